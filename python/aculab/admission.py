@@ -0,0 +1,255 @@
+# Copyright (C) 2009 Lars Immisch
+
+"""Admission control for calls.
+
+An overloaded reactor delays the media callbacks of all calls, and every
+new call makes it worse. The L{AdmissionControl} watches the lag and the
+backlog of a reactor. While the reactor is overloaded, new incoming calls
+are rejected and new outgoing calls are deferred until it has recovered.
+Calls that are already connected are not affected.
+
+A deferred outgoing call has no handle until it is placed. If it cannot
+be placed, because it was deferred for longer than C{timeout} or because
+the C{openout} failed, the controller of the call is told with::
+
+    def openout_failed(self, call, reason, user_data):
+        pass
+
+reason is the exception: an L{Overloaded} or the L{AculabError
+<error.AculabError>} of the C{openout}. If too many calls are deferred
+already, the C{openout} raises L{Overloaded} instead.
+
+The checks are done by L{CallHandle.ev_incoming_call_det
+<callcontrol.CallHandle.ev_incoming_call_det>},
+L{SIPHandle.ev_incoming_call_det <sip.SIPHandle.ev_incoming_call_det>}
+and the C{openout} methods of both, for calls on a reactor with an
+attached admission control.
+
+Usage::
+
+    admission = AdmissionControl(Reactor, max_lag = 0.05)
+    admission.start()
+"""
+
+import logging
+from collections import deque
+# local imports
+import lowlevel
+from instrument import Histogram
+from timer import monotonic
+
+log = logging.getLogger('admission')
+
+class Overloaded(Exception):
+    """An outgoing call was not placed because the reactor is
+    overloaded."""
+    pass
+
+class AdmissionControl(object):
+    """Reject and defer new calls while a reactor is overloaded.
+
+    The lag is measured with a periodic timer: the reactor is late by the
+    time between the deadline and the call of the timer. The backlog is
+    the number of callbacks waiting for the reactor, see
+    L{PollReactor.backlog <posixreactor.PollReactor.backlog>}. Reactors
+    without a backlog are judged by the lag only.
+
+    The reactor is overloaded if the lag or the backlog exceed their
+    maximum. It has recovered after C{recovery} consecutive measurements
+    below half the maximum.
+
+    When the reactor has recovered, deferred outgoing calls are started
+    in order, at most C{release} per interval. At most C{max_pending} calls
+    are deferred, and calls that were deferred for more than C{timeout}
+    seconds are dropped."""
+
+    def __init__(self, reactor, max_lag = 0.05, max_backlog = 200,
+                 interval = 0.1, recovery = 5,
+                 cause = lowlevel.LC_NUMBER_BUSY, sip_code = 503,
+                 release = 10, max_pending = 100, timeout = 30.0):
+        """Create an admission control for reactor.
+
+        @param reactor: The reactor of the calls.
+        @param max_lag: The maximum lag in seconds.
+        @param max_backlog: The maximum number of waiting callbacks.
+        @param interval: The interval of the measurements in seconds.
+        @param recovery: The number of good measurements before new calls
+        are admitted again.
+        @param cause: The cause for rejected calls.
+        @param sip_code: The response code for rejected SIP calls.
+        @param release: The maximum number of deferred outgoing calls that
+        are started per interval.
+        @param max_pending: The maximum number of deferred outgoing calls.
+        @param timeout: The maximum time in seconds that an outgoing call
+        is deferred."""
+        self.reactor = reactor
+        self.max_lag = max_lag
+        self.max_backlog = max_backlog
+        self.interval = interval
+        self.recovery = recovery
+        self.cause = cause
+        self.sip_code = sip_code
+        self.release = release
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.periodic = None
+        self.overloaded = False
+        # consecutive good measurements while overloaded
+        self.good = 0
+        self.lag = 0.0
+        self.backlog = 0
+        # lag in microseconds
+        self.lags = Histogram()
+        self.overloads = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.deferred = 0
+        self.refused = 0
+        self.expired = 0
+        self.failed = 0
+        # deferred outgoing calls: (time, call, function, args, kwargs)
+        self.pending = deque()
+
+    def start(self):
+        """Attach the admission control to the reactor and start the
+        measurements."""
+        self.reactor.admission = self
+        self.periodic = self.reactor.add_periodic(self.interval, self.probe,
+                                                  policy = 'coalesce')
+
+    def stop(self):
+        """Detach the admission control from the reactor.
+
+        Deferred outgoing calls that have not expired are started
+        immediately."""
+        if getattr(self.reactor, 'admission', None) is self:
+            self.reactor.admission = None
+        if self.periodic:
+            self.periodic.cancel()
+            self.periodic = None
+
+        self.overloaded = False
+        self.expire()
+        while self.pending:
+            self.start_deferred()
+
+    def probe(self):
+        """Measure lag and backlog. Used internally."""
+        lag = max(self.periodic.late, 0.0)
+        backlog = 0
+        if hasattr(self.reactor, 'backlog'):
+            backlog = self.reactor.backlog()
+
+        self.lag = lag
+        self.backlog = backlog
+        self.lags.add(lag * 1e6)
+
+        if lag > self.max_lag or backlog > self.max_backlog:
+            self.good = 0
+            if not self.overloaded:
+                self.overloaded = True
+                self.overloads += 1
+                log.warn('reactor overloaded (lag %.1f ms, backlog %d), '
+                         'rejecting new calls', lag * 1000, backlog)
+        elif lag < self.max_lag / 2 and backlog <= self.max_backlog / 2:
+            if self.overloaded:
+                self.good += 1
+                if self.good >= self.recovery:
+                    self.overloaded = False
+                    self.good = 0
+                    log.info('reactor recovered (lag %.1f ms, backlog %d), '
+                             'admitting new calls', lag * 1000, backlog)
+        else:
+            self.good = 0
+
+        self.expire()
+        if not self.overloaded:
+            for i in range(min(self.release, len(self.pending))):
+                self.start_deferred()
+
+    def expire(self):
+        """Drop the deferred outgoing calls that are older than the
+        timeout. Used internally."""
+        deadline = monotonic() - self.timeout
+        while self.pending and self.pending[0][0] <= deadline:
+            t, call, function, args, kwargs = self.pending.popleft()
+            self.expired += 1
+            log.warn('%s deferred %s expired after %.1fs', call.name,
+                     function.__name__, self.timeout)
+            self.fail(call, Overloaded('deferred for more than %.1fs' %
+                                       self.timeout))
+
+    def start_deferred(self):
+        """Start the oldest deferred outgoing call. Used internally."""
+        t, call, function, args, kwargs = self.pending.popleft()
+        try:
+            function(*args, **kwargs)
+        except Exception, e:
+            self.failed += 1
+            log.error('%s error in deferred %s', call.name,
+                      function.__name__, exc_info=1)
+            self.fail(call, e)
+
+    def fail(self, call, reason):
+        """Tell the controller of call that a deferred outgoing call was
+        not placed. Used internally."""
+        f = getattr(call.controllers[-1], 'openout_failed', None)
+        if f:
+            try:
+                f(call, reason, call.user_data)
+            except:
+                log.error('%s error in openout_failed', call.name,
+                          exc_info=1)
+
+    def admit(self, call):
+        """Return True if the incoming call may be accepted.
+
+        Called by the C{ev_incoming_call_det} handlers."""
+        if self.overloaded:
+            self.rejected += 1
+            log.info('%s rejected, reactor overloaded', call.name)
+            return False
+
+        self.admitted += 1
+        return True
+
+    def defer(self, call, function, *args, **kwargs):
+        """Defer an outgoing call while the reactor is overloaded.
+
+        Called by the C{openout} methods with themselves as function.
+
+        @return: True if the call was deferred. C{function(*args, **kwargs)}
+        will be called from the reactor when it has recovered.
+        @raise Overloaded: if C{max_pending} calls are deferred already."""
+        if not self.overloaded:
+            return False
+
+        if len(self.pending) >= self.max_pending:
+            self.refused += 1
+            raise Overloaded('%d outgoing calls deferred already' %
+                             len(self.pending))
+
+        self.deferred += 1
+        self.pending.append((monotonic(), call, function, args, kwargs))
+        return True
+
+    def stats(self):
+        """Return the state, the thresholds and the counters as a
+        dictionary.
+
+        Lags are in microseconds, like in the
+        L{reactor statistics <instrument.ReactorStats>}."""
+        return { 'overloaded': self.overloaded,
+                 'lag': self.lag * 1e6,
+                 'backlog': self.backlog,
+                 'max_lag': self.max_lag * 1e6,
+                 'max_backlog': self.max_backlog,
+                 'lags': self.lags.snapshot(),
+                 'overloads': self.overloads,
+                 'admitted': self.admitted,
+                 'rejected': self.rejected,
+                 'deferred': self.deferred,
+                 'refused': self.refused,
+                 'expired': self.expired,
+                 'failed': self.failed,
+                 'pending': len(self.pending) }
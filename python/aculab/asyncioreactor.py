@@ -0,0 +1,390 @@
+# Copyright (C) 2009 Lars Immisch
+
+"""Reactor implementation on top of an asyncio event loop.
+
+This allows to run calls in the same event loop as other asyncio based
+code (HTTP clients, database clients), without a second thread.
+
+The L{AsyncioReactor} implements the interface of the
+L{PollReactor <posixreactor.PollReactor>}: driver fds are watched with
+C{loop.add_reader}/C{loop.add_writer} and timers use C{loop.call_later}.
+
+The L{FutureController} and the C{Async*} wrappers turn controller
+callbacks into futures, so that a coroutine can do (with the C{trollius}
+backport of asyncio for Python 2)::
+
+    from trollius import From, coroutine
+
+    @coroutine
+    def greet(channel):
+        reason = yield From(channel.play('greeting.al'))
+
+    controller = FutureController(app_controller)
+    channel = AsyncChannel(SpeechChannel(controller, reactor = reactor))
+    reactor.loop.create_task(greet(channel))
+"""
+
+from __future__ import with_statement
+
+import sys
+import threading
+import select
+import logging
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+# local imports
+from timer import Timer, Periodic, monotonic
+from executor import run_in_executor
+
+log = logging.getLogger('reactor')
+
+class AsyncioReactor(object):
+    """Prosody Event reactor running in an asyncio event loop.
+
+    The reactor must be created in the thread that runs the loop. Events
+    and timers may be added from other threads.
+
+    Driver events with C{POLLIN} or C{POLLPRI} are watched with
+    C{add_reader}, C{POLLOUT} with C{add_writer}.
+
+    Raising C{StopIteration} in a callback stops the loop. Other exceptions
+    are logged, stop the loop and are raised from L{run}, like in the
+    L{PollReactor <posixreactor.PollReactor>}."""
+
+    def __init__(self, loop = None):
+        """Create a reactor.
+
+        @param loop: The event loop. The default is the current event loop.
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        self.loop = loop
+        self.thread = threading.currentThread()
+        # map fd to (mode, method)
+        self.handles = {}
+        # the exception of the callback that stopped the loop (exc_info)
+        self.error = None
+
+    def in_loop(self):
+        """Return True if called from the thread of the event loop."""
+        return threading.currentThread() == self.thread
+
+    def call(self, function, *args):
+        """Call function in the loop thread. Used internally."""
+        if self.in_loop():
+            function(*args)
+        else:
+            self.loop.call_soon_threadsafe(function, *args)
+
+    def call_soon(self, function, *args):
+        """Call function from the event loop as soon as possible.
+
+        This is safe to call from any thread."""
+        self.loop.call_soon_threadsafe(self.dispatch, function, *args)
+
+    def call_from_signal(self, function, *args):
+        """Call function from the event loop as soon as possible.
+
+        This is safe to call from a signal handler: the event loop queues
+        the call without a lock and wakes up through its self-pipe."""
+        self.loop.call_soon_threadsafe(self.dispatch, function, *args)
+
+    def call_from_thread(self, function, *args):
+        """Call function in the thread of the event loop.
+
+        From the thread of the event loop, function is called immediately."""
+        self.call(function, *args)
+
+    def run_in_executor(self, function, *args, **kwargs):
+        """Call function(*args) in a worker thread, without blocking the
+        reactor.
+
+        @param callback: Keyword argument. Called in the reactor thread as
+        C{callback(result, exception)} when function has returned.
+        @param executor: Keyword argument. The L{WorkerPool
+        <executor.WorkerPool>}. The default is the pool shared by all
+        reactors."""
+        run_in_executor(self, function, args, kwargs)
+
+    def dispatch(self, function, *args):
+        """Call a reactor callback. Used internally."""
+        try:
+            function(*args)
+        except (StopIteration, KeyboardInterrupt):
+            self.loop.stop()
+        except:
+            log.error('error in AsyncioReactor callback %s', function,
+                      exc_info=1)
+            # raised from run
+            if self.error is None:
+                self.error = sys.exc_info()
+            self.loop.stop()
+
+    def on_event(self, handle):
+        """Dispatch an event on handle. Used internally."""
+        mode, method = self.handles.get(handle, (None, None))
+        # ignore missing method, it must have been removed
+        if method:
+            self.dispatch(method)
+
+    def add_timer(self, interval, function, args = [], kwargs={}, slack = 0):
+        '''Add a timer after interval in seconds.
+
+        @param slack: The timer may be delayed by up to slack seconds, so
+        that it expires together with other timers.'''
+
+        t = Timer(interval, function, args, kwargs, slack)
+        t.handle = None
+
+        self.call(self.arm_timer, t.absolute - monotonic(), t)
+
+        return t
+
+    def arm_timer(self, interval, timer):
+        """Schedule a timer in the loop. Used internally."""
+        if timer.pending:
+            timer.handle = self.loop.call_later(interval, self.run_timer,
+                                                timer)
+
+    def run_timer(self, timer):
+        """Run a timer. Used internally."""
+        if timer.pending:
+            timer.pending = False
+            self.dispatch(timer)
+
+    def cancel_timer(self, timer):
+        '''Cancel a timer.
+        Cancelling an expired timer raises a ValueError'''
+
+        if not timer.pending:
+            raise ValueError('timer is not pending')
+
+        timer.pending = False
+        # a foreign thread just leaves the handle to run_timer
+        if timer.handle and self.in_loop():
+            timer.handle.cancel()
+
+    def add_periodic(self, interval, function, args = [], kwargs = {},
+                     policy = 'skip'):
+        """Call function every interval seconds, until the returned
+        L{Periodic <timer.Periodic>} is cancelled.
+
+        @param policy: What to do when the reactor falls behind by one or
+        more intervals: C{'skip'}, C{'burst'} or C{'coalesce'}. See
+        L{Periodic <timer.Periodic>}."""
+
+        p = Periodic(self, interval, function, args, kwargs, policy)
+        p.schedule()
+
+        return p
+
+    def add(self, handle, mode, method, edge = False, priority = None):
+        """Add an event to the reactor.
+
+        @param handle: A file descriptor, B{not} a File object.
+        @param mode: A bitmask of select.POLLOUT, select.POLLIN, etc.
+        @param method: This will be called when the event is fired.
+        @param edge: Ignored.
+        @param priority: Ignored, the event loop has no priorities."""
+
+        if not callable(method):
+            raise ValueError('method must be callable')
+
+        self.call(self.register, handle, mode, method)
+
+    def register(self, handle, mode, method):
+        """Register an event in the loop. Used internally."""
+        # a repeated add modifies the event, like in the PollReactor
+        if handle in self.handles:
+            self.unregister(handle)
+        self.handles[handle] = (mode, method)
+        if mode & (select.POLLIN | select.POLLPRI):
+            self.loop.add_reader(handle, self.on_event, handle)
+        if mode & select.POLLOUT:
+            self.loop.add_writer(handle, self.on_event, handle)
+
+    def remove(self, handle):
+        """Remove a handle from the reactor.
+
+        @param handle: A file descriptor."""
+
+        self.call(self.unregister, handle)
+
+    def unregister(self, handle):
+        """Unregister an event from the loop. Used internally."""
+        mode, method = self.handles.pop(handle)
+        if mode & (select.POLLIN | select.POLLPRI):
+            self.loop.remove_reader(handle)
+        if mode & select.POLLOUT:
+            self.loop.remove_writer(handle)
+
+    def run(self):
+        """Run the event loop until a callback raises StopIteration.
+
+        An exception from a callback stops the loop and is raised here."""
+        self.thread = threading.currentThread()
+        self.error = None
+        try:
+            self.loop.run_forever()
+        except KeyboardInterrupt:
+            return
+
+        error, self.error = self.error, None
+        if error:
+            raise error[0], error[1], error[2]
+
+class FutureController(object):
+    """A controller that resolves futures from controller callbacks.
+
+    All callbacks are passed on to an (optional) application controller.
+
+    Futures are created with L{expect} (usually by the C{Async*}
+    wrappers) and are resolved when the callback is called for the object.
+    """
+
+    # map the supported callbacks to the kind of result: 'reason' resolves
+    # the future with the reason (the first argument after the object)
+    callbacks = { 'play_done': 'reason',
+                  'record_done': 'reason',
+                  'digits_done': 'reason',
+                  'tone_done': 'reason',
+                  'silence_done': 'reason',
+                  'faxrx_done': 'reason',
+                  'faxtx_done': 'reason',
+                  'ev_call_connected': None,
+                  'ev_idle': None,
+                  'vmprx_ready': None }
+
+    def __init__(self, controller = None, loop = None):
+        """Create a FutureController.
+
+        @param controller: The application controller.
+        @param loop: The event loop. The default is the current event loop.
+        """
+        if loop is None:
+            loop = asyncio.get_event_loop()
+
+        self.controller = controller
+        self.loop = loop
+        # map (object, callback name) to a list of futures
+        self.futures = {}
+
+    def expect(self, obj, name):
+        """Return a future that is resolved when the callback name
+        is called for obj.
+
+        The result is the reason for job callbacks and C{None} for events."""
+        if name not in self.callbacks:
+            raise ValueError('%s is not supported' % name)
+
+        f = asyncio.Future(loop = self.loop)
+        self.futures.setdefault((obj, name), []).append(f)
+
+        return f
+
+    def resolve(self, name, obj, args):
+        """Resolve the futures for obj and pass the callback on."""
+        result = None
+        if self.callbacks[name] == 'reason':
+            result = args[0]
+
+        for f in self.futures.pop((obj, name), []):
+            if not f.done():
+                f.set_result(result)
+
+        m = getattr(self.controller, name, None)
+        if m:
+            m(obj, *args)
+
+    def __getattr__(self, name):
+        if name in self.callbacks:
+            return lambda obj, *args: self.resolve(name, obj, args)
+
+        if self.controller is None:
+            raise AttributeError(name)
+
+        return getattr(self.controller, name)
+
+class AsyncWrapper(object):
+    """Base class for the C{Async*} wrappers.
+
+    Attributes that are not defined in the wrapper are looked up in the
+    wrapped object."""
+
+    def __init__(self, obj, controller = None):
+        """Wrap obj.
+
+        @param obj: A SpeechChannel, CallHandle or VMPrx.
+        @param controller: The L{FutureController}. The default is the
+        controller of obj."""
+        self.obj = obj
+        if controller is None:
+            if hasattr(obj, 'controllers'):
+                controller = obj.controllers[-1]
+            else:
+                controller = obj.controller
+
+        if not isinstance(controller, FutureController):
+            raise ValueError('the controller must be a FutureController')
+
+        self.controller = controller
+
+    def __getattr__(self, name):
+        return getattr(self.obj, name)
+
+    def start(self, name, method, *args, **kwargs):
+        """Call method and return the future for the callback name."""
+        f = self.controller.expect(self.obj, name)
+        try:
+            method(*args, **kwargs)
+        except:
+            self.controller.futures[(self.obj, name)].remove(f)
+            raise
+
+        return f
+
+class AsyncChannel(AsyncWrapper):
+    """A L{SpeechChannel <speech.SpeechChannel>} with methods that return
+    futures. The future is resolved with the reason of the job."""
+
+    def play(self, *args, **kwargs):
+        return self.start('play_done', self.obj.play, *args, **kwargs)
+
+    def record(self, *args, **kwargs):
+        return self.start('record_done', self.obj.record, *args, **kwargs)
+
+    def digits(self, *args, **kwargs):
+        return self.start('digits_done', self.obj.digits, *args, **kwargs)
+
+    def tone(self, *args, **kwargs):
+        return self.start('tone_done', self.obj.tone, *args, **kwargs)
+
+    def silence(self, *args, **kwargs):
+        return self.start('silence_done', self.obj.silence, *args, **kwargs)
+
+class AsyncCall(AsyncWrapper):
+    """A L{CallHandle <callcontrol.CallHandle>} or
+    L{SIPHandle <sip.SIPHandle>} that returns futures for call events."""
+
+    def connected(self):
+        """Return a future that is resolved on C{EV_CALL_CONNECTED}."""
+        return self.controller.expect(self.obj, 'ev_call_connected')
+
+    def idle(self):
+        """Return a future that is resolved on C{EV_IDLE}."""
+        return self.controller.expect(self.obj, 'ev_idle')
+
+class AsyncVMPrx(AsyncWrapper):
+    """A L{VMPrx <rtp.VMPrx>} that returns a future for C{vmprx_ready}."""
+
+    def ready(self):
+        """Return a future that is resolved when the VMPrx is ready."""
+        if self.obj.rtp_port is not None:
+            f = asyncio.Future(loop = self.controller.loop)
+            f.set_result(None)
+            return f
+
+        return self.controller.expect(self.obj, 'vmprx_ready')
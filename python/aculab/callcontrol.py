@@ -15,9 +15,10 @@ import getopt
 import lowlevel
 import aculab
 import logging
-from reactor import Reactor, add_call_event, remove_call_event
+from reactor import Reactor, add_call_event, remove_call_event, HANDLED
 from switching import Connection, CTBusEndpoint, NetEndpoint, DefaultBus
 from error import AculabError
+from drain import draining, call_started, call_ended
 
 log = logging.getLogger('call')
 log_switch = logging.getLogger('switch')
@@ -138,7 +139,14 @@ class CallHandle(CallHandleBase):
         <http://www.aculab.com/Support/v6_api/CallControl/cc8.htm>}.
         @param cnf: see U{cnf
         <http://www.aculab.com/Support/v6_api/CallControl/glos/cnf.htm>}
+
+        While the process is L{draining <drain>}, the handle is not opened.
         """
+        drain = draining()
+        if drain:
+            drain.retire(self)
+            return
+
         inparms = lowlevel.IN_XPARMS()
         inparms.net = self.port
         inparms.ts = self.timeslot
@@ -216,7 +224,25 @@ class CallHandle(CallHandleBase):
         call_feature_openout.htm>}.
         @param cnf: see U{cnf
         <http://www.aculab.com/Support/v6_api/CallControl/glos/cnf.htm>}.
+
+        If the reactor is overloaded, the call is deferred until it has
+        recovered and no handle is allocated yet. If it cannot be placed
+        later, the controller's C{openout_failed} is called, see
+        L{admission}.
+
+        @raise Overloaded: if the call cannot be deferred, see
+        L{AdmissionControl.defer <admission.AdmissionControl.defer>}.
         """
+
+        admission = getattr(self.reactor, 'admission', None)
+        if admission and admission.defer(self, self.openout,
+                                         destination_address,
+                                         sending_complete,
+                                         originating_address, unique,
+                                         feature_type, feature, cnf):
+            log.info('%s openout(%s) deferred, reactor overloaded',
+                     self.name, destination_address)
+            return
         
         outparms = self._outparms(destination_address, sending_complete,
                                   originating_address, unique,
@@ -243,6 +269,7 @@ class CallHandle(CallHandleBase):
                   sending_complete, originating_address)
 
         add_call_event(self.reactor, self)
+        call_started(self)
 
     def feature_send(self, feature_type, feature,
                      message_control=lowlevel.CONTROL_NEXT_CC_MESSAGE):
@@ -618,6 +645,7 @@ class CallHandle(CallHandleBase):
 
         # reset details
         self.details = lowlevel.DETAIL_XPARMS()
+        call_ended(self)
 
         if self.handle:
             
@@ -657,9 +685,27 @@ class CallHandle(CallHandleBase):
         """Internal event handler for C{EV_INCOMING_CALL_DETECTED}.
 
         Calls L{get_details} to cache them.
+
+        If the process is L{draining <drain>} or the reactor is overloaded,
+        the call is disconnected with the cause of the drain or the
+        L{admission control <admission.AdmissionControl>} and the controller
+        does not see the event.
         """
         self.get_details()
 
+        drain = draining()
+        if drain:
+            drain.refuse(self)
+            self.disconnect(drain.cause)
+            return HANDLED
+
+        admission = getattr(self.reactor, 'admission', None)
+        if admission and not admission.admit(self):
+            self.disconnect(admission.cause)
+            return HANDLED
+
+        call_started(self)
+
     def ev_ext_hold_request(self):
         """Internal event handler for C{EV_EXT_HOLD_REQUEST}.
 
@@ -0,0 +1,225 @@
+# Copyright (C) 2009 Lars Immisch
+
+"""Drain the calls of a process before a restart.
+
+A restart cuts all active calls and recordings. A L{Drain} lets them
+finish instead:
+
+ - idle call handles are not opened again: L{CallHandle.openin
+   <callcontrol.CallHandle.openin>} and L{SIPHandle.openin
+   <sip.SIPHandle.openin>} do nothing while draining, so the usual
+   C{call.openin()} in C{ev_idle} retires the handle.
+ - new incoming calls on handles that are still open are rejected with
+   C{cause} (PSTN) or C{sip_code} (SIP), like under L{admission control
+   <admission>}.
+ - calls in progress, jobs on L{SpeechChannel <speech.SpeechChannel>}s
+   (play, record, FAX) and work queued with C{reactor.run_in_executor}
+   continue.
+
+When no calls, jobs and background work are left, or when the timeout
+has passed, the drain stops the reactor. Progress is logged every
+C{interval} seconds and passed to C{report}, if given.
+
+The drain is process-wide: all reactors of the process stop accepting
+calls. The calls and jobs are tracked by the call handles and speech
+channels, see L{call_started} and L{job_started}.
+
+Usage, for a restart with SIGTERM::
+
+    drain_on_signal(Reactor, timeout = 600)
+    Reactor.run()
+"""
+
+import signal
+import logging
+# local imports
+import lowlevel
+from executor import default_pool
+from timer import monotonic
+
+log = logging.getLogger('drain')
+
+# the calls and the owners of jobs in progress (speech channels, T.38
+# gateway jobs), in all reactors
+_calls = set()
+_jobs = set()
+# the active drain, if any
+_drain = None
+
+def call_started(call):
+    """Track a call in progress. Called when an incoming call is accepted
+    and by C{openout}."""
+    _calls.add(call)
+
+def call_ended(call):
+    """Stop tracking a call. Called by C{release}."""
+    _calls.discard(call)
+
+def job_started(owner):
+    """Track a job of owner. Called by L{SpeechChannel.start
+    <speech.SpeechChannel.start>} and for L{T38GWJob <fax.T38GWJob>}s."""
+    _jobs.add(owner)
+
+def job_ended(owner):
+    """Stop tracking the job of owner. Called by L{SpeechChannel.job_done
+    <speech.SpeechChannel.job_done>} and L{T38GWJob.close
+    <fax.T38GWJob.close>}."""
+    _jobs.discard(owner)
+
+def draining():
+    """Return the active L{Drain} or C{None}."""
+    return _drain
+
+class Drain(object):
+    """Stop taking new calls and stop the reactor when the calls in
+    progress have finished."""
+
+    def __init__(self, reactor, timeout = 600.0, interval = 5.0,
+                 cause = lowlevel.LC_NUMBER_BUSY, sip_code = 503,
+                 report = None, exit = None, executor = None):
+        """Create a drain.
+
+        @param reactor: The reactor that checks the progress.
+        @param timeout: The maximum duration of the drain in seconds.
+        Calls that are still active then are cut.
+        @param interval: The interval of the progress checks and reports
+        in seconds.
+        @param cause: The cause for rejected PSTN calls.
+        @param sip_code: The response code for rejected SIP calls.
+        @param report: Called as C{report(stats)} with the L{stats} after
+        each check, e.g. L{MetricsReporter.report
+        <supervisor.MetricsReporter.report>}.
+        @param exit: Called when the drain is complete. The default raises
+        StopIteration, which stops the reactor. Pass a function that stops
+        all reactors for a L{ReactorGroup <reactor.ReactorGroup>}.
+        @param executor: The L{WorkerPool <executor.WorkerPool>} of the
+        background work. The default is the shared pool."""
+        self.reactor = reactor
+        self.timeout = timeout
+        self.interval = interval
+        self.cause = cause
+        self.sip_code = sip_code
+        self.report = report
+        self.exit = exit
+        self.executor = executor or default_pool
+        self.started = None
+        self.deadline = None
+        self.periodic = None
+        self.rejected = 0
+        self.retired = 0
+
+    def start(self):
+        """Start draining. Must be called in the thread of the reactor."""
+        global _drain
+        if _drain is not None:
+            raise RuntimeError('already draining')
+
+        _drain = self
+        self.started = monotonic()
+        self.deadline = self.started + self.timeout
+        log.info('draining %d calls, %d jobs (timeout %.0fs)',
+                 len(_calls), len(_jobs), self.timeout)
+
+        self.periodic = self.reactor.add_periodic(self.interval, self.check)
+        self.reactor.call_soon(self.check)
+
+    def cancel(self):
+        """Stop draining and accept calls again.
+
+        Handles that were retired are not reopened."""
+        global _drain
+        if _drain is self:
+            _drain = None
+        if self.periodic:
+            self.periodic.cancel()
+            self.periodic = None
+        log.info('drain cancelled')
+
+    def expire(self):
+        """End the drain at the next check, even if calls are active."""
+        self.deadline = monotonic()
+        self.check()
+
+    def refuse(self, call):
+        """Count and log a rejected incoming call. Called by the
+        C{ev_incoming_call_det} handlers, which disconnect the call."""
+        self.rejected += 1
+        log.info('%s rejected, draining', call.name)
+
+    def retire(self, call):
+        """Count and log a handle that is not opened again. Called by the
+        C{openin} methods."""
+        self.retired += 1
+        log.debug('%s not reopened, draining', call.name)
+
+    def pending(self):
+        """Return the number of functions queued or running in the
+        executor."""
+        stats = self.executor.stats()
+        return stats['queued'] + stats['busy']
+
+    def stats(self):
+        """Return the progress as a dictionary."""
+        now = monotonic()
+        return { 'calls': len(_calls),
+                 'jobs': len(_jobs),
+                 'pending': self.pending(),
+                 'elapsed': now - self.started,
+                 'remaining': max(self.deadline - now, 0.0),
+                 'rejected': self.rejected,
+                 'retired': self.retired }
+
+    def check(self):
+        """Report the progress and exit when done. Used internally."""
+        if _drain is not self or self.periodic is None:
+            return
+
+        stats = self.stats()
+        if self.report:
+            self.report(stats)
+
+        busy = stats['calls'] or stats['jobs'] or stats['pending']
+        if busy and stats['remaining'] > 0:
+            log.info('draining: %(calls)d calls, %(jobs)d jobs, '
+                     '%(pending)d background tasks, %(remaining).0fs left',
+                     stats)
+            return
+
+        if busy:
+            log.warn('drain timed out after %(elapsed).0fs: %(calls)d calls, '
+                     '%(jobs)d jobs, %(pending)d background tasks left',
+                     stats)
+        else:
+            log.info('drained in %(elapsed).1fs, %(rejected)d calls '
+                     'rejected', stats)
+
+        self.periodic.cancel()
+        self.periodic = None
+        if self.exit:
+            self.exit()
+        else:
+            raise StopIteration
+
+def drain_on_signal(reactor, signum = signal.SIGTERM, **kwargs):
+    """Start a L{Drain} when the process receives signum.
+
+    A second signal ends the drain immediately.
+
+    The drain is started from the reactor loop with C{call_from_signal},
+    because the signal may interrupt the reactor thread while it holds
+    the reactor's mutex.
+
+    @param kwargs: The keyword arguments of L{Drain}.
+    @return: The drain."""
+    drain = Drain(reactor, **kwargs)
+    signals = []
+
+    def handler(signum, frame):
+        signals.append(signum)
+        if len(signals) == 1:
+            reactor.call_from_signal(drain.start)
+        else:
+            reactor.call_from_signal(drain.expire)
+
+    signal.signal(signum, handler)
+    return drain
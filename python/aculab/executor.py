@@ -0,0 +1,179 @@
+# Copyright (C) 2009 Lars Immisch
+
+"""A shared pool of worker threads for blocking work.
+
+Controllers must not block the reactor, but starting a thread per call
+for blocking work (a lookup, sending mail) creates hundreds of threads in
+a burst of calls. The reactors offer C{run_in_executor} instead::
+
+    def done(result, exception):
+        # called in the reactor thread
+        ...
+
+    reactor.run_in_executor(lookup, cli, callback = done)
+
+The function runs in a L{WorkerPool} with a bounded number of threads and
+the callback is called in the reactor thread with the result, or with
+the exception if the function raised one.
+
+All reactors share the L{default_pool} unless an executor is passed.
+"""
+
+from __future__ import with_statement
+
+import sys
+import time
+import threading
+import logging
+from collections import deque
+# local imports
+from instrument import Histogram
+
+log = logging.getLogger('executor')
+
+class WorkerPool(object):
+    """A bounded pool of worker threads.
+
+    Threads are started on demand, up to C{workers}. Work that arrives
+    while all threads are busy is queued. If C{max_queue} is not C{None}
+    and the queue is full, L{submit} raises a RuntimeError."""
+
+    def __init__(self, workers = 8, max_queue = None, name = 'worker'):
+        """Create a pool.
+
+        @param workers: The maximum number of threads.
+        @param max_queue: The maximum number of queued functions, or
+        C{None} for no limit.
+        @param name: The name of the threads."""
+        self.workers = workers
+        self.max_queue = max_queue
+        self.name = name
+        self.mutex = threading.Lock()
+        self.condition = threading.Condition(self.mutex)
+        # (reactor, function, args, callback, submit time)
+        self.queue = deque()
+        self.threads = []
+        self.idle = 0
+        self.shutdown = False
+        # statistics, protected by the mutex
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.rejected = 0
+        self.max_queued = 0
+        # times in microseconds
+        self.wait = Histogram()
+        self.run_time = Histogram()
+
+    def submit(self, reactor, function, args = (), callback = None):
+        """Call function(*args) in a worker thread and pass the result to
+        callback in the thread of reactor.
+
+        @param callback: Called as C{callback(result, exception)}.
+        exception is None if function returned normally, result is None if
+        it raised an exception."""
+        with self.mutex:
+            if self.shutdown:
+                raise RuntimeError('%s pool is shut down' % self.name)
+
+            if self.max_queue is not None \
+                   and len(self.queue) >= self.max_queue:
+                self.rejected += 1
+                raise RuntimeError('%s queue is full (%d)' %
+                                   (self.name, len(self.queue)))
+
+            self.queue.append((reactor, function, args, callback,
+                               time.time()))
+            self.submitted += 1
+            if len(self.queue) > self.max_queued:
+                self.max_queued = len(self.queue)
+
+            if self.idle:
+                self.condition.notify()
+            elif len(self.threads) < self.workers:
+                t = threading.Thread(target = self.run, name = '%s-%d' %
+                                     (self.name, len(self.threads)))
+                t.setDaemon(1)
+                self.threads.append(t)
+                t.start()
+
+    def run(self):
+        """The main function of a worker thread. Used internally."""
+        while True:
+            with self.mutex:
+                while not self.queue and not self.shutdown:
+                    self.idle += 1
+                    self.condition.wait()
+                    self.idle -= 1
+
+                if not self.queue:
+                    return
+
+                reactor, function, args, callback, submitted = \
+                         self.queue.popleft()
+                start = time.time()
+                self.wait.add((start - submitted) * 1e6)
+
+            result = None
+            exception = None
+            try:
+                result = function(*args)
+            except:
+                exception = sys.exc_info()[1]
+                log.warn('error in %s', getattr(function, '__name__',
+                                                function), exc_info=1)
+
+            with self.mutex:
+                self.run_time.add((time.time() - start) * 1e6)
+                if exception is None:
+                    self.completed += 1
+                else:
+                    self.failed += 1
+
+            # always queue the callback: the reactor may not be running yet
+            if callback is not None:
+                reactor.call_soon(callback, result, exception)
+
+    def stop(self):
+        """Stop the threads when the queue is empty and wait for them."""
+        with self.mutex:
+            self.shutdown = True
+            self.condition.notifyAll()
+            threads = self.threads[:]
+
+        for t in threads:
+            t.join()
+
+    def stats(self):
+        """Return the pool statistics as a dictionary.
+
+        C{wait} is the time functions spend in the queue and C{run} the time
+        they run, both in microseconds."""
+        with self.mutex:
+            return { 'workers': self.workers,
+                     'threads': len(self.threads),
+                     'busy': len(self.threads) - self.idle,
+                     'queued': len(self.queue),
+                     'max_queued': self.max_queued,
+                     'submitted': self.submitted,
+                     'completed': self.completed,
+                     'failed': self.failed,
+                     'rejected': self.rejected,
+                     'wait': self.wait.snapshot(),
+                     'run': self.run_time.snapshot() }
+
+# the pool shared by all reactors
+default_pool = WorkerPool()
+
+def run_in_executor(reactor, function, args, kwargs):
+    """Implementation of C{reactor.run_in_executor}. Used internally.
+
+    The keyword arguments C{callback} and C{executor} (a L{WorkerPool})
+    are accepted."""
+    callback = kwargs.pop('callback', None)
+    executor = kwargs.pop('executor', None) or default_pool
+    if kwargs:
+        raise TypeError('unexpected keyword arguments: %s' %
+                        ', '.join(kwargs.keys()))
+
+    executor.submit(reactor, function, args, callback)
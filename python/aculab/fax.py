@@ -12,6 +12,7 @@ from names import sm_error_names, fax_error_names
 from error import AculabError, AculabFAXError
 from util import translate_card, TiNG_version
 from reactor import Reactor
+from drain import job_started, job_ended
 # The following are only needed for type comparisons
 if TiNG_version[0] >= 2:
     from rtp import VMPtx, VMPrx, FMPtx, FMPrx
@@ -198,7 +199,9 @@ class FaxJob:
         channel = self.channel
         self.channel = None
 
-        channel.job_done(self, function, reason)
+        # done is called from the FAX thread
+        channel.reactor.call_from_thread(channel.job_done, self, function,
+                                         reason)
 
 class FaxRxJob(FaxJob, threading.Thread):
     """Job to receive a FAX.
@@ -575,6 +578,7 @@ if TiNG_version[0] >= 2:
             self.job = create.job
             self.fd = create.fd()
             self.reactor.add(self.fd, self.notify)
+            job_started(self)
 
         def notify(self):
             """I{Reactor callback}."""
@@ -594,6 +598,7 @@ if TiNG_version[0] >= 2:
 
             Should not be running (no auto-stop implemented).
             """
+            job_ended(self)
             if self.job:
                 rc = lowlevel.sm_t38gw_destroy_job(self.job)
                 self.job = None
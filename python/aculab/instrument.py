@@ -0,0 +1,196 @@
+# Copyright (C) 2009 Lars Immisch
+
+"""Instrumentation for the reactors.
+
+The data is kept in fixed-size log-linear L{Histogram}s, so recording
+a value is cheap and the memory use is constant."""
+
+import time
+import math
+import inspect
+
+class Histogram(object):
+    """A log-linear histogram of non-negative integers.
+
+    Every power of two is split into 2**sub_bits linear buckets, so the
+    relative error of the percentiles is at most 1/2**sub_bits.
+    Values above 2**max_bits are counted in the last bucket.
+
+    The reactors record times in microseconds."""
+
+    def __init__(self, sub_bits = 3, max_bits = 36):
+        self.sub_bits = sub_bits
+        self.sub_count = 1 << sub_bits
+        self.counts = [0] * ((max_bits - sub_bits + 2) * self.sub_count)
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def index(self, value):
+        """Return the bucket index for value. Used internally."""
+        if value < self.sub_count:
+            return value
+
+        # the position of the highest bit, like int.bit_length() - 1
+        e = math.frexp(value)[1] - 1
+        if not value >> e:
+            # the conversion to float rounded up, above 2 ** 53
+            e -= 1
+        m = (value >> (e - self.sub_bits)) - self.sub_count
+        return min((e - self.sub_bits + 1) * self.sub_count + m,
+                   len(self.counts) - 1)
+
+    def lower(self, index):
+        """Return the lowest value of the bucket index. Used internally."""
+        if index < self.sub_count:
+            return index
+
+        group, m = divmod(index, self.sub_count)
+        return (self.sub_count + m) << (group - 1)
+
+    def add(self, value):
+        """Record a value."""
+        value = int(value)
+        if value < 0:
+            value = 0
+
+        self.counts[self.index(value)] += 1
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """Return the value below which p percent of the values fall.
+
+        The value is the middle of the bucket, but never more than the
+        maximum."""
+        if not self.count:
+            return None
+
+        threshold = self.count * p / 100.0
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if c and seen >= threshold:
+                low = self.lower(i)
+                high = self.lower(i + 1)
+                return min((low + high - 1) // 2, self.max)
+
+        return self.max
+
+    def snapshot(self):
+        """Return a dictionary with count, min, max, mean and the 50th,
+        90th, 99th and 99.9th percentile."""
+        if self.count:
+            mean = self.total / float(self.count)
+        else:
+            mean = None
+
+        return { 'count': self.count,
+                 'min': self.min,
+                 'max': self.max,
+                 'mean': mean,
+                 'p50': self.percentile(50),
+                 'p90': self.percentile(90),
+                 'p99': self.percentile(99),
+                 'p999': self.percentile(99.9) }
+
+# cache for callback_name, maps (class, method name) to the name
+_names = {}
+
+def callback_name(method):
+    """Return a name for a reactor callback for the statistics.
+
+    Bound methods are named after the class that defines them, e.g.
+    C{PlayJobBase.fill_play_buffer}. For curried functions and timers, the
+    name of the function is used."""
+
+    obj = getattr(method, 'im_self', None)
+    if obj is not None:
+        key = (obj.__class__, method.__name__)
+        name = _names.get(key, None)
+        if name is None:
+            name = '%s.%s' % (obj.__class__.__name__, method.__name__)
+            for c in inspect.getmro(obj.__class__):
+                if c.__dict__.has_key(method.__name__):
+                    name = '%s.%s' % (c.__name__, method.__name__)
+                    break
+            _names[key] = name
+        return name
+
+    # curry or Timer
+    fun = getattr(method, 'fun', None) or getattr(method, 'function', None)
+    if fun is not None:
+        return callback_name(fun)
+
+    return getattr(method, '__name__', method.__class__.__name__)
+
+class ReactorStats(object):
+    """Statistics for a reactor.
+
+    All times are in microseconds:
+     - poll_wait: the time spent waiting in poll
+     - callbacks: the execution time of event callbacks, by callback name
+     - timers: the execution time of timers
+     - calls: the execution time of functions queued with call_soon
+     - timer_lateness: the time between the scheduled and the actual
+       start of a timer
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Clear all statistics."""
+        self.start = time.time()
+        self.events = 0
+        self.poll_wait = Histogram()
+        self.callbacks = {}
+        self.timers = Histogram()
+        self.calls = Histogram()
+        self.timer_lateness = Histogram()
+
+    def callback(self, name, elapsed):
+        """Record the execution time of a callback in seconds."""
+        h = self.callbacks.get(name, None)
+        if h is None:
+            h = self.callbacks[name] = Histogram()
+
+        h.add(elapsed * 1e6)
+
+    def timer(self, elapsed):
+        """Record the execution time of a timer in seconds."""
+        self.timers.add(elapsed * 1e6)
+
+    def call(self, elapsed):
+        """Record the execution time of a call_soon function in seconds."""
+        self.calls.add(elapsed * 1e6)
+
+    def late(self, lateness):
+        """Record the lateness of a timer in seconds."""
+        self.timer_lateness.add(lateness * 1e6)
+
+    def snapshot(self):
+        """Return the statistics as a dictionary of plain values."""
+        elapsed = time.time() - self.start
+        if elapsed > 0:
+            rate = self.events / elapsed
+        else:
+            rate = 0.0
+
+        callbacks = {}
+        for name, h in self.callbacks.items():
+            callbacks[name] = h.snapshot()
+
+        return { 'elapsed': elapsed,
+                 'events': self.events,
+                 'events_per_second': rate,
+                 'poll_wait': self.poll_wait.snapshot(),
+                 'callbacks': callbacks,
+                 'timers': self.timers.snapshot(),
+                 'calls': self.calls.snapshot(),
+                 'timer_lateness': self.timer_lateness.snapshot() }
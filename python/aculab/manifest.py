@@ -0,0 +1,151 @@
+# Copyright (C) 2009 Lars Immisch
+
+"""Load and validate the prompts of an application at startup.
+
+A prompt manifest is a list of prompt files, from a directory scan
+(L{scan}) or a list file (L{read_list}). L{preload} validates each prompt
+and pins it in the L{PromptCache <speech.PromptCache>}, so that the first
+callers after a restart do not wait for the disk, and a missing or broken
+prompt is reported at startup instead of in the middle of a call::
+
+    report = preload(scan(root) + [os.path.join(root, 'default.al')],
+                     strict = True)
+
+A prompt is rejected if:
+ - it is missing or cannot be read
+ - its extension is not in L{speech.filetypes}
+ - it is empty
+ - it has a WAV header (the prompts are raw PCM)
+ - it has an odd length, but 16 bit samples
+ - the cache does not hold it after loading
+
+Pinned prompts are cached even if they exceed the budget of the cache.
+"""
+
+import os
+import time
+import logging
+# local imports
+from speech import filetypes, prompt_cache
+
+log = logging.getLogger('manifest')
+
+def scan(directory, recursive = True):
+    """Return the prompt files in directory, sorted.
+
+    Only files with an extension in L{speech.filetypes} are prompts."""
+    prompts = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        for fn in filenames:
+            if os.path.splitext(fn)[1] in filetypes:
+                prompts.append(os.path.join(dirpath, fn))
+        if not recursive:
+            break
+
+    prompts.sort()
+    return prompts
+
+def read_list(filename):
+    """Read a list file with one prompt per line.
+
+    Empty lines and lines starting with C{#} are ignored. Relative names
+    are relative to the directory of the list file."""
+    directory = os.path.dirname(filename)
+    prompts = []
+    for line in file(filename):
+        line = line.strip()
+        if line and not line.startswith('#'):
+            prompts.append(os.path.join(directory, line))
+
+    return prompts
+
+def check(prompt):
+    """Check the data of a L{Prompt <speech.Prompt>}.
+
+    @return: a description of the problem or C{None}."""
+    if not prompt.length:
+        return 'empty'
+    if prompt.data[:4] == 'RIFF':
+        return 'WAV header'
+    if prompt.data_rate > prompt.sampling_rate and prompt.length % 2:
+        return 'odd length for 16 bit samples'
+
+    return None
+
+class PreloadReport(object):
+    """The result of L{preload}.
+
+    @ivar loaded: A list of the loaded L{Prompt <speech.Prompt>}s.
+    @ivar problems: A list of (filename, problem) tuples."""
+
+    def __init__(self):
+        self.loaded = []
+        self.problems = []
+        self.size = 0
+        self.elapsed = 0.0
+
+    def duration(self):
+        """Return the total duration of the loaded prompts in seconds."""
+        return sum([p.duration() for p in self.loaded])
+
+    def __str__(self):
+        return '%d prompts (%d bytes, %.1fs) loaded in %.3fs, %d problems' % \
+               (len(self.loaded), self.size, self.duration(), self.elapsed,
+                len(self.problems))
+
+def preload(filenames, cache = None, strict = False):
+    """Validate the prompts and pin the valid ones in cache.
+
+    @param filenames: The prompt files, e.g. from L{scan} or L{read_list}.
+    @param cache: The L{PromptCache <speech.PromptCache>}. The default
+    is the L{prompt_cache <speech.prompt_cache>} of the process.
+    @param strict: Raise a ValueError if any prompt is invalid.
+    @return: a L{PreloadReport}."""
+    if cache is None:
+        cache = prompt_cache
+
+    report = PreloadReport()
+    start = time.time()
+    seen = set()
+    for fn in filenames:
+        if fn in seen:
+            continue
+        seen.add(fn)
+
+        if os.path.splitext(fn)[1] not in filetypes:
+            report.problems.append((fn, 'unknown extension'))
+            continue
+
+        try:
+            prompt = cache.pin(fn)
+        except (IOError, OSError), e:
+            report.problems.append((fn, e.strerror or str(e)))
+            continue
+
+        problem = check(prompt)
+        if problem:
+            cache.discard(fn)
+            report.problems.append((fn, problem))
+            continue
+
+        # the report must not claim prompts that are read from disk
+        if fn not in cache.prompts:
+            report.problems.append((fn, 'not cached'))
+            continue
+
+        log.debug('prompt %s: %d bytes, %.2fs', fn, prompt.length,
+                  prompt.duration())
+        report.loaded.append(prompt)
+        report.size += prompt.length
+
+    report.elapsed = time.time() - start
+
+    for fn, problem in report.problems:
+        log.error('prompt %s: %s', fn, problem)
+    log.info('%s', report)
+
+    if strict and report.problems:
+        raise ValueError('invalid prompts: %s' %
+                         ', '.join(['%s (%s)' % p for p in report.problems]))
+
+    return report
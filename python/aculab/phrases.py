@@ -0,0 +1,337 @@
+# Copyright (C) 2009 Lars Immisch
+
+"""Spoken numbers, digits, dates and amounts from indexed segments.
+
+A phrase book is one concatenated prompt file per language (the I{blob})
+plus an I{index} with the name, offset and length of each segment in the
+blob. A L{PhraseBook <speech.PhraseBook>} maps the blob and plays a list
+of segment names as a single replay with a L{PhraseJob <speech.PhraseJob>}.
+
+The languages in this module translate numbers, digit strings, dates and
+amounts to segment names. The segment names are the same for all
+languages:
+
+ - C{0} to C{19}, C{20}, C{30} ... C{90}: cardinal numbers
+ - C{hundred}, C{thousand}, C{million}, C{millions}, C{billion},
+   C{billions}: the scales (English only uses the singular)
+ - C{minus}, C{and}: C{and} is used between units and subunits of amounts
+ - C{plus}, C{star}, C{hash}: for digit strings
+ - C{month1} to C{month12}: the names of the months
+ - C{ord1} to C{ord31}: the ordinal numbers for the days of the month
+ - C{oh}: the zero in years like 1905 (English)
+ - C{one}, C{a}: the German I{ein} and I{eine} in compounds
+
+The segment names of a language are in L{Language.names}. Build a blob and
+its index from one prompt file per segment with L{build}::
+
+    build(glob.glob('prompts/en/*.al'), 'en.al')
+    english = PhraseBook('en.al', English())
+    english.say_number(channel, 1234)
+"""
+
+import os
+import logging
+from decimal import Decimal, ROUND_HALF_UP
+
+log = logging.getLogger('phrases')
+
+def index_name(filename):
+    """Return the default index filename for a blob."""
+    return os.path.splitext(filename)[0] + '.idx'
+
+def read_index(filename):
+    """Read an index.
+
+    An index has one line per segment with the name, the offset and the
+    length in bytes, separated by whitespace. Empty lines and lines
+    starting with C{#} are ignored.
+
+    @return: a dictionary name: (offset, length)."""
+    index = {}
+    for i, line in enumerate(file(filename)):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        try:
+            name, offset, length = line.split()
+            index[name] = (int(offset), int(length))
+        except ValueError:
+            raise ValueError('%s:%d: invalid index entry' % (filename, i + 1))
+
+    return index
+
+def build(filenames, blob, index = None):
+    """Concatenate prompt files into a blob and write its index.
+
+    The segment name is the filename without directory and extension.
+
+    @param filenames: The prompt files, one per segment.
+    @param blob: The name of the blob.
+    @param index: The name of the index. The default is the blob name with
+    the extension C{.idx}.
+    @return: a dictionary name: (offset, length)."""
+    if index is None:
+        index = index_name(blob)
+
+    segments = {}
+    offset = 0
+    out = file(blob, 'wb')
+    try:
+        for fn in filenames:
+            name = os.path.splitext(os.path.basename(fn))[0]
+            if name in segments:
+                raise ValueError('duplicate segment %s in %s' % (name, fn))
+            data = file(fn, 'rb').read()
+            out.write(data)
+            segments[name] = (offset, len(data))
+            offset += len(data)
+    finally:
+        out.close()
+
+    out = file(index, 'w')
+    try:
+        out.write('# name offset length\n')
+        for name, (offset, length) in sorted(segments.items(),
+                                             key = lambda s: s[1]):
+            out.write('%s %d %d\n' % (name, offset, length))
+    finally:
+        out.close()
+
+    log.info('built %s: %d segments, %d bytes', blob, len(segments), offset)
+
+    return segments
+
+class Language(object):
+    """The rules shared by all languages.
+
+    A language is a subclass with a method C{number(n)} that returns the
+    segment names for the integer n, see L{English.number}. All methods
+    return lists of segment names."""
+
+    # the largest number that can be spoken
+    limit = 10 ** 12 - 1
+
+    names = [str(i) for i in range(20)] \
+            + [str(i) for i in range(20, 100, 10)] \
+            + ['minus', 'and', 'plus', 'star', 'hash'] \
+            + ['month%d' % i for i in range(1, 13)] \
+            + ['ord%d' % i for i in range(1, 32)]
+
+    digit_names = { '+': 'plus', '*': 'star', '#': 'hash' }
+    # separators in digit strings that are not spoken
+    separators = ' -/().'
+
+    def check(self, n):
+        """Raise a ValueError if n is too large. Used internally."""
+        if abs(n) > self.limit:
+            raise ValueError('%d is too large to be spoken' % n)
+
+    def count(self, n):
+        """Return the segment names for n things, like C{1} in I{1 euro}.
+        The default is L{number}."""
+        return self.number(n)
+
+    def digits(self, digits):
+        """Return the segment names for the digits of a telephone number,
+        account number or similar, one by one.
+
+        C{+}, C{*} and C{#} are spoken; spaces, dashes, slashes, dots and
+        parentheses are ignored."""
+        names = []
+        for d in digits:
+            if d.isdigit():
+                names.append(d)
+            elif d in self.digit_names:
+                names.append(self.digit_names[d])
+            elif d not in self.separators:
+                raise ValueError('cannot speak %r in %r' % (d, digits))
+
+        return names
+
+    def year(self, year):
+        """Return the segment names for a year."""
+        return self.number(year)
+
+    def date(self, date, year = True):
+        """Return the segment names for a date.
+
+        @param date: A C{datetime.date} or C{datetime.datetime}.
+        @param year: Include the year."""
+        names = ['month%d' % date.month, 'ord%d' % date.day]
+        if year:
+            names += self.year(date.year)
+
+        return names
+
+    def amount(self, amount, unit = ('euro', 'euros'),
+               subunit = ('cent', 'cents')):
+        """Return the segment names for an amount of money.
+
+        @param amount: The amount as an integer, a float or a Decimal. It
+        is rounded half up to two decimal places, so 0.125 is 0.13.
+        @param unit: The segment names of the unit, as a string or as a
+        tuple (singular, plural).
+        @param subunit: The segment names of the subunit, like L{unit}."""
+        cents = int((Decimal(str(amount)) * 100).quantize(Decimal(1),
+                                                          ROUND_HALF_UP))
+        units, cents = divmod(abs(cents), 100)
+
+        names = []
+        if amount < 0 and (units or cents):
+            names.append('minus')
+        if units or not cents:
+            names += self.count(units) + [self.plural(unit, units)]
+        if units and cents:
+            names.append('and')
+        if cents:
+            names += self.count(cents) + [self.plural(subunit, cents)]
+
+        return names
+
+    def plural(self, unit, n):
+        """Return the segment name of unit for n. Used internally."""
+        if type(unit) == type(''):
+            return unit
+        if n == 1:
+            return unit[0]
+        return unit[1]
+
+class English(Language):
+    """Numbers, dates and amounts in English, like I{one thousand two
+    hundred thirty four} or I{March 3rd nineteen oh five}."""
+
+    names = Language.names + ['hundred', 'thousand', 'million', 'billion',
+                              'oh']
+
+    scales = [(10 ** 9, 'billion'), (10 ** 6, 'million'),
+              (1000, 'thousand')]
+
+    def below_thousand(self, n):
+        """Return the segment names for 0 < n < 1000. Used internally."""
+        names = []
+        if n >= 100:
+            names += [str(n // 100), 'hundred']
+            n %= 100
+        if n >= 20:
+            names.append(str(n // 10 * 10))
+            n %= 10
+        if n:
+            names.append(str(n))
+
+        return names
+
+    def number(self, n):
+        """Return the segment names for the integer n."""
+        self.check(n)
+        if n < 0:
+            return ['minus'] + self.number(-n)
+        if n == 0:
+            return ['0']
+
+        names = []
+        for scale, name in self.scales:
+            if n >= scale:
+                names += self.below_thousand(n // scale) + [name]
+                n %= scale
+        if n:
+            names += self.below_thousand(n)
+
+        return names
+
+    def year(self, year):
+        """Return the segment names for a year: in pairs of digits before
+        2000, like I{nineteen ninety nine}."""
+        if 1100 <= year < 2000:
+            high, low = divmod(year, 100)
+            if not low:
+                return self.number(high) + ['hundred']
+            if low < 10:
+                return self.number(high) + ['oh', str(low)]
+            return self.number(high) + self.number(low)
+
+        return self.number(year)
+
+class German(Language):
+    """Numbers, dates and amounts in German, like I{eintausend
+    zweihundertvierunddreissig} or I{dritter Maerz zweitausendneun}.
+
+    The segment C{1} is I{eins}, C{one} is I{ein} in compounds and before
+    units, C{a} is I{eine} before I{Million} and I{Milliarde}."""
+
+    names = Language.names + ['one', 'a', 'hundred', 'thousand', 'million',
+                              'millions', 'billion', 'billions']
+
+    scales = [(10 ** 9, 'billion', 'billions'),
+              (10 ** 6, 'million', 'millions')]
+
+    def below_thousand(self, n, final = True):
+        """Return the segment names for 0 < n < 1000.
+
+        @param final: n is the end of the number, so a trailing 1 is
+        I{eins}. Used internally."""
+        names = []
+        if n >= 100:
+            h = n // 100
+            names += [h == 1 and 'one' or str(h), 'hundred']
+            n %= 100
+        if n >= 20 and n % 10:
+            # einundzwanzig
+            names += [n % 10 == 1 and 'one' or str(n % 10), 'and',
+                      str(n // 10 * 10)]
+        elif n == 1 and not final:
+            names.append('one')
+        elif n:
+            names.append(str(n))
+
+        return names
+
+    def number(self, n):
+        """Return the segment names for the integer n."""
+        self.check(n)
+        if n < 0:
+            return ['minus'] + self.number(-n)
+        if n == 0:
+            return ['0']
+
+        names = []
+        for scale, singular, plural in self.scales:
+            if n >= scale:
+                m = n // scale
+                if m == 1:
+                    names += ['a', singular]
+                else:
+                    names += self.below_thousand(m) + [plural]
+                n %= scale
+        if n >= 1000:
+            names += self.below_thousand(n // 1000, False) + ['thousand']
+            n %= 1000
+        if n:
+            names += self.below_thousand(n)
+
+        return names
+
+    def count(self, n):
+        """Return the segment names for n things: I{ein Euro}."""
+        if n == 1:
+            return ['one']
+        return self.number(n)
+
+    def year(self, year):
+        """Return the segment names for a year: in hundreds before 2000,
+        like I{neunzehnhundertneunundneunzig}."""
+        if 1100 <= year < 2000:
+            high, low = divmod(year, 100)
+            names = self.number(high) + ['hundred']
+            if low:
+                names += self.number(low)
+            return names
+
+        return self.number(year)
+
+    def date(self, date, year = True):
+        """Return the segment names for a date, day first."""
+        names = ['ord%d' % date.day, 'month%d' % date.month]
+        if year:
+            names += self.year(date.year)
+
+        return names
@@ -7,21 +7,31 @@ from __future__ import with_statement
 import threading
 import select
 import os
+import time
+import errno
 import logging
+from collections import deque
 # local imports
-from util import create_pipe
-from timer import TimerBase
+from util import create_pipe, PRIORITY_CONTROL, PRIORITY_MEDIA, \
+     PRIORITY_BACKGROUND
+from timer import TimerBase, TimerWheel, Periodic, monotonic
+from instrument import ReactorStats, callback_name
+from executor import run_in_executor
 
 log = logging.getLogger('reactor')
 
-def add_event(reactor, event, method):
+def add_event(reactor, event, method, edge = False,
+              priority = PRIORITY_MEDIA):
     """Add an event to a reactor.
 	
     @param reactor: The reactor to add the event to
     @param event: A C{tSMEventId} structure
+    @param edge: The method drains the event completely, so edge triggered
+    notification may be used. See L{EpollReactor}.
+    @param priority: The priority class, see L{PollReactor.add}.
     @return: a OS dependent value that can ve used for reactor.remove()
     """       
-    reactor.add(event.fd, event.mode, method)
+    reactor.add(event.fd, event.mode, method, edge, priority)
     return event.fd
 
 def remove_event(reactor, event):
@@ -52,15 +62,55 @@ class PollReactor(threading.Thread):
     """Prosody Event reactor for Unix systems with poll(), most notably
     Linux.
 
-    Experimental support for notifications."""
+    Experimental support for notifications.
 
-    def __init__(self):
-        """Create a reactor."""
+    Events are dispatched in the order of their priority class, see
+    L{add}."""
+
+    # The maximum number of background callbacks per batch of events if
+    # the batch also contains control or media events. Deferred background
+    # events are dispatched first in the next batch, so they are delayed,
+    # but never starved
+    background_budget = 32
+
+    def __init__(self, timer_wheel = False, instrument = False):
+        """Create a reactor.
+
+        @param timer_wheel: Use a L{TimerWheel} instead of a L{TimerBase}
+        for the timers. This is cheaper for many thousands of coarse
+        timers, but timers fire with a granularity of 10 ms.
+        @param instrument: Collect statistics, see L{stats}."""
         threading.Thread.__init__(self)
+        self.statistics = None
+        if instrument:
+            self.statistics = ReactorStats()
+        # see watchdog.Watchdog
+        self.watchdog = None
         self.handles = {}
+        # map fd to the priority class for fds that are not media
+        self.priorities = {}
+        # background events deferred to the next batch
+        self.deferred = []
+        # the number of events returned by the last poll
+        self.batch = 0
         self.mutex = threading.Lock()
         self.queue = []
-        self.timer = TimerBase()
+        # handles removed by foreign threads, but not yet unregistered.
+        # Their events are not dispatched
+        self.removed = set()
+        # True if a byte is in the pipe that the reactor has not yet
+        # consumed. Protected by the mutex
+        self.wakeup_pending = False
+        # functions queued with call_soon. Protected by the mutex
+        self.calls = deque()
+        # functions queued by signal handlers, without the mutex
+        self.signalled = deque()
+        # the thread running the reactor loop, if any
+        self.thread = None
+        if timer_wheel:
+            self.timer = TimerWheel()
+        else:
+            self.timer = TimerBase()
 
         # create a pipe to add/remove fds
         self.pipe = create_pipe()
@@ -70,18 +120,21 @@ class PollReactor(threading.Thread):
         # listen to the read fd of our pipe
         self.poll.register(self.pipe[0], select.POLLIN)
 
-    def add_timer(self, interval, function, args = [], kwargs={}):
-        '''Add a timer after interval in seconds.'''
+    def add_timer(self, interval, function, args = [], kwargs={}, slack = 0):
+        '''Add a timer after interval in seconds.
 
-        with self.mutex:
-            t, adjust = self.timer.add(interval, function, args, kwargs)
+        @param slack: The timer may be delayed by up to slack seconds, so
+        that it expires in the same wakeup as other timers.'''
 
-        # if the new timer is the next, wake up the timer thread to readjust
-        # the wait period
+        with self.mutex:
+            t, adjust = self.timer.add(interval, function, args, kwargs,
+                                       slack)
+            # if the new timer is the next, wake up the timer thread to
+            # readjust the wait period
+            wakeup = adjust and self.need_wakeup()
 
-        if adjust and threading.currentThread() != self and self.isAlive():
-            # function 2 is timer adjust
-            self.pipe[1].write('2')
+        if wakeup:
+            self.pipe[1].write('1')
 
         return t
 
@@ -90,65 +143,287 @@ class PollReactor(threading.Thread):
         Cancelling an expired timer raises a ValueError'''
         with self.mutex:
             adjust = self.timer.cancel(timer)
-        
-        if adjust and threading.currentThread() != self and self.isAlive():
-            # function 2 is timer adjust
-            self.pipe[1].write('2')
+            wakeup = adjust and self.need_wakeup()
+
+        if wakeup:
+            self.pipe[1].write('1')
+
+    def add_periodic(self, interval, function, args = [], kwargs = {},
+                     policy = 'skip'):
+        """Call function every interval seconds, until the returned
+        L{Periodic <timer.Periodic>} is cancelled.
+
+        @param policy: What to do when the reactor falls behind by one or
+        more intervals: C{'skip'}, C{'burst'} or C{'coalesce'}. See
+        L{Periodic <timer.Periodic>}."""
+
+        p = Periodic(self, interval, function, args, kwargs, policy)
+        p.schedule()
+
+        return p
+
+    def instrument(self, enable = True):
+        """Enable or disable the collection of statistics.
+
+        Enabling the statistics clears them."""
+        if enable:
+            self.statistics = ReactorStats()
+        else:
+            self.statistics = None
+
+    def stats(self):
+        """Return a snapshot of the statistics as a dictionary, or None if
+        the reactor is not instrumented.
+
+        See L{ReactorStats <instrument.ReactorStats>} for the contents.
+        All times are in microseconds. C{timer_wakeups} contains the
+        counters of L{TimerBase.stats <timer.TimerBase.stats>}."""
+        statistics = self.statistics
+        if statistics is None:
+            return None
+
+        snapshot = statistics.snapshot()
+        with self.mutex:
+            snapshot['timer_wakeups'] = self.timer.stats()
+
+        return snapshot
+
+    def backlog(self):
+        """Return the number of callbacks waiting for the reactor: the
+        events of the last poll, deferred background events and queued
+        calls and updates.
+
+        This is an estimate for L{admission control <admission>} and may be
+        called from any thread."""
+        return self.batch + len(self.deferred) + len(self.calls) + \
+               len(self.queue)
 
-    def add(self, handle, mode, method):
+    def call_soon(self, function, *args):
+        """Call function from the reactor loop as soon as possible.
+
+        This is safe to call from any thread. All functions queued before
+        the reactor wakes up are called in one batch, in order."""
+
+        with self.mutex:
+            self.calls.append((function, args))
+            wakeup = self.need_wakeup()
+
+        if wakeup:
+            self.pipe[1].write('1')
+
+    def call_from_signal(self, function, *args):
+        """Call function from the reactor loop as soon as possible.
+
+        This is safe to call from a signal handler: signal handlers run in
+        the main thread, which may be the reactor thread holding the mutex,
+        so this neither takes the mutex nor calls function directly."""
+
+        # deque.append is atomic
+        self.signalled.append((function, args))
+        self.pipe[1].write('1')
+
+    def call_from_thread(self, function, *args):
+        """Call function in the reactor thread.
+
+        Worker threads use this to hand results back to calls and channels.
+        From the reactor thread itself, function is called immediately."""
+
+        if self.is_foreign():
+            self.call_soon(function, *args)
+        else:
+            function(*args)
+
+    def run_in_executor(self, function, *args, **kwargs):
+        """Call function(*args) in a worker thread, without blocking the
+        reactor.
+
+        @param callback: Keyword argument. Called in the reactor thread as
+        C{callback(result, exception)} when function has returned.
+        @param executor: Keyword argument. The L{WorkerPool
+        <executor.WorkerPool>}. The default is the pool shared by all
+        reactors."""
+        run_in_executor(self, function, args, kwargs)
+
+    def is_foreign(self):
+        """Return True if the reactor loop is running in another thread."""
+        thread = self.thread
+        return thread is not None and thread != threading.currentThread()
+
+    def need_wakeup(self):
+        """Return True if the reactor thread must be woken up.
+
+        Only one wakeup is pending at a time: the reactor applies all
+        queued operations when it wakes up. Must be called with the
+        mutex held."""
+        if not self.is_foreign():
+            return False
+
+        if self.wakeup_pending:
+            return False
+
+        self.wakeup_pending = True
+        return True
+
+    def add(self, handle, mode, method, edge = False,
+            priority = PRIORITY_MEDIA):
         """Add an event to the reactor.
 
         @param handle: A file descriptor, B{not} a File object.
         @param mode: A bitmask of select.POLLOUT, select.POLLIN, etc.
-        @param method: This will be called when the event is fired."""
+        @param method: This will be called when the event is fired.
+        @param edge: Ignored - poll is always level triggered. See
+        L{EpollReactor}.
+        @param priority: The priority class: C{PRIORITY_CONTROL} (call
+        control), C{PRIORITY_MEDIA} (the default) or C{PRIORITY_BACKGROUND}.
+        Within a batch of events from poll, control events are dispatched
+        first and background events last (see L{background_budget})."""
 
         if not callable(method):
             raise ValueError('method must be callable')
 
-        if threading.currentThread() == self or not self.isAlive():
+        if priority not in (PRIORITY_CONTROL, PRIORITY_MEDIA,
+                            PRIORITY_BACKGROUND):
+            raise ValueError('invalid priority %s' % priority)
+
+        if not self.is_foreign():
             # log.debug('self adding fd: %d %s', handle, method.__name__)
-            self.handles[handle] = method
-            self.poll.register(handle, mode)
+            self.register(handle, mode, method, priority)
         else:
             # log.debug('adding fd: %d %s', handle, method.__name__)
             with self.mutex:
-                self.handles[handle] = method
                 # function 1 is add
-                self.queue.append((1, handle, mode))
+                self.queue.append((1, handle, mode, method, priority))
+                wakeup = self.need_wakeup()
 
-            self.pipe[1].write('1')
+            if wakeup:
+                self.pipe[1].write('1')
 
     def remove(self, handle):
         """Remove a handle from the reactor.
 
         @param handle: A file descriptor.
 
-        This method blocks until handle is removed by the reactor thread.
+        When called from a foreign thread, the handle is unregistered by
+        the reactor thread before it dispatches the next batch of events.
+        The method of the handle is not called after remove has returned,
+        even for events in the batch that the reactor is dispatching.
         """
 
-        if threading.currentThread() == self or not self.isAlive():
+        if not self.is_foreign():
             # log.debug('self removing fd: %d', handle)
-            del self.handles[handle]
-            self.poll.unregister(handle)
+            self.unregister(handle)
         else:
             # log.debug('removing fd: %d', handle)
             with self.mutex:
-                del self.handles[handle]
                 # function 0 is remove
-                self.queue.append((0, handle, None))
+                self.queue.append((0, handle, None, None, None))
+                self.removed.add(handle)
+                wakeup = self.need_wakeup()
+
+            if wakeup:
+                self.pipe[1].write('1')
+
+    def register(self, handle, mode, method, priority = PRIORITY_MEDIA):
+        """Register handle in the reactor thread. Used internally.
 
-            self.pipe[1].write('0')
+        The handle table is owned by the reactor thread (or the creating
+        thread before the reactor is started), so it needs no lock."""
+        self.handles[handle] = method
+        if priority == PRIORITY_MEDIA:
+            self.priorities.pop(handle, None)
+        else:
+            self.priorities[handle] = priority
+        self.poll.register(handle, mode)
+
+    def unregister(self, handle):
+        """Unregister handle in the reactor thread. Used internally."""
+        self.removed.discard(handle)
+        del self.handles[handle]
+        self.priorities.pop(handle, None)
+        self.poll.unregister(handle)
+
+    def prioritize(self, active, pipe):
+        """Sort a batch of events by priority class. Used internally.
+
+        Background events beyond the L{background_budget} are deferred to
+        the next batch.
+
+        @return: The events to dispatch now."""
+        priorities = self.priorities
+        control = []
+        media = []
+        background = []
+        # deferred events first
+        seen = {}
+        for e in self.deferred:
+            background.append(e)
+            seen[e[0]] = True
+
+        for e in active:
+            a = e[0]
+            if a == pipe:
+                continue
+            p = priorities.get(a, PRIORITY_MEDIA)
+            if p == PRIORITY_MEDIA:
+                media.append(e)
+            elif p == PRIORITY_CONTROL:
+                control.append(e)
+            elif not seen.has_key(a):
+                background.append(e)
+
+        if (control or media) and len(background) > self.background_budget:
+            self.deferred = background[self.background_budget:]
+            background = background[:self.background_budget]
+        else:
+            self.deferred = []
+
+        return control + media + background
 
     def update(self):
-        """Update our list of fds."""
-        
+        """Consume the wakeup and apply all queued adds and removes."""
+
+        self.pipe[0].read(1)
+
+        with self.mutex:
+            queue = self.queue
+            self.queue = []
+            self.wakeup_pending = False
+
+        for add, fd, mask, method, priority in queue:
+            try:
+                if add:
+                    self.register(fd, mask, method, priority)
+                else:
+                    self.unregister(fd)
+            except (KeyError, IOError, OSError):
+                log.error('error updating fd %d in PollReactor', fd,
+                          exc_info=1)
+
+    def run_calls(self):
+        """Call the functions queued with L{call_soon}.
+
+        @return: True if more functions were queued in the meantime.
+        """
         with self.mutex:
-            add, fd, mask = self.queue.pop(0)
+            calls = self.calls
+            self.calls = deque()
 
-        if add:
-            self.poll.register(fd, mask)
+        signalled = self.signalled
+        while signalled:
+            calls.append(signalled.popleft())
+
+        statistics = self.statistics
+        if statistics is None and self.watchdog is None:
+            for function, args in calls:
+                function(*args)
         else:
-            self.poll.unregister(fd)
+            for function, args in calls:
+                record = None
+                if statistics is not None:
+                    record = statistics.call
+                self.monitor(function, args, record)
+
+        return len(self.calls) > 0 or len(self.signalled) > 0
 
     def run_timers(self):
         """Run the pending timers.
@@ -157,38 +432,130 @@ class PollReactor(threading.Thread):
         """
         with self.mutex:
             timers = self.timer.get_pending()
-            wait = self.timer.time_to_wait()
 
-        for t in timers:
-            t()
-
-        return wait
+        statistics = self.statistics
+        if statistics is None and self.watchdog is None:
+            for t in timers:
+                t()
+        else:
+            for t in timers:
+                record = None
+                if statistics is not None:
+                    statistics.late(monotonic() - t.absolute)
+                    record = statistics.timer
+                self.monitor(t, (), record)
+
+        # the timers may have added timers
+        with self.mutex:
+            return self.timer.time_to_wait()
+
+    def monitor(self, function, args, record):
+        """Call function under the watchdog and pass the execution time
+        in seconds to record (if not None). Used internally."""
+        watchdog = self.watchdog
+        if watchdog is not None:
+            watchdog.enter(function)
+        start = time.time()
+        try:
+            function(*args)
+        finally:
+            if watchdog is not None:
+                watchdog.leave()
+            if record is not None:
+                record(time.time() - start)
+
+    def dispatch_monitored(self, statistics, active, pipe):
+        """Dispatch events with statistics or a watchdog. Used internally."""
+        handles = self.handles
+        removed = self.removed
+        for a, mask in active:
+            if a != pipe:
+                m = handles.get(a, None)
+                if m and a not in removed:
+                    record = None
+                    if statistics is not None:
+                        statistics.events += 1
+                        name = callback_name(m)
+                        record = lambda elapsed: \
+                                 statistics.callback(name, elapsed)
+                    self.monitor(m, (), record)
+
+    def start(self):
+        """Start the reactor in a new thread."""
+        # from now on, other threads must queue their requests
+        self.thread = self
+        threading.Thread.start(self)
 
     def run(self):
         'Run the reactor.'
 
-        wait = self.timer.time_to_wait()
-        
+        self.thread = threading.currentThread()
+        try:
+            self.loop()
+        finally:
+            self.thread = None
+
+    def loop(self):
+        """The reactor loop. Used internally."""
+
+        # functions may have been queued before the loop was started
+        if self.calls or self.signalled:
+            wait = 0
+        else:
+            wait = self.timer.time_to_wait()
+        pipe = self.pipe[0].fileno()
+        # only the reactor thread modifies the handle table now
+        handles = self.handles
+        removed = self.removed
+
         while True:
             try:
                 # log.debug('poll(%s)', wait)
-                active = self.poll.poll(wait)
-                for a, mask in active:
-                    if a == self.pipe[0].fileno():
-                        self.pipe[0].read(1)
-                        wait = self.update()
+                statistics = self.statistics
+                try:
+                    if statistics is None:
+                        active = self.poll.poll(wait)
                     else:
-                        with self.mutex:
-                            m = self.handles.get(a, None)
+                        start = time.time()
+                        active = self.poll.poll(wait)
+                        statistics.poll_wait.add((time.time() - start) * 1e6)
+                except (select.error, IOError), e:
+                    # a signal handler has run, see drain.drain_on_signal
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    active = []
+                self.batch = len(active)
+
+                # apply queued adds and removes first, so that a handle
+                # removed by a foreign thread before poll returned is not
+                # dispatched
+                for a, mask in active:
+                    if a == pipe:
+                        self.update()
+                        break
+
+                if self.priorities or self.deferred:
+                    active = self.prioritize(active, pipe)
+
+                if statistics is None and self.watchdog is None:
+                    for a, mask in active:
+                        if a != pipe:
+                            m = handles.get(a, None)
 
-                        # log.info('event on fd %d %s: %s', a,
-                        #         maskstr(mask), m.__name__)
+                            # log.info('event on fd %d %s: %s', a,
+                            #         maskstr(mask), m.__name__)
 
-                        # ignore missing method, it must have been removed
-                        if m:
-                            m()
-                            
+                            # ignore missing method, it must have been
+                            # removed
+                            if m and a not in removed:
+                                m()
+                else:
+                    self.dispatch_monitored(statistics, active, pipe)
+
+                more = self.run_calls()
                 wait = self.run_timers()
+                if more or self.deferred:
+                    wait = 0
 
             except StopIteration:
                 return
@@ -197,3 +564,83 @@ class PollReactor(threading.Thread):
             except:
                 log.error('error in PollReactor main loop', exc_info=1)
                 raise
+
+class Epoll(object):
+    """Wrap C{select.epoll} in the interface of C{select.poll}.
+
+    The poll and epoll event masks are identical on Linux, so
+    no translation is needed."""
+
+    def __init__(self):
+        self.epoll = select.epoll()
+
+    def register(self, fd, mask):
+        """Register fd or change its mask, like C{select.poll.register}."""
+        try:
+            self.epoll.register(fd, mask)
+        except (IOError, OSError), e:
+            if e.errno != errno.EEXIST:
+                raise
+            self.epoll.modify(fd, mask)
+
+    def unregister(self, fd):
+        """Unregister fd.
+
+        The kernel removes a closed fd from the epoll set, so an fd that
+        was closed (or closed and reused) before it was unregistered is
+        ignored, like C{select.poll.unregister} does."""
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, OSError), e:
+            if e.errno not in (errno.EBADF, errno.ENOENT):
+                raise
+
+    def poll(self, timeout = -1):
+        """Poll with a timeout in ms, like C{select.poll.poll}."""
+        if timeout is None or timeout < 0:
+            return self.epoll.poll(-1)
+
+        return self.epoll.poll(timeout / 1000.0)
+
+class EpollReactor(PollReactor):
+    """Prosody Event reactor for Linux, using epoll.
+
+    The cost of poll() grows with the number of registered file
+    descriptors, and every SpeechChannel has three of them. The cost of
+    epoll only grows with the number of active file descriptors.
+
+    Edge triggered notification can be enabled for events whose
+    callbacks drain the event completely (they are registered with
+    C{edge=True}). This saves a system call per event."""
+
+    def __init__(self, timer_wheel = False, edge_triggered = False,
+                 instrument = False):
+        """Create an epoll reactor.
+
+        @param timer_wheel: See L{PollReactor}.
+        @param edge_triggered: Use edge triggered notification for
+        events that are added with C{edge=True}.
+        @param instrument: See L{PollReactor}."""
+        PollReactor.__init__(self, timer_wheel, instrument)
+        self.edge_triggered = edge_triggered
+        self.poll = Epoll()
+
+        # listen to the read fd of our pipe
+        self.poll.register(self.pipe[0], select.POLLIN)
+
+    def add(self, handle, mode, method, edge = False,
+            priority = PRIORITY_MEDIA):
+        """Add an event to the reactor.
+
+        @param handle: A file descriptor, B{not} a File object.
+        @param mode: A bitmask of select.POLLOUT, select.POLLIN, etc.
+        @param method: This will be called when the event is fired.
+        @param edge: If True and the reactor was created with
+        C{edge_triggered}, the event is edge triggered. C{method} must
+        then drain the event completely.
+        @param priority: See L{PollReactor.add}."""
+
+        if edge and self.edge_triggered:
+            mode = mode | select.EPOLLET
+
+        PollReactor.add(self, handle, mode, method, priority = priority)
@@ -36,17 +36,24 @@ from __future__ import with_statement
 import threading
 import select
 import os
+import errno
 import logging
 import atexit
+from collections import deque
 # local imports
 import lowlevel
-from util import curry, create_pipe
+from util import curry, create_pipe, PRIORITY_CONTROL, PRIORITY_MEDIA, \
+     PRIORITY_BACKGROUND
 from names import event_name
 from error import AculabError
 
 log = logging.getLogger('reactor')
 log_call = logging.getLogger('call')
 
+# Returned by an event handler on a Call object to consume the event, see
+# call_dispatch
+HANDLED = object()
+
 if os.name == 'nt':
     import win32reactor
     import win32event
@@ -63,7 +70,162 @@ else:
     add_event = posixreactor.add_event
     remove_event = posixreactor.remove_event
 
-    Reactor = posixreactor.PollReactor()
+    # ACULAB_REACTOR selects the reactor implementation: 'poll', 'epoll',
+    # 'epoll-et' (epoll with edge triggered driver events), 'asyncio'
+    # (the current asyncio event loop) or 'simulated' (a virtual clock for
+    # tests). The default is poll.
+    _reactor = os.environ.get('ACULAB_REACTOR', 'poll')
+
+    if _reactor == 'poll':
+        Reactor = posixreactor.PollReactor()
+    elif _reactor == 'epoll':
+        Reactor = posixreactor.EpollReactor()
+    elif _reactor == 'epoll-et':
+        Reactor = posixreactor.EpollReactor(edge_triggered = True)
+    elif _reactor == 'asyncio':
+        import asyncioreactor
+        Reactor = asyncioreactor.AsyncioReactor()
+    elif _reactor == 'simulated':
+        import simreactor
+        Reactor = simreactor.SimulatedReactor()
+    else:
+        raise ValueError('ACULAB_REACTOR must be poll, epoll, epoll-et, '
+                         'asyncio or simulated, not %s' % _reactor)
+
+class ReactorGroup(object):
+    """A group of reactors, each running in its own thread.
+
+    A single reactor dispatches all events in one thread. A ReactorGroup
+    spreads the load over several reactors (I{shards}), while keeping
+    the guarantee that all callbacks for a call are made from a single
+    thread: a call and all its media resources must use the same reactor.
+
+    Pass the reactor from L{assign} to the call, and create the media
+    resources with C{reactor=call.reactor} (L{speech.Glue} does this).
+
+    The first shard is the default L{Reactor}."""
+
+    def __init__(self, count, factory = None):
+        """Create a group of count reactors.
+
+        @param count: The number of reactors.
+        @param factory: Create additional reactors. The default is the
+        class of L{Reactor}."""
+
+        if count < 1:
+            raise ValueError('a ReactorGroup needs at least one reactor')
+        
+        if factory is None:
+            factory = Reactor.__class__
+
+        self.reactors = [Reactor] + [factory() for i in range(count - 1)]
+        self.mutex = threading.Lock()
+        self.next = 0
+
+    def __len__(self):
+        return len(self.reactors)
+
+    def __getitem__(self, shard):
+        return self.reactors[shard]
+
+    def assign(self):
+        """Return the reactor for a new call (round robin)."""
+        with self.mutex:
+            reactor = self.reactors[self.next]
+            self.next = (self.next + 1) % len(self.reactors)
+
+        return reactor
+
+    def shard(self, obj):
+        """Return the shard of an object with a reactor attribute
+        (a call, a SpeechChannel, a VMPrx, etc.)."""
+        return self.reactors.index(obj.reactor)
+
+    def call_in(self, shard, function, *args, **kwargs):
+        """Call function in the thread of a shard.
+
+        This is safe to call from any thread. The function is called
+        from the reactor loop of the shard as soon as possible.
+
+        @param shard: The index of the shard or a reactor of the group."""
+        if type(shard) == type(0):
+            reactor = self.reactors[shard]
+        else:
+            reactor = shard
+
+        reactor.call_soon(curry(function, *args, **kwargs))
+
+    def start(self):
+        """Start all reactors in their own threads."""
+        for r in self.reactors:
+            r.start()
+
+    def run(self):
+        """Start all but the first reactor in their own threads and run the
+        first reactor in the current thread."""
+        for r in self.reactors[1:]:
+            r.start()
+
+        self.reactors[0].run()
+
+class CallEventQueue(object):
+    """The handoff of call events from the L{CallEventThread} to one
+    reactor.
+
+    Events are queued as C{(handle, event)} records in a deque. Appending
+    and popping are atomic, so no lock is needed. The reactor is woken up
+    at most once per drain: the call event thread only writes to the pipe
+    if the reactor has not been signalled since it last started to drain
+    the queue."""
+
+    def __init__(self, reactor, on_event):
+        """Create the queue and register the pipe with reactor.
+
+        @param on_event: Called with the queue when the pipe is readable."""
+        self.events = deque()
+        # True if the reactor has been woken up and has not yet started
+        # to drain
+        self.signalled = False
+        self.wakeups = 0
+        if os.name == 'nt':
+            self.pipe = win32event.CreateEvent(None, 0, 0, None)
+            reactor.add(self.pipe, curry(on_event, self), PRIORITY_CONTROL)
+        else:
+            # Create a nonblocking pipe (if drained completely on reading,
+            # this will behave like a Windows Event Semaphore)
+            self.pipe = create_pipe(True)
+            reactor.add(self.pipe[0].fileno(), select.POLLIN,
+                        curry(on_event, self), priority = PRIORITY_CONTROL)
+
+    def push(self, handle, event):
+        """Queue an event and wake up the reactor if necessary."""
+        self.events.append((handle, event))
+        if not self.signalled:
+            self.signalled = True
+            self.wakeups += 1
+            if os.name == 'nt':
+                win32event.SetEvent(self.pipe)
+            else:
+                self.pipe[1].write('1')
+
+    def drain(self):
+        """Return the queued events. Called from the reactor."""
+        if os.name != 'nt':
+            # Drain the pipe. Reading from the empty pipe raises EAGAIN
+            try:
+                while len(self.pipe[0].read(256)) == 256:
+                    pass
+            except IOError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+
+        # clear the flag before popping, so that an event queued from now
+        # on writes to the pipe again
+        self.signalled = False
+
+        # only take what is there now, later events have their own wakeup
+        events = self.events
+        return [events.popleft() for i in xrange(len(events))]
 
 class CallEventThread(threading.Thread):
     """This is a helper thread class for call events on v5 drivers.
@@ -74,119 +236,105 @@ class CallEventThread(threading.Thread):
     the application design.
     
     We use this thread to get events for all call handles and send
-    them to the actual reactor through a pipe and a queue.
+    them to the actual reactor through a L{CallEventQueue}.
     """
 
     # We have a chicken and egg problem when we create call handles
     # - we get the call handle after the openin/openout, but this thread
     # may receive events before the call knows its handle.
-    # As a consequence, this thread has to queue events for any handle.
+    # As a consequence, this thread has to buffer events for unknown
+    # handles until the call is added.
     
-    # To avoid a silent memory leak, limit the queue size
-    max_chicken_events = 4
+    # To avoid a silent memory leak, limit the number of buffered events
+    # (for all unknown handles). Further events are dropped and logged
+    max_chicken_events = 256
 
-    def __init__(self):
+    def __init__(self, max_chicken_events = None):
+        """Create the call event thread.
+
+        @param max_chicken_events: The maximum number of events buffered
+        for unknown handles. The default is the class attribute."""
+        # map call handle to (call, CallEventQueue)
         self.calls = {}
-        self.pipes = {}
-        # map call handle to event queue
+        # map reactor to CallEventQueue
+        self.queues = {}
+        # map call handle to a list of events that arrived before the call
+        # was added. Protected by the mutex, like all changes to calls
         self.events = {}
+        self.chicken_events = 0
+        self.dropped = 0
+        if max_chicken_events is not None:
+            self.max_chicken_events = max_chicken_events
         self.mutex = threading.Lock()
         threading.Thread.__init__(self)
         self.exit = False
 
-    def create_pipe(self, reactor):
-        if os.name == 'nt':
-            pipe = win32event.CreateEvent(None, 0, 0, None)
-            self.pipes[reactor] = pipe
-            reactor.add(pipe, curry(self.on_event, pipe))
-        else:
-            # Create a nonblocking pipe (if drained completely on reading,
-            # this will behave like a Windows Event Semaphore)
-            pipe = create_pipe(True)
-            self.pipes[reactor] = pipe
-            reactor.add(pipe[0].fileno(), select.POLLIN,
-                        curry(self.on_event, pipe[0]))
-
     def shutdown(self):
         with self.mutex:
             self.exit = True
 
     def add(self, reactor, call):
         with self.mutex:
-            self.calls[call.handle] = (call, reactor)
-            # If the pipe doesn't exist, create and install it
-            pipe = self.pipes.get(reactor, None)
-            if pipe is None:
-                self.create_pipe(reactor)
-                
-            # Pop the internal event queue
-            events = self.events.get(call.handle, [])
-            if events:
-                del self.events[call.handle]
-
-        # log.debug('add: queue %s', events)
-
-        # Queue events to the proper reactor
-        for e in events:
-            self.enqueue(e)
-            
+            # If the queue doesn't exist, create and install it
+            queue = self.queues.get(reactor, None)
+            if queue is None:
+                queue = CallEventQueue(reactor, self.on_event)
+                self.queues[reactor] = queue
+
+            # Queue the early events first. The call is added last, so
+            # that enqueue takes the mutex until the early events are
+            # queued, and the order is kept
+            events = self.events.pop(call.handle, [])
+            self.chicken_events -= len(events)
+            for e in events:
+                queue.push(call.handle, e)
+
+            self.calls[call.handle] = (call, queue)
+
     def remove(self, reactor, call):
         # Todo: clean up pipes to the reactor
         with self.mutex:
             del self.calls[call.handle]
-            if self.events.has_key(call.handle):
-                del self.events[call.handle]
-
-    def on_event(self, pipe):
-        if os.name != 'nt':
-            # Drain the pipe
-            while True:
-                s = pipe.read(256)
-                # log.debug('on_event pipe %s read: %d', pipe, len(s))
-                if len(s) < 256:
-                    break
-
-        # Collect all events and translate call handle to call
-        with self.mutex:
-            todo = [ (self.calls[handle][0], events)
-                     for handle, events in self.events.iteritems() ]
-
-            self.events = {}
-
-        # Dispatch all events
-        for call, events in todo:
-            for e in events:
-                # log_call.debug('got event %s for 0x%x on %s',
-                #                event_name(event), event.handle, pipe)
+            events = self.events.pop(call.handle, [])
+            self.chicken_events -= len(events)
+
+    def on_event(self, queue):
+        """Dispatch the events of queue. Called from the reactor."""
+        calls = self.calls
+        for handle, e in queue.drain():
+            call, q = calls.get(handle, (None, None))
+            # ignore events for removed calls
+            if call:
+                # log_call.debug('got event %s for 0x%x',
+                #                event_name(e), handle)
                 call_dispatch(call, e)
 
     def enqueue(self, event):
         """Queue the event."""
 
         handle = event.handle
-        
-        with self.mutex:
-            # Queue the event
-            if self.events.has_key(handle):
-                events = self.events[handle]
-                if len(events) > self.max_chicken_events:
-                    raise RuntimeError("chicken queue overflow: 0x%x"
-                                       % handle)
-                events.append(event)
-            else:
-                self.events[handle] = [event]
 
-            call, reactor = self.calls.get(handle, (None, None))
-            # Get the pipe to the reactor
-            pipe = self.pipes.get(reactor, None)
+        # the fast path for known handles needs no lock
+        call, queue = self.calls.get(handle, (None, None))
+        if queue:
+            queue.push(handle, event)
+            return
 
-        if pipe:
-            # log_call.debug('%x sending %s', handle, event_name(event))
-            # Write a notification to the pipe
-            if os.name == 'nt':
-                win32event.SetEvent(pipe)
-            else:
-                pipe[1].write('1')
+        with self.mutex:
+            call, queue = self.calls.get(handle, (None, None))
+            if not queue:
+                # Buffer the event until the call is added
+                if self.chicken_events >= self.max_chicken_events:
+                    self.dropped += 1
+                    log_call.error('chicken queue overflow, dropped event '
+                                   '%s for 0x%x', event_name(event), handle)
+                    return
+                self.events.setdefault(handle, []).append(event)
+                self.chicken_events += 1
+                return
+
+        # the call was added in the meantime
+        queue.push(handle, event)
 
     def run(self):
         """Thread main - Process call events."""
@@ -230,6 +378,11 @@ def call_dispatch(call, event):
 
     The Call object can have a special _post method for each event that is
     called last.
+
+    If the method on the Call object returns L{HANDLED}, the event is
+    consumed and neither the controller nor the _post method are called
+    (this is used to reject calls, see L{admission}). Other return values
+    are ignored.
     """
 
     ev = event_name(event).lower()
@@ -258,8 +411,8 @@ def call_dispatch(call, event):
     for h, n, args in handlers:
         if args:
             h(*args)
-        else:
-            h()
+        elif h() is HANDLED and n == 'call':
+            return
 
 def call_on_event(call):
     event = lowlevel.STATE_XPARMS()
@@ -302,14 +455,15 @@ def add_call_event(reactor, call):
             call.event = pywintypes.HANDLE(chwo.wait_object)
 
             # Note the curry
-            reactor.add(call.event, curry(call_on_event, call))
+            reactor.add(call.event, curry(call_on_event, call),
+                        PRIORITY_CONTROL)
         else:
             # This is a bit nasty - we set an attribute on call
             call.event = chwo.wait_object.fileno()
 
             # Note the curry
             reactor.add(call.event, chwo.wait_object.mode(),
-                        curry(call_on_event, call))
+                        curry(call_on_event, call), True, PRIORITY_CONTROL)
 
 def remove_call_event(reactor, call):
     if lowlevel.cc_version < 6:
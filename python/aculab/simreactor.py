@@ -0,0 +1,243 @@
+# Copyright (C) 2009 Lars Immisch
+
+"""A reactor with a virtual clock, for simulations and tests.
+
+The L{SimulatedReactor} implements the reactor API, but no time passes
+while it runs: the clock jumps to the next timer or scripted event, so
+hours of call traffic with timeouts run in seconds and the results do not
+depend on the load of the machine.
+
+File descriptors are not polled. Events on them are delivered from a
+script with L{SimulatedReactor.inject}, and arbitrary functions (for
+example controller callbacks that simulate call events) can be scheduled
+with L{SimulatedReactor.call_at}::
+
+    reactor = SimulatedReactor()
+    for i in range(1000):
+        reactor.call_at(i * 60.0, controller.ev_incoming_call_det, call, None)
+    reactor.run()
+
+Set C{ACULAB_REACTOR=simulated} to use a SimulatedReactor as the default
+L{Reactor <reactor.Reactor>}. Controllers should use L{SimulatedReactor.time}
+instead of C{time.time} to measure durations in the simulation.
+"""
+
+import heapq
+import select
+import itertools
+import logging
+from collections import deque
+# local imports
+from timer import Timer, Periodic, align
+from util import PRIORITY_MEDIA
+
+log = logging.getLogger('reactor')
+
+# at the same time, fd events are dispatched before timers, like in the
+# PollReactor
+_EVENT = 0
+_TIMER = 1
+
+class SimulatedPeriodic(Periodic):
+    """A L{Periodic <timer.Periodic>} on the virtual clock."""
+
+    def now(self):
+        return self.reactor.now
+
+class SimulatedReactor(object):
+    """A reactor with a virtual clock.
+
+    Timers fire in order of their expiry, without delay: the clock is
+    advanced to the expiry time. Functions queued with L{call_soon} run
+    before the clock advances.
+
+    Exceptions in callbacks are not caught, so they stop the simulation.
+    Raising C{StopIteration} stops the reactor like the other reactors."""
+
+    def __init__(self, start = 0.0):
+        """Create a reactor.
+
+        @param start: The initial time of the virtual clock in seconds."""
+        self.now = start
+        self.start = start
+        # map handle to (mode, method)
+        self.handles = {}
+        # (time, kind, sequence, timer or (handle, mask))
+        self.schedule = []
+        self.sequence = itertools.count()
+        self.calls = deque()
+        # counters, see stats
+        self.events = 0
+        self.timers = 0
+        self.ignored = 0
+
+    def time(self):
+        """Return the time of the virtual clock in seconds."""
+        return self.now
+
+    def add_timer(self, interval, function, args = [], kwargs = {},
+                  slack = 0):
+        """Add a timer after interval seconds of virtual time.
+
+        @param slack: The timer may be delayed by up to slack seconds,
+        like in the other reactors."""
+        return self.arm(align(self.now + max(interval, 0), slack),
+                        function, args, kwargs)
+
+    def arm(self, absolute, function, args, kwargs):
+        """Add a timer at the absolute virtual time. Used internally."""
+        t = Timer(0, function, args, kwargs)
+        t.absolute = absolute
+        heapq.heappush(self.schedule, (absolute, _TIMER, t.sequence, t))
+
+        return t
+
+    def cancel_timer(self, timer):
+        '''Cancel a timer.
+        Cancelling an expired timer raises a ValueError'''
+        if not timer.pending:
+            raise ValueError('timer is not pending')
+
+        timer.pending = False
+
+    def add_periodic(self, interval, function, args = [], kwargs = {},
+                     policy = 'skip'):
+        """Call function every interval seconds of virtual time, until the
+        returned L{Periodic <timer.Periodic>} is cancelled."""
+        p = SimulatedPeriodic(self, interval, function, args, kwargs, policy)
+        p.schedule()
+
+        return p
+
+    def call_at(self, when, function, *args):
+        """Call function at the absolute virtual time when.
+
+        @return: The timer, which can be cancelled with L{cancel_timer}."""
+        return self.arm(max(when, self.now), function, args, {})
+
+    def call_soon(self, function, *args):
+        """Call function before the clock advances."""
+        self.calls.append((function, args))
+
+    def call_from_signal(self, function, *args):
+        """Call function before the clock advances, like L{call_soon}."""
+        self.calls.append((function, args))
+
+    def call_from_thread(self, function, *args):
+        """Call function from the reactor. There is only one thread in a
+        simulation, so this is the same as L{call_soon}."""
+        self.calls.append((function, args))
+
+    def run_in_executor(self, function, *args, **kwargs):
+        """Call function(*args) and queue the callback with L{call_soon}.
+
+        The function runs immediately, in virtual time zero, so that the
+        simulation stays deterministic. The executor is ignored."""
+        callback = kwargs.pop('callback', None)
+        kwargs.pop('executor', None)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments: %s' %
+                            ', '.join(kwargs.keys()))
+
+        result = None
+        exception = None
+        try:
+            result = function(*args)
+        except Exception, e:
+            exception = e
+
+        if callback is not None:
+            self.call_soon(callback, result, exception)
+
+    def add(self, handle, mode, method, edge = False,
+            priority = PRIORITY_MEDIA):
+        """Add an event to the reactor.
+
+        @param handle: A file descriptor. It is not polled, see L{inject}.
+        @param mode: A bitmask of select.POLLOUT, select.POLLIN, etc.
+        @param method: This will be called when an event is injected.
+        @param edge: Ignored.
+        @param priority: Ignored."""
+        if not callable(method):
+            raise ValueError('method must be callable')
+
+        self.handles[handle] = (mode, method)
+
+    def remove(self, handle):
+        """Remove a handle from the reactor."""
+        del self.handles[handle]
+
+    def inject(self, when, handle, mask = select.POLLIN):
+        """Script an event on handle at the absolute virtual time when.
+
+        The event is dispatched if a method is registered for handle with a
+        mode that matches mask at that time, and ignored otherwise."""
+        heapq.heappush(self.schedule, (when, _EVENT, self.sequence.next(),
+                                       (handle, mask)))
+
+    def backlog(self):
+        """Return the number of queued calls."""
+        return len(self.calls)
+
+    def stats(self):
+        """Return the virtual time elapsed and the number of dispatched
+        events, timers and ignored events."""
+        return { 'elapsed': self.now - self.start,
+                 'events': self.events,
+                 'timers': self.timers,
+                 'ignored': self.ignored }
+
+    def step(self):
+        """Run the queued calls and the next timer or event.
+
+        @return: False if nothing is left to do."""
+        calls = self.calls
+        while calls:
+            function, args = calls.popleft()
+            function(*args)
+
+        schedule = self.schedule
+        while schedule:
+            when, kind, sequence, item = heapq.heappop(schedule)
+            if kind == _TIMER:
+                if not item.pending:
+                    continue
+                self.now = max(self.now, when)
+                item.pending = False
+                self.timers += 1
+                item()
+            else:
+                self.now = max(self.now, when)
+                handle, mask = item
+                mode, method = self.handles.get(handle, (0, None))
+                if method and mode & mask:
+                    self.events += 1
+                    method()
+                else:
+                    self.ignored += 1
+            return True
+
+        return bool(calls)
+
+    def run(self, until = None):
+        """Run the simulation until a callback raises StopIteration, nothing
+        is left to do or the virtual time reaches until.
+
+        @param until: The absolute virtual time to stop at, or None."""
+        try:
+            while True:
+                if until is not None:
+                    # discard cancelled timers, they do not count
+                    schedule = self.schedule
+                    while schedule and schedule[0][1] == _TIMER \
+                              and not schedule[0][3].pending:
+                        heapq.heappop(schedule)
+                    if not self.calls and (not schedule or
+                                           schedule[0][0] > until):
+                        self.now = max(self.now, until)
+                        return
+
+                if not self.step():
+                    return
+        except StopIteration:
+            return
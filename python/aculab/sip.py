@@ -10,8 +10,9 @@ from switching import Connection, CTBusEndpoint, NetEndpoint, DefaultBus
 from error import AculabError
 from names import event_names
 from callcontrol import CallHandleBase
-from reactor import Reactor, add_call_event, remove_call_event
+from reactor import Reactor, add_call_event, remove_call_event, HANDLED
 from snapshot import Snapshot
+from drain import draining, call_started, call_ended
 
 log = logging.getLogger('sip')
 
@@ -26,9 +27,12 @@ class SIPHandle(CallHandleBase):
     def __init__(self, controller, user_data = None,
                  reactor = Reactor):
 
-        sip_port = Snapshot().sip.port_id
-        if sip_port is None:
+        # the SIP port is None if the partition of the process does not
+        # open it, see snapshot.Partition
+        sip = Snapshot().sip
+        if sip is None or sip.port_id is None:
             raise RuntimeError('no SIP service running')
+        sip_port = sip.port_id
 
         CallHandleBase.__init__(self, controller, user_data, sip_port,
                                 reactor)
@@ -43,7 +47,14 @@ class SIPHandle(CallHandleBase):
         
         See U{sip_openin
         <http://www.aculab.com/Support/v6_api/sip/\
-        sip_openin.htm>}."""
+        sip_openin.htm>}.
+
+        While the process is L{draining <drain>}, the handle is not opened."""
+
+        drain = draining()
+        if drain:
+            drain.retire(self)
+            return
         
         inparms = lowlevel.SIP_IN_PARMS()
         inparms.net = self.port
@@ -70,7 +81,26 @@ class SIPHandle(CallHandleBase):
         
         See U{sip_openout
         <http://www.aculab.com/Support/v6_api/sip/\
-        sip_openout.htm>}."""
+        sip_openout.htm>}.
+
+        If the reactor is overloaded, the call is deferred until it has
+        recovered. If it cannot be placed later, the controller's
+        C{openout_failed} is called, see L{admission}.
+
+        @raise Overloaded: if the call cannot be deferred, see
+        L{AdmissionControl.defer <admission.AdmissionControl.defer>}."""
+
+        admission = getattr(self.reactor, 'admission', None)
+        if admission and admission.defer(self, self.openout,
+                                         destination_address,
+                                         sdp, originating_address,
+                                         contact_address,
+                                         request_notification_mask,
+                                         response_notification_mask,
+                                         call_options, custom_headers):
+            log.info('%s openout(%s) deferred, reactor overloaded',
+                     self.name, destination_address)
+            return
 
         media = lowlevel.ACU_MEDIA_OFFER_ANSWER()
         media.raw_sdp = str(sdp)
@@ -107,6 +137,7 @@ class SIPHandle(CallHandleBase):
                   originating_address)
 
         add_call_event(self.reactor, self)
+        call_started(self)
 
     def get_details(self):
         if self.details:
@@ -189,6 +220,8 @@ class SIPHandle(CallHandleBase):
     def release(self):
         """Release a call."""
 
+        call_ended(self)
+
         if self.details:
             lowlevel.sip_free_details(self.details)
             self.details = None
@@ -223,6 +256,22 @@ class SIPHandle(CallHandleBase):
     def ev_incoming_call_det(self):
         self.get_details()
 
+        # reject the call with the response code of the drain or the
+        # admission control if the process is draining or the reactor is
+        # overloaded
+        drain = draining()
+        if drain:
+            drain.refuse(self)
+            self.disconnect(drain.sip_code)
+            return HANDLED
+
+        admission = getattr(self.reactor, 'admission', None)
+        if admission and not admission.admit(self):
+            self.disconnect(admission.sip_code)
+            return HANDLED
+
+        call_started(self)
+
     def ev_details(self):
         self.get_details()
         
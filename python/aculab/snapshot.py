@@ -1,6 +1,9 @@
 # Copyright (C) 2005-2007 Lars Immisch
 
-"""A snapshot of all available cards, ports and modules (v6 API and later)."""
+"""A snapshot of all available cards, ports and modules (v6 API and later).
+
+A process can open a subset of the cards, ports and modules with a
+L{Partition}, see L{supervisor}."""
 
 from pprint import PrettyPrinter
 import lowlevel
@@ -140,6 +143,84 @@ class SIPPort(object):
         if rc:
             raise AculabError(rc, 'sip_set_message_notifications')        
 
+class Partition(object):
+    """A filter for L{Snapshot.init}: the cards, call control ports and
+    Prosody modules that a process opens.
+
+    Cards are identified by their serial number, ports and modules by their
+    index on the card. The ports and modules of a card are only opened if
+    the card is selected.
+
+    A card can be shared by several partitions that split its ports and
+    modules, without knowing how many the card has: with C{shares},
+    partition i of n opens every n-th port and module, starting with i.
+
+    Note that the indices into C{Snapshot().call}, C{ports}, etc. refer to
+    the opened subset."""
+
+    def __init__(self, cards = None, ports = None, modules = None,
+                 sip = True, shares = None):
+        """Create a partition.
+
+        @param cards: A list of serial numbers, or C{None} for all cards.
+        @param ports: A dictionary that maps serial numbers to lists of
+        port indices. Cards that are not in the dictionary (or C{None})
+        open all ports.
+        @param modules: A dictionary that maps serial numbers to lists of
+        module indices, like C{ports}.
+        @param sip: Open the SIP port.
+        @param shares: A dictionary that maps serial numbers to tuples
+        (index, count) for the cards that are shared by count partitions.
+        Explicit C{ports} or C{modules} of a card take precedence."""
+        self.cards = cards
+        self.ports = ports
+        self.modules = modules
+        self.sip = sip
+        self.shares = shares
+
+    def card(self, serial_no):
+        """Return True if the card serial_no is opened."""
+        return self.cards is None or serial_no in self.cards
+
+    def share(self, serial_no, index):
+        """Return True if index is in the share of card serial_no. Used
+        internally."""
+        if self.shares is None or serial_no not in self.shares:
+            return True
+        i, count = self.shares[serial_no]
+        return index % count == i
+
+    def port(self, serial_no, index):
+        """Return True if port index on card serial_no is opened."""
+        if self.ports is None or serial_no not in self.ports:
+            return self.share(serial_no, index)
+        return index in self.ports[serial_no]
+
+    def module(self, serial_no, index):
+        """Return True if module index on card serial_no is opened."""
+        if self.modules is None or serial_no not in self.modules:
+            return self.share(serial_no, index)
+        return index in self.modules[serial_no]
+
+    def __repr__(self):
+        return 'Partition(%s, %s, %s, %s, %s)' % (self.cards, self.ports,
+                                                 self.modules, self.sip,
+                                                 self.shares)
+
+# the default filter opens everything
+_all = Partition()
+
+def system_serials():
+    """Return the serial numbers of all cards in the system, without opening
+    them."""
+    snapshotp = lowlevel.ACU_SNAPSHOT_PARMS()
+
+    rc = lowlevel.acu_get_system_snapshot(snapshotp)
+    if rc:
+        raise AculabError(rc, 'acu_get_snapshot_parms')
+
+    return [snapshotp.get_serial(i) for i in range(snapshotp.count)]
+
 class CallControlCard(Card):
     """An Aculab card capable of call control.
 
@@ -150,7 +231,7 @@ class CallControlCard(Card):
        http://www.aculab.com/Support/v6_api/CallControl/\
        call_get_card_info.htm}.
        """
-    def __init__(self, card, info):
+    def __init__(self, card, info, filter = _all):
         Card.__init__(self, card, info)
 
         callp = lowlevel.ACU_OPEN_CALL_PARMS()
@@ -179,7 +260,8 @@ class CallControlCard(Card):
 
             self.ip_address = ipinfo.ip4_address;
 
-        self.ports = [Port(card, i) for i in range(infop.ports)]
+        self.ports = [Port(card, i) for i in range(infop.ports)
+                      if filter.port(card.serial_no, i)]
 
     def __repr__(self):
         if self.ip_address:
@@ -341,7 +423,7 @@ class Module(object):
 class ProsodyCard(Card):
     """An Aculab Prosody (speech processing) card.
     """
-    def __init__(self, card, info):
+    def __init__(self, card, info, filter = _all):
         Card.__init__(self, card, info)
         
         self.ip_address = None
@@ -358,7 +440,8 @@ class ProsodyCard(Card):
         if rc:
             raise AculabError(rc, '%s sm_get_card_info' % self.card.serial_no)
             
-        self.modules = [Module(card, i) for i in range(sm_infop.module_count)]
+        self.modules = [Module(card, i) for i in range(sm_infop.module_count)
+                        if filter.module(card.serial_no, i)]
 
         if sm_infop.card_type == lowlevel.kSMCarrierCardTypePX:
             ipinfo = lowlevel.ACU_PROSODY_IP_CARD_REGISTRATION_PARMS()
@@ -391,9 +474,15 @@ class Snapshot(object):
             Snapshot._singleton.init(*args, **kwargs)
         return Snapshot._singleton
 
-    def init(self, notification_queue = 0, user_data = None):
+    def init(self, notification_queue = 0, user_data = None, filter = None):
         """Note that we do not have a __init__ method, since this is called
-        every time the singleton is re-issued. We do the work here instead"""
+        every time the singleton is re-issued. We do the work here instead
+
+        @param filter: A L{Partition} that selects the cards, ports and
+        modules to open. The default is to open everything."""
+
+        if filter is None:
+            filter = _all
         
         self.sip = None
         self.switch = []
@@ -406,20 +495,18 @@ class Snapshot(object):
         
         count = count + 1
 
-        try:
-            self.sip = SIPPort()
-        except AculabError:
-            pass
+        if filter.sip:
+            try:
+                self.sip = SIPPort()
+            except AculabError:
+                pass
+
+        for serial_no in system_serials():
+            if not filter.card(serial_no):
+                continue
 
-        snapshotp = lowlevel.ACU_SNAPSHOT_PARMS()
-    
-        rc = lowlevel.acu_get_system_snapshot(snapshotp)
-        if rc:
-            raise AculabError(rc, 'acu_get_snapshot_parms')
-    
-        for i in range(snapshotp.count):
             openp = lowlevel.ACU_OPEN_CARD_PARMS()
-            openp.serial_no = snapshotp.get_serial(i)
+            openp.serial_no = serial_no
             openp.app_context_token = user_data
             openp.notification_queue = notification_queue
             rc = lowlevel.acu_open_card(openp)
@@ -439,13 +526,13 @@ class Snapshot(object):
                 # ignore ERR_NO_PORTS: happens on Prosody X without
                 # a PMX
                 try:
-                    self.call.append(CallControlCard(openp, infop))
+                    self.call.append(CallControlCard(openp, infop, filter))
                 except AculabError, e:
                     if e.value != lowlevel.ERR_NO_PORTS:
                         raise
 
             if infop.resources_available & lowlevel.ACU_RESOURCE_SPEECH:
-                self.prosody.append(ProsodyCard(openp, infop))
+                self.prosody.append(ProsodyCard(openp, infop, filter))
 
     def pprint(self, **kwargs):
         """Pretty-print all cards (not very detailed yet)"""
@@ -17,10 +17,16 @@ block for IVR-type applications. For an example, look at U{am/am.py
 an answering machine that implements its user interaction as a queue of jobs.
 """
 
+from __future__ import with_statement
+
 import sys
 import os
 import time
+import mmap
+import bisect
 import logging
+import threading
+import itertools
 import lowlevel
 import names
 import select
@@ -31,32 +37,36 @@ from switching import (Connection, CTBusEndpoint, SpeechEndpoint, TDMrx, TDMtx,
                        DefaultBus, connect, get_datafeed)
 from util import TiNG_version
 from error import *
+from drain import job_started, job_ended
+from timer import monotonic
+from phrases import index_name, read_index
 if os.name == 'nt':
     import pywintypes
 
-__all__ = ['PlayJob', 'RecordJob', 'DigitsJob', 'ToneJob', 'SilenceJob',
-           'SpeechChannel', 'Conference', 'Glue']
+__all__ = ['PlayJob', 'MappedFile', 'MappedPlayJob', 'Prompt', 'PromptCache',
+           'CachedPlayJob', 'PlaylistJob', 'PhraseBook', 'PhraseJob',
+           'RecordJob', 'DigitsJob', 'ToneJob', 'SilenceJob', 'SpeechChannel',
+           'Conference', 'Glue']
 
 log = logging.getLogger('speech')
 log_switch = logging.getLogger('switch')
 
+# map filename extensions to (format, sampling rate, data rate)
+filetypes = { '.al': (lowlevel.kSMDataFormatALawPCM, 8000, 8000),
+              '.ul': (lowlevel.kSMDataFormatULawPCM, 8000, 8000),
+              '.sw': (lowlevel.kSMDataFormat16bit, 8000, 16000) }
+
 def guess_filetype(fn):
     """Guess format, sampling rate and data rate from the file extension.
 
     Currently recognized are C{.al} (alaw, 8kHz) C{.ul} (mulaw, 8kHz)
-    and C{.sw} (16bit/sample, signed, 8 kHz).
+    and C{.sw} (16bit/sample, signed, 8 kHz), see L{filetypes}.
 
     @return: a tuple (format, sampling rate, data rate).
     """
     ext = os.path.splitext(fn)[1]
-    if ext == '.al':
-        return (lowlevel.kSMDataFormatALawPCM, 8000, 8000)
-    elif ext == '.ul':
-        return (lowlevel.kSMDataFormatULawPCM, 8000, 8000)
-    elif ext == '.sw':
-        return (lowlevel.kSMDataFormat16bit, 8000, 16000)
 
-    return (lowlevel.kSMDataFormatALawPCM, 8000, 8000)
+    return filetypes.get(ext, (lowlevel.kSMDataFormatALawPCM, 8000, 8000))
 
 tonetype = { lowlevel.kSMRecognisedNothing: 'nothing',
              lowlevel.kSMRecognisedTrainingDigit: 'training digit',
@@ -80,7 +90,8 @@ class PlayJobBase(object):
 
     Subclasses must implement C{get_data(len)} to fill
     the buffer C{data}. C{get_data(len)} must return the length of the
-    data written.
+    data written. Alternatively, subclasses may overwrite C{put_data(len)}
+    to pass the data to the driver themselves.
 
     Subclasses must overwrite C{done}, and, in their implementation, they must
     call C{PlayJobBase.done} and C{self.channel.job_done(...)}.
@@ -161,7 +172,7 @@ class PlayJobBase(object):
             # Add a reactor to self and add the write event to it.
             self.reactor = self.channel.reactor
             add_event(self.reactor, self.channel.event_write,
-                      self.fill_play_buffer)
+                      self.fill_play_buffer, True)
 
         return self
 
@@ -214,19 +225,28 @@ class PlayJobBase(object):
                 self.done()
                 return True
             else:
-                l = self.get_data(lowlevel.kSMMaxReplayDataBufferSize)
-                self.data.channel = self.channel.channel
+                l = self.put_data(lowlevel.kSMMaxReplayDataBufferSize)
+                self.offset = self.offset + l
 
-                if l == lowlevel.kSMMaxReplayDataBufferSize:
-                    rc = lowlevel.sm_put_replay_data(self.data)
-                else:
-                    rc = lowlevel.sm_put_last_replay_data(self.data)
+    def put_data(self, length):
+        """Pass up to length bytes from C{get_data} to the driver. If there
+        is less data, it is the last data.
 
-                if rc:
-                    raise AculabSpeechError(rc, 'sm_put_replay_data',
-                                            self.channel.name)
+        @return: the length of the data passed to the driver."""
 
-                self.offset = self.offset + l
+        l = self.get_data(length)
+        self.data.channel = self.channel.channel
+
+        if l == length:
+            rc = lowlevel.sm_put_replay_data(self.data)
+        else:
+            rc = lowlevel.sm_put_last_replay_data(self.data)
+
+        if rc:
+            raise AculabSpeechError(rc, 'sm_put_replay_data',
+                                    self.channel.name)
+
+        return l
 
     def stop(self):
         """I{Generic job interface method}.
@@ -327,6 +347,762 @@ class PlayJob(PlayJobBase):
                 
         return self.data.read(self.file, length)
 
+class MappedFile(object):
+    """A prompt file, mapped read-only into memory.
+
+    A L{MappedPlayJob} passes the data to the driver directly from the
+    mapping, so there is no C{fread} and no copy per chunk. All channels
+    that play the same MappedFile share one mapping and one file
+    descriptor, and all processes share the pages in the page cache."""
+
+    def __init__(self, filename, filetype = None):
+        """Map a file.
+
+        @param filename: The name of the file.
+        @param filetype: The file type. The default is to guess it from
+        the filename extension, see L{PlayJob}."""
+        
+        self.filename = filename
+        if filetype is None:
+            self.filetype, self.sampling_rate, self.data_rate = \
+                           guess_filetype(filename)
+        else:
+            self.filetype = filetype
+            self.sampling_rate = 8000
+            self.data_rate = 8000
+
+        f = file(filename, 'rb')
+        try:
+            self.length = os.fstat(f.fileno()).st_size
+            if self.length:
+                self.data = mmap.mmap(f.fileno(), self.length,
+                                     access = mmap.ACCESS_READ)
+            else:
+                # empty files cannot be mapped
+                self.data = ''
+        finally:
+            # the mapping keeps its own reference to the file
+            f.close()
+
+    def __repr__(self):
+        return 'MappedFile(%s)' % self.filename
+
+    def close(self):
+        """Unmap the file.
+
+        Jobs that are still playing it will fail."""
+        if self.data:
+            self.data.close()
+        self.data = ''
+        self.length = 0
+
+class MappedPlayJob(PlayJobBase):
+    """Job to play a L{MappedFile} or a L{Prompt}.
+
+    The driver reads directly from the mapping or the prompt data. Use
+    this for prompts that many channels play at the same time."""
+
+    name = 'play'
+
+    def __init__(self, channel, f, agc = 0, speed = 0, volume = 0,
+                 filetype = None):
+        """Create a MappedPlayJob.
+
+        @param channel: The L{SpeechChannel} that will play the file.
+        @param f: A L{MappedFile}, a L{Prompt} or a I{filename}. A file
+        that is passed by name is mapped for this job only and unmapped upon
+        completion.
+        
+        See L{PlayJob} for the other parameters. The file type of the
+        L{MappedFile} is used if filetype is C{None}."""
+
+        PlayJobBase.__init__(self, channel, agc, speed, volume, filetype)
+
+        if type(f) == type(''):
+            self.file = MappedFile(f, filetype)
+            self.filename = f
+        else:
+            self.file = f
+
+        if filetype is None:
+            self.filetype = self.file.filetype
+            self.sampling_rate = self.file.sampling_rate
+            self.data_rate = self.file.data_rate
+
+        self.length = self.file.length
+        # no buffer needed, the driver reads from the mapping
+        self.data = lowlevel.SM_TS_DATA_PARMS(0)
+
+        # used for logging
+        self.datadesc = self.file.filename
+
+    def done(self):
+        """I{Generic job interface method}."""
+
+        reason, duration = PlayJobBase.done(self)
+
+        f = self.file
+
+        if hasattr(self, 'filename'):
+            f.close()
+            self.file = None
+            f = self.filename
+
+        self.channel.job_done(self, 'play_done', reason, duration, f)
+
+    def put_data(self, length):
+        """I{PlayJobBase interface method}."""
+
+        l = max(min(length, self.length - self.offset), 0)
+        self.data.channel = self.channel.channel
+
+        rc = self.data.put_replay_buffer(self.file.data, self.offset, l,
+                                         l < length)
+        if rc:
+            raise AculabSpeechError(rc, 'sm_put_replay_data',
+                                    self.channel.name)
+
+        return l
+
+class Prompt(object):
+    """A prompt held in memory by a L{PromptCache}.
+
+    The data is an immutable string, so a prompt that is replaced or
+    evicted stays valid for the jobs that are still playing it."""
+
+    def __init__(self, filename, mtime, data, filetype = None):
+        self.filename = filename
+        self.mtime = mtime
+        self.data = data
+        self.length = len(data)
+        if filetype is None:
+            self.filetype, self.sampling_rate, self.data_rate = \
+                           guess_filetype(filename)
+        else:
+            self.filetype = filetype
+            self.sampling_rate = 8000
+            self.data_rate = 8000
+        # the number of jobs playing the prompt
+        self.refs = 0
+        self.pinned = False
+        # the time of the last check of the mtime
+        self.checked = 0.0
+        # the LRU clock of the last use
+        self.used = 0
+
+    def __repr__(self):
+        return 'Prompt(%s)' % self.filename
+
+    def duration(self):
+        """Return the duration of the prompt in seconds."""
+        return float(self.length) / self.data_rate
+
+class PromptCache(object):
+    """A cache of prompts in memory, shared by all channels of the process.
+
+    Prompts are keyed by filename and modification time: a prompt is
+    loaded again when its file has changed. The modification time is
+    checked at most every C{check_interval} seconds, so that a hit usually
+    costs no system call at all.
+
+    The cache holds at most C{budget} bytes. The least recently used
+    prompts are evicted first, except for pinned prompts and prompts that
+    are being played (see L{acquire} and L{release}). Prompts larger than
+    the budget are loaded but not cached, unless they are pinned.
+
+    This is safe to use from several reactor threads."""
+
+    def __init__(self, budget = 64 * 1024 * 1024, check_interval = 1.0):
+        """Create a prompt cache.
+
+        @param budget: The maximum size of the cached prompts in bytes.
+        @param check_interval: The interval in seconds for checking the
+        modification time of a cached prompt. Use C{None} to never check."""
+        self.budget = budget
+        self.check_interval = check_interval
+        self.mutex = threading.Lock()
+        # filename: Prompt
+        self.prompts = {}
+        # the LRU clock, see Prompt.used
+        self.clock = itertools.count(1)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, filename, filetype = None):
+        """Return the L{Prompt} for filename, loading it if necessary.
+
+        @raise IOError: if the file cannot be read."""
+        return self.lookup(filename, filetype, False)
+
+    def lookup(self, filename, filetype, pin):
+        """Return the L{Prompt} for filename and pin it if pin is True.
+        Used internally.
+
+        @raise IOError: if the file cannot be read."""
+        now = monotonic()
+        pinned = pin
+        with self.mutex:
+            prompt = self.prompts.pop(filename, None)
+            if prompt and self.check_interval is not None and \
+                   now - prompt.checked >= self.check_interval:
+                prompt.checked = now
+                try:
+                    mtime = os.stat(filename).st_mtime
+                except OSError:
+                    # keep playing the cached prompt
+                    mtime = prompt.mtime
+                if mtime != prompt.mtime:
+                    log.debug('prompt %s has changed', filename)
+                    self.remove(prompt)
+                    pinned = pinned or prompt.pinned
+                    prompt = None
+
+            if prompt:
+                self.hits += 1
+                prompt.pinned = prompt.pinned or pin
+                prompt.used = self.clock.next()
+                self.prompts[filename] = prompt
+                return prompt
+
+            self.misses += 1
+
+        # read the file without holding the mutex
+        f = file(filename, 'rb')
+        try:
+            mtime = os.fstat(f.fileno()).st_mtime
+            prompt = Prompt(filename, mtime, f.read(), filetype)
+        finally:
+            f.close()
+        prompt.checked = now
+        prompt.pinned = pinned
+
+        if prompt.length > self.budget and not pinned:
+            log.warn('prompt %s (%d bytes) exceeds the budget of the '
+                     'prompt cache', filename, prompt.length)
+            return prompt
+
+        with self.mutex:
+            # another thread may have loaded the prompt in the meantime
+            other = self.prompts.pop(filename, None)
+            if other:
+                self.remove(other)
+                prompt.pinned = prompt.pinned or other.pinned
+            prompt.used = self.clock.next()
+            self.prompts[filename] = prompt
+            self.size += prompt.length
+            self.evict()
+
+        return prompt
+
+    def acquire(self, prompt):
+        """Protect a prompt from eviction until L{release} is called.
+        Used by L{CachedPlayJob} while it plays."""
+        with self.mutex:
+            prompt.refs += 1
+
+    def release(self, prompt):
+        """Release a prompt protected by L{acquire}."""
+        with self.mutex:
+            prompt.refs -= 1
+            if not prompt.refs:
+                self.evict()
+
+    def pin(self, filename, filetype = None):
+        """Load filename and never evict it. A pinned prompt is cached even
+        if it exceeds the budget.
+
+        @return: the L{Prompt}."""
+        return self.lookup(filename, filetype, True)
+
+    def unpin(self, filename):
+        """Allow a pinned prompt to be evicted again."""
+        with self.mutex:
+            prompt = self.prompts.get(filename, None)
+            if prompt:
+                prompt.pinned = False
+                self.evict()
+
+    def remove(self, prompt):
+        """Forget a prompt that was removed from the cache. Must be called
+        with the mutex held. Used internally."""
+        self.size -= prompt.length
+
+    def evict(self):
+        """Evict the least recently used prompts until the cache is within
+        its budget. Must be called with the mutex held. Used internally."""
+        if self.size <= self.budget:
+            return
+
+        for prompt in sorted(self.prompts.values(), key = lambda p: p.used):
+            if self.size <= self.budget:
+                break
+            if prompt.pinned or prompt.refs:
+                continue
+
+            del self.prompts[prompt.filename]
+            self.remove(prompt)
+            self.evictions += 1
+            log.debug('evicted prompt %s', prompt.filename)
+
+    def discard(self, filename):
+        """Remove a prompt from the cache, even if it is pinned."""
+        with self.mutex:
+            prompt = self.prompts.pop(filename, None)
+            if prompt:
+                self.remove(prompt)
+
+    def clear(self):
+        """Remove all prompts that are not pinned."""
+        with self.mutex:
+            for filename, prompt in self.prompts.items():
+                if not prompt.pinned:
+                    del self.prompts[filename]
+                    self.remove(prompt)
+
+    def stats(self):
+        """Return the size, the number of prompts and the counters as a
+        dictionary."""
+        with self.mutex:
+            return { 'prompts': len(self.prompts),
+                     'pinned': len([p for p in self.prompts.values()
+                                    if p.pinned]),
+                     'size': self.size,
+                     'budget': self.budget,
+                     'hits': self.hits,
+                     'misses': self.misses,
+                     'evictions': self.evictions }
+
+# the prompt cache of the process
+prompt_cache = PromptCache()
+
+class CachedPlayJob(MappedPlayJob):
+    """Job to play a file from a L{PromptCache}.
+
+    Once the prompt is cached, creating the job costs no file I/O and the
+    channel needs no file descriptor.
+
+    The prompt is protected from eviction while the job plays."""
+
+    def __init__(self, channel, f, agc = 0, speed = 0, volume = 0,
+                 filetype = None, cache = None):
+        """Create a CachedPlayJob.
+
+        @param channel: The L{SpeechChannel} that will play the file.
+        @param f: The filename.
+        @param cache: The L{PromptCache}. The default is the
+        L{prompt_cache} of the process.
+
+        See L{PlayJob} for the other parameters."""
+
+        if cache is None:
+            cache = prompt_cache
+
+        self.cache = cache
+        MappedPlayJob.__init__(self, channel, cache.get(f, filetype),
+                               agc, speed, volume, filetype)
+        self.filename = f
+
+    def start(self):
+        """I{Generic job interface method}."""
+
+        self.cache.acquire(self.file)
+        try:
+            return MappedPlayJob.start(self)
+        except:
+            self.cache.release(self.file)
+            raise
+
+    def done(self):
+        """I{Generic job interface method}."""
+
+        reason, duration = PlayJobBase.done(self)
+
+        self.cache.release(self.file)
+        self.file = None
+
+        self.channel.job_done(self, 'play_done', reason, duration,
+                              self.filename)
+
+class PlaylistJob(PlayJobBase):
+    """Job to play several prompts back to back in a single replay.
+
+    There is no gap between the prompts, and only one C{sm_replay_start}
+    and one C{job_done} for the whole list. All prompts must have the same
+    file type.
+
+    The start of each item is in L{starts}. When the job is done, the
+    controller's C{playlist_done} is called with the index of the item
+    that was playing and the position in it::
+
+        def playlist_done(self, channel, reason, duration, index, position,
+                          user_data):
+            pass
+    """
+
+    name = 'playlist'
+
+    def __init__(self, channel, items, agc = 0, speed = 0, volume = 0,
+                 filetype = None, cache = None):
+        """Create a PlaylistJob.
+
+        @param channel: The L{SpeechChannel} that will play the files.
+        @param items: A list of I{filenames}, file objects, L{MappedFile}s,
+        L{Prompt}s or L{Segment}s. Files that are passed by name are opened for this
+        job and closed upon completion. File objects are played from
+        their current position and left open.
+        @param cache: A L{PromptCache}. If given, files passed by name are
+        played from the cache instead.
+
+        See L{PlayJob} for the other parameters. If filetype is C{None},
+        it is determined from the first item."""
+
+        PlayJobBase.__init__(self, channel, agc, speed, volume, filetype)
+
+        # check the file types before opening anything
+        types = []
+        for item in items:
+            if type(item) == type(''):
+                types.append(guess_filetype(item))
+            elif hasattr(item, 'data'):
+                types.append((item.filetype, item.sampling_rate,
+                              item.data_rate))
+            else:
+                # file objects have no type
+                types.append(None)
+
+        known = [t for t in types if t]
+        if filetype is None and known:
+            self.filetype, self.sampling_rate, self.data_rate = known[0]
+
+        for i, t in enumerate(types):
+            if t and t[0] != self.filetype:
+                raise ValueError('playlist item %d has a different file type'
+                                 % i)
+
+        self.cache = cache
+        # the sources, the files opened here and the prompts from the cache
+        self.sources = []
+        self.files = []
+        self.prompts = []
+        names = []
+        try:
+            for item in items:
+                if type(item) == type(''):
+                    if cache:
+                        source = cache.get(item, self.filetype)
+                        self.prompts.append(source)
+                    else:
+                        source = file(item, 'rb')
+                        self.files.append(source)
+                    names.append(item)
+                else:
+                    source = item
+                    names.append(str(item))
+                self.sources.append(source)
+        except:
+            # the prompts are not acquired before start
+            for f in self.files:
+                f.close()
+            self.files = []
+            self.prompts = []
+            raise
+
+        # the length of each item and the offset of its start in bytes
+        self.lengths = []
+        self.starts = []
+        self.length = 0
+        for source in self.sources:
+            if hasattr(source, 'data'):
+                l = source.length
+            else:
+                pos = source.tell()
+                source.seek(0, 2)
+                l = source.tell() - pos
+                source.seek(pos, 0)
+            self.starts.append(self.length)
+            self.lengths.append(l)
+            self.length += l
+
+        # the item and the offset in it of the next data for the driver
+        self.item = 0
+        self.item_offset = 0
+
+        # used for logging
+        self.datadesc = ', '.join(names)
+
+    def boundaries(self):
+        """Return the start of each item in seconds."""
+        return [float(s) / self.data_rate for s in self.starts]
+
+    def locate(self, offset):
+        """Return the index of the item at offset (in bytes) and the
+        position in the item in seconds."""
+        if not self.starts:
+            return (0, 0.0)
+
+        index = max(bisect.bisect_right(self.starts, offset) - 1, 0)
+        # skip empty items
+        while index < len(self.starts) - 1 and not self.lengths[index]:
+            index += 1
+        position = min(offset - self.starts[index], self.lengths[index])
+
+        return (index, float(position) / self.data_rate)
+
+    def start(self):
+        """I{Generic job interface method}."""
+
+        for prompt in self.prompts:
+            self.cache.acquire(prompt)
+        try:
+            return PlayJobBase.start(self)
+        except:
+            self.release()
+            raise
+
+    def release(self):
+        """Close the files and release the prompts. Used internally."""
+        for f in self.files:
+            f.close()
+        self.files = []
+
+        for prompt in self.prompts:
+            self.cache.release(prompt)
+        self.prompts = []
+
+    def done(self):
+        """I{Generic job interface method}."""
+
+        reason, duration = PlayJobBase.done(self)
+
+        index, position = self.locate(self.stop_offset or self.offset)
+        self.release()
+
+        self.channel.job_done(self, 'playlist_done', reason, duration,
+                              index, position)
+
+    def advance(self):
+        """Skip to the next item with data. Used internally.
+
+        @return: the current source or C{None} at the end."""
+        while self.item < len(self.sources):
+            if self.item_offset < self.lengths[self.item]:
+                if not self.item_offset:
+                    log.debug('%s %s item %d at %.3f', self.channel.name,
+                              self.name, self.item,
+                              float(self.starts[self.item]) / self.data_rate)
+                return self.sources[self.item]
+
+            self.item += 1
+            self.item_offset = 0
+
+        return None
+
+    def put_data(self, length):
+        """I{PlayJobBase interface method}.
+
+        A chunk within a L{MappedFile}, L{Prompt} or L{Segment} is passed to
+        the driver directly, a chunk across items is copied."""
+
+        l = max(min(length, self.length - self.offset), 0)
+        self.data.channel = self.channel.channel
+
+        source = self.advance()
+        if source is not None and hasattr(source, 'data') and \
+               self.item_offset + l <= self.lengths[self.item]:
+            # segments of a phrase book start at an offset in the data
+            start = getattr(source, 'offset', 0) + self.item_offset
+            rc = self.data.put_replay_buffer(source.data, start, l,
+                                             l < length)
+            self.item_offset += l
+        else:
+            chunks = []
+            n = l
+            while n:
+                source = self.advance()
+                if source is None:
+                    break
+                c = min(n, self.lengths[self.item] - self.item_offset)
+                if hasattr(source, 'data'):
+                    start = getattr(source, 'offset', 0) + self.item_offset
+                    data = source.data[start:start + c]
+                else:
+                    data = source.read(c)
+                chunks.append(data)
+                self.item_offset += len(data)
+                n -= len(data)
+                if len(data) < c:
+                    log.warn('%s %s item %d is shorter than %d bytes',
+                             self.channel.name, self.name, self.item,
+                             self.lengths[self.item])
+                    break
+
+            # stop after a short read, so that the offset stays exact
+            l -= n
+            self.data.setdata(''.join(chunks))
+            if l == length:
+                rc = lowlevel.sm_put_replay_data(self.data)
+            else:
+                rc = lowlevel.sm_put_last_replay_data(self.data)
+
+        if rc:
+            raise AculabSpeechError(rc, 'sm_put_replay_data',
+                                    self.channel.name)
+
+        return l
+
+class Segment(object):
+    """A segment of a L{PhraseBook}: a slice of its data."""
+
+    def __init__(self, book, name, offset, length):
+        self.name = name
+        self.data = book.file.data
+        self.offset = offset
+        self.length = length
+        self.filetype = book.file.filetype
+        self.sampling_rate = book.file.sampling_rate
+        self.data_rate = book.file.data_rate
+
+    def __repr__(self):
+        return 'Segment(%s)' % self.name
+
+    def __str__(self):
+        return self.name
+
+class PhraseBook(object):
+    """The segments of one language in a single mapped file.
+
+    The blob is a concatenation of prompts, and the index has the name,
+    offset and length of each segment in it, see L{phrases}. A number,
+    date or amount is spoken as one L{PhraseJob} that plays the segments
+    straight from the mapping, instead of one job per segment::
+
+        english = PhraseBook('en.al', phrases.English())
+        english.say_number(channel, 1234)
+        english.say(channel, ['balance'] + english.language.amount(12.5))
+    """
+
+    def __init__(self, filename, language, index = None, filetype = None):
+        """Map a blob and read its index.
+
+        @param filename: The name of the blob.
+        @param language: The L{Language <phrases.Language>} that translates
+        numbers, dates and amounts to segment names.
+        @param index: The name of the index. The default is the name of
+        the blob with the extension C{.idx}.
+        @param filetype: The file type. The default is to guess it from
+        the filename extension, see L{PlayJob}.
+        @raise ValueError: if the index is invalid."""
+
+        self.filename = filename
+        self.language = language
+        self.file = MappedFile(filename, filetype)
+        if index is None:
+            index = index_name(filename)
+
+        self.segments = {}
+        for name, (offset, length) in read_index(index).iteritems():
+            if offset < 0 or length < 0 or offset + length > self.file.length:
+                raise ValueError('%s: segment %s is outside of %s' %
+                                 (index, name, filename))
+            self.segments[name] = Segment(self, name, offset, length)
+
+        missing = [n for n in language.names if n not in self.segments]
+        if missing:
+            log.warn('%s: no segments for %s', filename, ', '.join(missing))
+
+    def __repr__(self):
+        return 'PhraseBook(%s)' % self.filename
+
+    def close(self):
+        """Unmap the blob.
+
+        Jobs that are still playing it will fail."""
+        self.file.close()
+        self.segments = {}
+
+    def lookup(self, names):
+        """Return the L{Segment}s for a list of segment names.
+
+        @raise ValueError: if a segment is not in the index."""
+        try:
+            return [self.segments[n] for n in names]
+        except KeyError, e:
+            raise ValueError('%s: no segment %s' % (self.filename, e.args[0]))
+
+    def say(self, channel, names, volume = 0, agc = 0, speed = 0):
+        """Play a list of segment names on channel.
+
+        This is a shorthand for L{SpeechChannel.say}."""
+        channel.say(self, names, volume, agc, speed)
+
+    def say_number(self, channel, n, **kwargs):
+        """Speak the integer n on channel."""
+        self.say(channel, self.language.number(n), **kwargs)
+
+    def say_digits(self, channel, digits, **kwargs):
+        """Speak a string of digits on channel, one by one."""
+        self.say(channel, self.language.digits(digits), **kwargs)
+
+    def say_date(self, channel, date, year = True, **kwargs):
+        """Speak a C{datetime.date} on channel."""
+        self.say(channel, self.language.date(date, year), **kwargs)
+
+    def say_amount(self, channel, amount, unit = ('euro', 'euros'),
+                   subunit = ('cent', 'cents'), **kwargs):
+        """Speak an amount of money on channel.
+
+        See L{Language.amount <phrases.Language.amount>} for the
+        parameters."""
+        self.say(channel, self.language.amount(amount, unit, subunit),
+                 **kwargs)
+
+class PhraseJob(PlaylistJob):
+    """Job to play segments of a L{PhraseBook} back to back.
+
+    All segments are played in a single replay. A chunk within a segment
+    is passed to the driver directly from the blob, and only chunks across
+    segments are copied.
+
+    When the job is done, the controller's C{phrase_done} is called with
+    the index of the segment that was playing and the position in it::
+
+        def phrase_done(self, channel, reason, duration, index, position,
+                        user_data):
+            pass
+    """
+
+    name = 'phrase'
+
+    def __init__(self, channel, book, names, agc = 0, speed = 0,
+                 volume = 0):
+        """Create a PhraseJob.
+
+        @param channel: The L{SpeechChannel} that will play the phrase.
+        @param book: The L{PhraseBook}.
+        @param names: A list of segment names.
+        @raise ValueError: if a segment is not in the book.
+
+        See L{PlayJob} for the other parameters."""
+
+        PlaylistJob.__init__(self, channel, book.lookup(names), agc, speed,
+                             volume, book.file.filetype)
+        self.sampling_rate = book.file.sampling_rate
+        self.data_rate = book.file.data_rate
+        self.book = book
+        self.names = names
+
+    def done(self):
+        """I{Generic job interface method}."""
+
+        reason, duration = PlayJobBase.done(self)
+
+        index, position = self.locate(self.stop_offset or self.offset)
+
+        self.channel.job_done(self, 'phrase_done', reason, duration,
+                              index, position)
+
 class SilenceJob(PlayJobBase):
     """Job to play silence.
 
@@ -469,7 +1245,8 @@ class RecordJob(object):
                   self.agc, self.volume)
                   
         # add the read event to the reactor
-        add_event(self.channel.reactor, self.channel.event_read, self.on_read)
+        add_event(self.channel.reactor, self.channel.event_read, self.on_read,
+                  True)
 
     def done(self):                
         """I{Generic job interface method}."""
@@ -1314,7 +2091,7 @@ class SpeechChannel(object):
             self.event_recog = self.set_event(lowlevel.kSMEventTypeRecog)
         
             # add the recog event to the reactor
-            add_event(self.reactor, self.event_recog, self.on_recog)
+            add_event(self.reactor, self.event_recog, self.on_recog, True)
 
     def dc_config(self, protocol, pconf, encoding, econf):
         """Configure the channel for data communications.
@@ -1350,17 +2127,30 @@ class SpeechChannel(object):
 
         if not self.close_pending:
             self.job = job
-            job.start()
-    
+            # a short job may be done before start returns, so the job
+            # must be tracked first
+            job_started(self)
+            try:
+                job.start()
+            except:
+                self.job = None
+                job_ended(self)
+                raise
+
     def play(self, file, volume = 0, agc = 0, speed = 0, filetype = None):
         """Play a file.
 
-        This is a shorthand to create and start a L{PlayJob}.
+        This is a shorthand to create and start a L{PlayJob}, or a
+        L{MappedPlayJob} if file is a L{MappedFile} or a L{Prompt}.
 
         See L{PlayJob <PlayJob.__init__>} for a description of the
         parameters."""
 
-        job = PlayJob(self, file, agc, volume, speed, filetype)
+        if isinstance(file, (MappedFile, Prompt)):
+            job = MappedPlayJob(self, file, agc = agc, speed = speed,
+                                volume = volume, filetype = filetype)
+        else:
+            job = PlayJob(self, file, agc, volume, speed, filetype)
 
         self.start(job)
 
@@ -1405,6 +2195,33 @@ class SpeechChannel(object):
 
         self.start(job)
 
+    def playlist(self, items, volume = 0, agc = 0, speed = 0,
+                 filetype = None, cache = None):
+        """Play several files back to back.
+
+        This is a shorthand to create and start a L{PlaylistJob}.
+
+        See L{PlaylistJob <PlaylistJob.__init__>} for a description of the
+        parameters."""
+
+        job = PlaylistJob(self, items, agc = agc, speed = speed,
+                          volume = volume, filetype = filetype, cache = cache)
+
+        self.start(job)
+
+    def say(self, book, names, volume = 0, agc = 0, speed = 0):
+        """Play segments of a L{PhraseBook} in a single replay.
+
+        This is a shorthand to create and start a L{PhraseJob}.
+
+        See L{PhraseJob <PhraseJob.__init__>} for a description of the
+        parameters."""
+
+        job = PhraseJob(self, book, names, agc = agc, speed = speed,
+                        volume = volume)
+
+        self.start(job)
+
     def silence(self, duration = 0.0):
         """Play silence.
 
@@ -1489,6 +2306,7 @@ class SpeechChannel(object):
         args = args + (self.user_data,)
 
         self.job = None
+        job_ended(self)
         if self.close_pending:
             self._close()
 
@@ -1521,7 +2339,7 @@ class Glue(object):
     of a call leg that has a Prosody channel for speech processing.
 
     When created, a Glue object will allocate a L{SpeechChannel}
-    and connect it to the call.
+    on the reactor of the call and connect it to the call.
     
     When deleted, it will close and disconnect the L{SpeechChannel}."""
     
@@ -1541,7 +2359,8 @@ class Glue(object):
         self.speech = None
         self.connection = None
         call.user_data = self
-        self.speech = SpeechChannel(controller, module, user_data = self)
+        self.speech = SpeechChannel(controller, module, user_data = self,
+                                    reactor = call.reactor)
         if auto_connect:
             self.connection = connect(call, self.speech)
 
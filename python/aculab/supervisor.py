@@ -0,0 +1,410 @@
+# Copyright (C) 2009 Lars Immisch
+
+"""A pre-fork supervisor for multiple worker processes.
+
+A single process runs all calls on one interpreter, with one GIL, and a
+crash takes down all calls. The L{Supervisor} partitions the cards of the
+system and forks a worker process for each L{Partition
+<snapshot.Partition>}. Each worker opens only its own cards, ports and
+modules. Crashed workers are restarted.
+
+Workers report metrics as dictionaries over a local socket, and the
+supervisor aggregates them.
+
+Usage::
+
+    def worker(partition, reporter):
+        # import modules that create a reactor here, not before the fork
+        from aculab.callcontrol import Call
+        from aculab.reactor import Reactor
+
+        for port in range(len(Snapshot().call[0].ports)):
+            Call(controller, port = port)
+
+        Reactor.add_periodic(10.0, lambda: reporter.report(Reactor.stats()))
+        Reactor.run()
+
+    Supervisor(worker).run()
+
+Note that the worker must not inherit a reactor from the supervisor, so the
+supervisor must not import L{reactor} or the modules that use it
+(L{callcontrol}, L{speech}, etc.).
+"""
+
+import os
+import time
+import errno
+import signal
+import socket
+import select
+import tempfile
+import logging
+try:
+    import json
+except ImportError:
+    import simplejson as json
+# local imports
+from snapshot import Snapshot, Partition, system_serials
+from timer import monotonic
+
+log = logging.getLogger('supervisor')
+
+def partition_cards(serials, count):
+    """Distribute the cards with serials into count partitions.
+
+    If there are at least as many cards as partitions, the cards are
+    distributed round-robin. Otherwise, the partitions are distributed
+    round-robin over the cards, and the partitions of a card split its
+    call control ports and Prosody modules (see L{Partition
+    <snapshot.Partition>}). A single card can thus be served by several
+    workers.
+
+    Only the first partition opens the SIP port."""
+    if not serials:
+        return [Partition([])]
+
+    count = max(count, 1)
+    partitions = [Partition([], sip = (i == 0)) for i in range(count)]
+    if count <= len(serials):
+        for i, serial_no in enumerate(serials):
+            partitions[i % count].cards.append(serial_no)
+
+        return partitions
+
+    for c, serial_no in enumerate(serials):
+        sharing = partitions[c::len(serials)]
+        for i, p in enumerate(sharing):
+            p.cards.append(serial_no)
+            p.shares = { serial_no: (i, len(sharing)) }
+
+    return partitions
+
+def aggregate(metrics):
+    """Sum a list of metrics dictionaries.
+
+    Numbers are added, dictionaries are aggregated recursively and other
+    values are dropped."""
+    total = {}
+    for m in metrics:
+        for k, v in m.items():
+            if isinstance(v, dict):
+                total[k] = aggregate([total.get(k, {}), v])
+            elif isinstance(v, (int, long, float)) and \
+                     not isinstance(v, bool):
+                total[k] = total.get(k, 0) + v
+
+    return total
+
+class MetricsReporter(object):
+    """Send metrics from a worker to the supervisor."""
+
+    def __init__(self, address, index):
+        self.address = address
+        self.index = index
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+
+    def report(self, metrics):
+        """Send metrics, a dictionary of JSON serializable values.
+
+        Errors are logged, so that a busy supervisor cannot take down a
+        worker."""
+        try:
+            self.socket.sendto(json.dumps({ 'worker': self.index,
+                                            'pid': os.getpid(),
+                                            'metrics': metrics }),
+                               self.address)
+        except socket.error, e:
+            log.warn('could not report metrics: %s', e)
+
+class Worker(object):
+    """The state of a worker process in the supervisor."""
+
+    def __init__(self, index, partition):
+        self.index = index
+        self.partition = partition
+        self.pid = None
+        # the monotonic time of the start
+        self.started = None
+        self.restarts = 0
+        # the monotonic time of the next restart and the last restart delay
+        self.restart_at = None
+        self.delay = 0.0
+        self.metrics = {}
+
+    def __repr__(self):
+        return 'Worker(%d, %s, %s)' % (self.index, self.pid, self.partition)
+
+class Supervisor(object):
+    """Fork a worker process for each partition and restart them when they
+    crash.
+
+    A worker that exits with status 0 is not restarted. A worker that
+    crashes is restarted after restart_delay seconds. If it crashes again
+    within min_uptime seconds, the delay is doubled, up to max_delay.
+
+    When the supervisor stops, it sends SIGTERM to the workers and waits
+    kill_timeout seconds for them to exit, then it kills the rest with
+    SIGKILL."""
+
+    def __init__(self, worker, partitions = None, processes = None,
+                 address = None, restart_delay = 1.0, max_delay = 60.0,
+                 min_uptime = 10.0, kill_timeout = 630.0):
+        """Create a supervisor.
+
+        @param worker: Called as C{worker(partition, reporter)} in the
+        worker process after the L{Snapshot <snapshot.Snapshot>} has been
+        opened for the partition. The reporter is a L{MetricsReporter}.
+        @param partitions: A list of L{Partition <snapshot.Partition>}s.
+        The default is to distribute the cards with L{partition_cards}.
+        @param processes: The number of worker processes if partitions is
+        not given. The default is one per card.
+        @param address: The path of the socket for the metrics. The default
+        is a new temporary directory.
+        @param restart_delay: The initial delay before a restart in seconds.
+        @param max_delay: The maximum delay before a restart in seconds.
+        @param min_uptime: A worker that crashes later than this is
+        restarted after restart_delay.
+        @param kill_timeout: The time in seconds that workers get to exit
+        after SIGTERM. Workers that L{drain <drain>} their calls on SIGTERM
+        need up to the timeout of the drain."""
+
+        if partitions is None:
+            serials = system_serials()
+            partitions = partition_cards(serials, processes or len(serials))
+
+        self.worker = worker
+        self.workers = [Worker(i, p) for i, p in enumerate(partitions)]
+        # the temporary directory for the socket, if any
+        self.tempdir = None
+        if address is None:
+            self.tempdir = tempfile.mkdtemp()
+            address = os.path.join(self.tempdir, 'metrics')
+        self.address = address
+        self.restart_delay = restart_delay
+        self.max_delay = max_delay
+        self.min_uptime = min_uptime
+        self.kill_timeout = kill_timeout
+        self.running = False
+        self.socket = None
+
+    def open(self, partition):
+        """Open the cards of partition in a worker process. Used
+        internally."""
+        Snapshot(filter = partition)
+
+    def child(self, worker):
+        """The main function of a worker process. Used internally.
+
+        @return: The exit status."""
+        try:
+            self.socket.close()
+            for s in (signal.SIGTERM, signal.SIGINT):
+                signal.signal(s, signal.SIG_DFL)
+            self.open(worker.partition)
+            self.worker(worker.partition,
+                        MetricsReporter(self.address, worker.index))
+        except SystemExit, e:
+            return e.code or 0
+        except:
+            log.error('worker %d crashed', worker.index, exc_info=1)
+            return 1
+
+        return 0
+
+    def spawn(self, worker):
+        """Fork a worker process. Used internally."""
+        pid = os.fork()
+        if pid == 0:
+            status = 1
+            try:
+                status = self.child(worker)
+            finally:
+                logging.shutdown()
+                os._exit(status)
+
+        worker.pid = pid
+        worker.started = monotonic()
+        worker.restart_at = None
+        log.info('started worker %d (pid %d) for %s', worker.index, pid,
+                 worker.partition)
+
+    def exited(self, worker, status):
+        """Handle the exit of a worker process. Used internally."""
+        worker.pid = None
+        if os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0:
+            log.info('worker %d exited', worker.index)
+            return
+
+        if os.WIFSIGNALED(status):
+            log.error('worker %d killed by signal %d', worker.index,
+                      os.WTERMSIG(status))
+        else:
+            log.error('worker %d exited with status %d', worker.index,
+                      os.WEXITSTATUS(status))
+
+        if not self.running:
+            return
+
+        # back off if the worker crashes right after the start
+        delay = self.restart_delay
+        if worker.restarts and monotonic() - worker.started < self.min_uptime:
+            delay = min(worker.delay * 2, self.max_delay)
+        worker.delay = delay
+        worker.restart_at = monotonic() + delay
+        worker.restarts += 1
+        log.info('restarting worker %d in %.1fs', worker.index, delay)
+
+    def reap(self):
+        """Collect exited workers. Used internally."""
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+
+            if pid == 0:
+                return
+
+            for w in self.workers:
+                if w.pid == pid:
+                    self.exited(w, status)
+
+    def receive(self):
+        """Receive all pending metrics from the workers. Used internally."""
+        while True:
+            try:
+                data = self.socket.recv(65536)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+
+            try:
+                message = json.loads(data)
+                worker = self.workers[message['worker']]
+                worker.metrics = message['metrics']
+            except (ValueError, KeyError, IndexError, TypeError):
+                log.warn('invalid metrics message: %r', data[:80])
+
+    def metrics(self):
+        """Return the metrics of all workers.
+
+        @return: A dictionary with C{'workers'}, a list of the last metrics
+        of each worker (with C{'pid'} and C{'restarts'}), and
+        C{'total'}, the L{aggregate} of the metrics."""
+        workers = []
+        for w in self.workers:
+            m = dict(w.metrics)
+            m['pid'] = w.pid
+            m['restarts'] = w.restarts
+            workers.append(m)
+
+        return { 'workers': workers,
+                 'total': aggregate([w.metrics for w in self.workers]) }
+
+    def stop(self, *args):
+        """Stop the supervisor and terminate the workers.
+
+        This is also the handler for SIGTERM and SIGINT."""
+        self.running = False
+
+    def run(self):
+        """Start the workers and supervise them until L{stop} is called or
+        all workers have exited normally."""
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self.socket.bind(self.address)
+        self.socket.setblocking(0)
+
+        self.running = True
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        try:
+            for w in self.workers:
+                self.spawn(w)
+
+            while self.running:
+                try:
+                    select.select([self.socket], [], [], 0.2)
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+
+                # reap first: the metrics of an exited worker are already
+                # in the socket
+                self.reap()
+                self.receive()
+
+                now = monotonic()
+                active = False
+                for w in self.workers:
+                    if w.pid is None and w.restart_at is not None \
+                           and now >= w.restart_at:
+                        self.spawn(w)
+                    if w.pid is not None or w.restart_at is not None:
+                        active = True
+
+                if not active:
+                    break
+        finally:
+            self.running = False
+            self.terminate()
+            self.socket.close()
+            os.unlink(self.address)
+            if self.tempdir:
+                os.rmdir(self.tempdir)
+
+    def terminate(self):
+        """Terminate all workers and wait for them, at most kill_timeout
+        seconds. Workers that are still running then are killed. Used
+        internally."""
+        running = [w for w in self.workers if w.pid is not None]
+        for w in running:
+            self.kill(w, signal.SIGTERM)
+
+        deadline = monotonic() + self.kill_timeout
+        while running:
+            running = [w for w in running if not self.wait(w, os.WNOHANG)]
+            if not running:
+                return
+            if monotonic() >= deadline:
+                break
+            time.sleep(0.1)
+
+        for w in running:
+            log.warn('worker %d (pid %d) did not exit after %.0fs, killing it',
+                     w.index, w.pid, self.kill_timeout)
+            self.kill(w, signal.SIGKILL)
+
+        for w in running:
+            while not self.wait(w, 0):
+                pass
+
+    def kill(self, worker, signum):
+        """Send signum to a worker. Used internally."""
+        try:
+            os.kill(worker.pid, signum)
+        except OSError:
+            pass
+
+    def wait(self, worker, options):
+        """Wait for a worker with C{waitpid}. Used internally.
+
+        @return: True if the worker has exited."""
+        try:
+            pid, status = os.waitpid(worker.pid, options)
+        except OSError, e:
+            if e.errno == errno.EINTR:
+                return False
+            # already collected
+            pid = worker.pid
+
+        if pid == 0:
+            return False
+
+        worker.pid = None
+        return True
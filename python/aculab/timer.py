@@ -6,40 +6,254 @@ from __future__ import with_statement
 
 import threading
 import time
+import heapq
+import itertools
+import math
+import os
+import sys
+
+# sys.platform prefix: CLOCK_MONOTONIC from <time.h>
+clock_ids = [('linux', 1), ('freebsd', 4), ('netbsd', 3), ('openbsd', 3)]
+
+def _monotonic():
+    """Return a monotonic clock function or None."""
+    try:
+        # Python 3.3
+        return time.monotonic
+    except AttributeError:
+        pass
+
+    try:
+        import ctypes
+        import ctypes.util
+    except ImportError:
+        return None
+
+    if os.name == 'nt':
+        try:
+            GetTickCount64 = ctypes.windll.kernel32.GetTickCount64
+        except AttributeError:
+            # before Vista
+            return None
+        GetTickCount64.restype = ctypes.c_ulonglong
+
+        return lambda: GetTickCount64() / 1000.0
+
+    # CLOCK_MONOTONIC differs between platforms. Elsewhere, the same id
+    # may be a CPU time clock, so don't guess
+    for prefix, CLOCK_MONOTONIC in clock_ids:
+        if sys.platform.startswith(prefix):
+            break
+    else:
+        return None
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    for lib in ('c', 'rt'):
+        name = ctypes.util.find_library(lib)
+        if not name:
+            continue
+        try:
+            clock_gettime = ctypes.CDLL(name, use_errno=True).clock_gettime
+        except (OSError, AttributeError):
+            continue
+
+        ts = timespec()
+        if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            return None
+
+        def monotonic():
+            ts = timespec()
+            clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts))
+            return ts.tv_sec + ts.tv_nsec * 1e-9
+
+        return monotonic
+
+    return None
+
+# The clock for all timers. It is not affected by changes of the system
+# time. Falls back to time.time if no monotonic clock is available
+monotonic = _monotonic() or time.time
+
+def align(absolute, slack):
+    """Delay a deadline by at most slack seconds, so that it is a multiple
+    of the largest power of two (in seconds) not greater than slack.
+
+    Deadlines with overlapping windows end up on the same grid point, and
+    the grids for different slacks are nested, so the timers expire
+    together."""
+    if slack <= 0:
+        return absolute
+
+    grid = math.ldexp(1.0, math.frexp(slack)[1] - 1)
+    return math.ceil(absolute / grid) * grid
 
 class Timer:
     """A timed function and its arguments."""
+
+    # tie breaker for timers that are due at the same time
+    _sequence = itertools.count()
     
-    def __init__(self, interval, function, args=[], kwargs={}):
-        self.absolute = time.time() + interval
+    def __init__(self, interval, function, args=[], kwargs={}, slack = 0):
+        self.absolute = align(monotonic() + interval, slack)
+        self.sequence = self._sequence.next()
         self.function = function
         self.args = args
         self.kwargs = kwargs
+        # False when the timer has expired or was cancelled
+        self.pending = True
 
     def __cmp__(self, other):
-        return cmp(self.absolute, other.absolute)
+        return cmp((self.absolute, self.sequence),
+                   (other.absolute, other.sequence))
 
     def __call__(self):
         self.function(*self.args, **self.kwargs)
 
+class Periodic:
+    """A periodic timer on a reactor. Created by C{reactor.add_periodic}.
+
+    The deadlines are absolute (start + n * interval), so the period does
+    not drift with the execution time of the function.
+
+    If the reactor falls behind by one or more intervals, the policy
+    decides what happens:
+     - C{'skip'}: call the function once and drop the missed deadlines.
+       The phase is kept.
+     - C{'burst'}: call the function once for each missed deadline, as
+       quickly as possible.
+     - C{'coalesce'}: call the function once and restart the schedule
+       from now.
+
+    With C{'skip'} and C{'coalesce'}, the number of missed deadlines is
+    available as C{missed} during the call. C{late} is the time in seconds
+    between the deadline and the call."""
+
+    policies = ('skip', 'burst', 'coalesce')
+
+    def __init__(self, reactor, interval, function, args = [], kwargs = {},
+                 policy = 'skip'):
+        if interval <= 0:
+            raise ValueError('interval must be positive')
+        if policy not in self.policies:
+            raise ValueError('policy must be one of %s' % ', '.join(
+                self.policies))
+
+        self.reactor = reactor
+        self.interval = interval
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.policy = policy
+        self.deadline = self.now() + interval
+        self.missed = 0
+        self.late = 0.0
+        self.timer = None
+        # False when the timer was cancelled
+        self.pending = True
+
+    def now(self):
+        """Return the current time of the reactor's clock."""
+        return monotonic()
+
+    def schedule(self):
+        """Arm the timer for the next deadline. Used internally."""
+        self.timer = self.reactor.add_timer(self.deadline - self.now(),
+                                            self.fire)
+
+    def fire(self):
+        """Call the function and rearm. Used internally."""
+        if not self.pending:
+            return
+
+        late = self.now() - self.deadline
+        self.late = late
+        self.missed = 0
+        if self.policy == 'burst' or late < self.interval:
+            self.deadline = self.deadline + self.interval
+        else:
+            self.missed = int(late / self.interval)
+            if self.policy == 'skip':
+                self.deadline = self.deadline + \
+                                (self.missed + 1) * self.interval
+            else:
+                self.deadline = self.deadline + late + self.interval
+
+        # rearm first, so that the function may cancel the timer
+        self.schedule()
+        self.function(*self.args, **self.kwargs)
+
+    def cancel(self):
+        """Cancel the periodic timer.
+
+        This is safe to call from any thread. Cancelling a cancelled
+        timer raises a ValueError."""
+        if not self.pending:
+            raise ValueError('periodic timer is not pending')
+
+        self.pending = False
+        try:
+            self.reactor.cancel_timer(self.timer)
+        except ValueError:
+            # expired just now - fire will ignore it
+            pass
+
+def _stats(timers):
+    """Implementation of TimerBase.stats and TimerWheel.stats."""
+    if timers.expired:
+        reduction = 1.0 - timers.wakeups / float(timers.expired)
+    else:
+        reduction = 0.0
+
+    return { 'expired': timers.expired,
+             'wakeups': timers.wakeups,
+             'wakeup_reduction': reduction }
+
 class TimerBase:
-    """Timer base class - does the housekeeping."""
+    """Timer base class - does the housekeeping.
+
+    The timers are kept in a binary heap of (absolute, sequence, timer)
+    tuples. Cancelled timers are only marked and left in the heap until they
+    bubble up to the top or until they make up more than half of the heap,
+    when the heap is compacted.
+
+    The first element of the heap is always a pending timer."""
+
+    # Do not compact tiny heaps
+    compact_threshold = 64
 
     def __init__(self):
         self.timers = []
-
-    def add(self, interval, function, args = [], kwargs={}):
+        # number of cancelled timers still in the heap
+        self.cancelled = 0
+        # number of expired timers and of get_pending calls that
+        # returned timers, see stats
+        self.expired = 0
+        self.wakeups = 0
+
+    def __len__(self):
+        return len(self.timers) - self.cancelled
+
+    def stats(self):
+        """Return a dictionary with the number of expired timers, the
+        number of wakeups that expired timers and the reduction of wakeups
+        by timers that expired together (see the slack of L{add})."""
+        return _stats(self)
+
+    def add(self, interval, function, args = [], kwargs={}, slack = 0):
         '''Add a timer after interval in seconds.
 
+        @param slack: The timer may be delayed by up to slack seconds, so
+        that it expires together with other timers.
         @return: the tuple (timer, flag). flag is True if the timer added
         is the next timer due.'''
         
-        t = Timer(interval, function, args, kwargs)
+        t = Timer(interval, function, args, kwargs, slack)
 
-        self.timers.append(t)
-        self.timers.sort()
+        heapq.heappush(self.timers, (t.absolute, t.sequence, t))
 
-        return (t, self.timers.index(t) == 0)
+        return (t, self.timers[0][2] is t)
 
     def cancel(self, timer):
         '''Cancel a timer.
@@ -47,10 +261,34 @@ class TimerBase:
 
         @return: True if the cancelled timer is the next timer due.'''
 
-        i = self.timers.index(timer)
-        del self.timers[i]
+        if not timer.pending:
+            raise ValueError('timer is not pending')
+
+        timer.pending = False
+        self.cancelled = self.cancelled + 1
+        
+        if self.timers[0][2] is timer:
+            self.discard()
+            return True
+
+        if self.cancelled > self.compact_threshold \
+               and self.cancelled * 2 > len(self.timers):
+            self.compact()
+
+        return False
+
+    def discard(self):
+        """Pop cancelled timers off the top of the heap."""
+        timers = self.timers
+        while timers and not timers[0][2].pending:
+            heapq.heappop(timers)
+            self.cancelled = self.cancelled - 1
 
-        return i == 0
+    def compact(self):
+        """Remove all cancelled timers from the heap."""
+        self.timers = [e for e in self.timers if e[2].pending]
+        heapq.heapify(self.timers)
+        self.cancelled = 0
 
     def time_to_wait(self):
         """Return the time to wait for the next timer in ms or -1
@@ -58,31 +296,219 @@ class TimerBase:
         if not self.timers:
             return -1
         
-        now = time.time()
+        now = monotonic()
         
-        t = max(0, self.timers[0].absolute - now)
+        t = max(0, self.timers[0][0] - now)
 
-        return int(t * 1000)
+        # round up, waking up early costs another wakeup
+        return int(math.ceil(t * 1000))
 
     def get_pending(self):
         """Return a list of pending timers."""
         exp = []
 
-        if self.timers:
-            now = time.time()
-            t = self.timers[0]
-            while t.absolute <= now:
-                exp.append(t)
-                del self.timers[0]
+        timers = self.timers
+        if timers:
+            now = monotonic()
+            while timers and timers[0][0] <= now:
+                t = heapq.heappop(timers)[2]
+                if t.pending:
+                    t.pending = False
+                    exp.append(t)
+                else:
+                    self.cancelled = self.cancelled - 1
 
-                if not self.timers:
-                    return exp
-                
-                t = self.timers[0]
+            self.discard()
+
+            if exp:
+                self.expired = self.expired + len(exp)
+                self.wakeups = self.wakeups + 1
 
         return exp
             
         
+class TimerWheel:
+    """A hashed hierarchical timing wheel with the interface of L{TimerBase}.
+
+    Adding, cancelling and expiring a timer is O(1), at the expense of
+    precision: timers fire on the first tick of C{resolution} seconds
+    after they are due (never early).
+
+    This is intended for large numbers of short, coarse timers like
+    inter-digit or ringing timeouts.
+
+    Each level has C{slots} buckets; a bucket on level n covers
+    C{slots ** n} ticks. Timers on higher levels are cascaded down
+    when the lower level wraps around. Timers that are due beyond the
+    range of the wheel are kept in an overflow list.
+
+    Like in L{TimerBase}, cancelled timers are only marked; they are
+    dropped when their bucket is expired or cascaded."""
+
+    def __init__(self, resolution = 0.01, bits = 8, levels = 4):
+        """Create a timing wheel.
+
+        @param resolution: The length of a tick in seconds.
+        @param bits: Each level has 2 ** bits slots.
+        @param levels: The number of levels.
+        """
+        self.resolution = resolution
+        self.bits = bits
+        self.slots = 1 << bits
+        self.mask = self.slots - 1
+        self.wheels = [[[] for i in range(self.slots)] for l in range(levels)]
+        # number of entries (including cancelled timers) on level 0
+        self.entries = 0
+        self.overflow = []
+        # the next tick to process
+        self.current = int(monotonic() / resolution)
+        # the tick the caller waits for, None if waiting forever
+        self.deadline = None
+        # number of pending timers
+        self.count = 0
+        # see TimerBase.stats
+        self.expired = 0
+        self.wakeups = 0
+
+    def __len__(self):
+        return self.count
+
+    def insert(self, t):
+        """Put a timer into its bucket. Used internally."""
+        delta = t.tick - self.current
+        if delta < 0:
+            t.tick = self.current
+            delta = 0
+
+        shift = 0
+        for wheel in self.wheels:
+            if delta < (self.slots << shift):
+                wheel[(t.tick >> shift) & self.mask].append(t)
+                if not shift:
+                    self.entries = self.entries + 1
+                return
+            shift = shift + self.bits
+
+        self.overflow.append(t)
+
+    def stats(self):
+        """See L{TimerBase.stats}."""
+        return _stats(self)
+
+    def add(self, interval, function, args = [], kwargs={}, slack = 0):
+        '''Add a timer after interval in seconds.
+
+        @param slack: See L{TimerBase.add}.
+        @return: the tuple (timer, flag). flag is True if the timer added
+        is due before the tick returned by the last L{time_to_wait}.'''
+
+        t = Timer(interval, function, args, kwargs, slack)
+        t.tick = int(math.ceil(t.absolute / self.resolution))
+
+        self.insert(t)
+        self.count = self.count + 1
+
+        return (t, self.deadline is None or t.tick < self.deadline)
+
+    def cancel(self, timer):
+        '''Cancel a timer.
+        Cancelling an expired timer raises a ValueError.
+
+        @return: True if the cancelled timer is due at the tick returned by
+        the last L{time_to_wait}.'''
+
+        if not timer.pending:
+            raise ValueError('timer is not pending')
+
+        timer.pending = False
+        self.count = self.count - 1
+
+        return timer.tick == self.deadline
+
+    def cascade(self):
+        """Move the timers from the higher levels down when level 0 wraps.
+        Used internally."""
+        shift = 0
+        for wheel in self.wheels[1:]:
+            shift = shift + self.bits
+            index = (self.current >> shift) & self.mask
+            bucket = wheel[index]
+            wheel[index] = []
+            for t in bucket:
+                if t.pending:
+                    self.insert(t)
+            if index:
+                return
+
+        # all levels wrapped: retry the overflow list
+        overflow = self.overflow
+        self.overflow = []
+        for t in overflow:
+            if t.pending:
+                self.insert(t)
+
+    def time_to_wait(self):
+        """Return the time to wait for the next timer in ms or -1
+        if no timer is present.
+
+        If level 0 is empty, this returns the time to the next cascade."""
+        if not self.count:
+            self.deadline = None
+            return -1
+
+        wheel = self.wheels[0]
+        index = self.current & self.mask
+        tick = self.current - index + self.slots
+        if self.entries:
+            for i in xrange(index, self.slots):
+                if wheel[i]:
+                    tick = self.current + i - index
+                    break
+
+        self.deadline = tick
+        t = max(0, tick * self.resolution - monotonic())
+
+        return int(math.ceil(t * 1000))
+
+    def get_pending(self):
+        """Return a list of pending timers."""
+        exp = []
+
+        now = int(monotonic() / self.resolution)
+        wheel = self.wheels[0]
+        while self.current <= now:
+            if not self.count:
+                self.current = now + 1
+                break
+
+            index = self.current & self.mask
+            if not index:
+                self.cascade()
+
+            if not self.entries:
+                # nothing on level 0 - skip to the next cascade, but not
+                # beyond now, or timers added later would fire late
+                self.current = min(self.current - index + self.slots, now + 1)
+                continue
+
+            bucket = wheel[index]
+            if bucket:
+                wheel[index] = []
+                self.entries = self.entries - len(bucket)
+                for t in bucket:
+                    if t.pending:
+                        t.pending = False
+                        self.count = self.count - 1
+                        exp.append(t)
+
+            self.current = self.current + 1
+
+        if exp:
+            self.expired = self.expired + len(exp)
+            self.wakeups = self.wakeups + 1
+
+        return exp
+
 class TimerThread(threading.Thread, TimerBase):
     """An active, standalone Timer thread that will execute the
     timers in the context of its thread.
@@ -98,11 +524,12 @@ class TimerThread(threading.Thread, TimerBase):
         self.event = threading.Event()
         self.mutex = threading.Lock()
 
-    def add(self, interval, function, args = [], kwargs={}):
+    def add(self, interval, function, args = [], kwargs={}, slack = 0):
         '''Add a timer after interval in seconds.'''
 
         with self.mutex:
-            t, adjust = TimerBase.add(self, interval, function, args, kwargs)
+            t, adjust = TimerBase.add(self, interval, function, args, kwargs,
+                                      slack)
 
         # if the new timer is the next, wake up the timer thread to readjust
         # the wait period
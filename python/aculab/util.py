@@ -12,6 +12,11 @@ lowlevel.sm_get_driver_info(_driver_info)
 TiNG_version = (_driver_info.major, _driver_info.minor)
 del _driver_info
 
+# Priority classes for reactor events, see PollReactor.add
+PRIORITY_CONTROL = 0
+PRIORITY_MEDIA = 1
+PRIORITY_BACKGROUND = 2
+
 def swig_value(s):
     a = s.find('_')
     if a != -1:
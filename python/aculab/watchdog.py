@@ -0,0 +1,132 @@
+# Copyright (C) 2009 Lars Immisch
+
+"""Watchdog for slow reactor callbacks.
+
+A single slow callback (like a synchronous lookup in a controller method)
+delays all other callbacks of the reactor, including the refills of the
+playing channels. The L{Watchdog} finds out which callback it was."""
+
+import sys
+import time
+import thread
+import threading
+import traceback
+import logging
+# local imports
+from instrument import callback_name
+
+log = logging.getLogger('watchdog')
+
+class Watchdog(threading.Thread):
+    """Watch the callbacks of a reactor and log the callback and the stack
+    of the reactor thread if a callback runs longer than a threshold.
+
+    Each slow callback is reported once. At most one report is logged per
+    interval, further reports are counted and summarized in the next
+    report.
+
+    Usage::
+
+        watchdog = Watchdog(Reactor, 0.02)
+        watchdog.start()
+    """
+
+    def __init__(self, reactor, threshold = 0.02, interval = 10.0):
+        """Create a watchdog for reactor.
+
+        @param reactor: A L{PollReactor <posixreactor.PollReactor>}.
+        @param threshold: The maximum execution time of a callback in
+        seconds.
+        @param interval: The minimum time between two log messages in
+        seconds."""
+        threading.Thread.__init__(self, name = 'watchdog')
+        self.setDaemon(1)
+        self.reactor = reactor
+        self.threshold = threshold
+        self.interval = interval
+        # (sequence, callback, start, thread id) of the running callback.
+        # Written by the reactor thread only
+        self.current = None
+        self.sequence = 0
+        self.shutdown = threading.Event()
+        # number of slow callbacks detected
+        self.detected = 0
+        self.suppressed = 0
+        self.last_log = None
+        # (name, elapsed, stack) of the last slow callback
+        self.last = None
+
+    def enter(self, callback):
+        """Called by the reactor before a callback."""
+        self.sequence += 1
+        self.current = (self.sequence, callback, time.time(),
+                        thread.get_ident())
+
+    def leave(self):
+        """Called by the reactor after a callback."""
+        self.current = None
+
+    def start(self):
+        """Attach the watchdog to the reactor and start it."""
+        self.reactor.watchdog = self
+        threading.Thread.start(self)
+
+    def stop(self):
+        """Detach the watchdog from the reactor and stop it."""
+        if self.reactor.watchdog is self:
+            self.reactor.watchdog = None
+        self.shutdown.set()
+        if self.isAlive():
+            self.join()
+
+    def check(self, reported):
+        """Check the running callback.
+
+        @param reported: The sequence number of the last reported callback.
+        @return: The sequence number of the last reported callback."""
+
+        current = self.current
+        if current is None:
+            return reported
+
+        sequence, callback, start, ident = current
+        elapsed = time.time() - start
+        if sequence == reported or elapsed < self.threshold:
+            return reported
+
+        frame = sys._current_frames().get(ident, None)
+        # the callback may have returned in the meantime
+        if frame is None or self.current is not current:
+            return reported
+
+        stack = ''.join(traceback.format_stack(frame))
+        name = callback_name(callback)
+        self.detected += 1
+        self.last = (name, elapsed, stack)
+
+        now = time.time()
+        if self.last_log is not None and now - self.last_log < self.interval:
+            self.suppressed += 1
+            return sequence
+
+        if self.suppressed:
+            log.warn('callback %s running for %.1f ms (%d more slow '
+                     'callbacks not logged), stack:\n%s', name,
+                     elapsed * 1000, self.suppressed, stack)
+        else:
+            log.warn('callback %s running for %.1f ms, stack:\n%s', name,
+                     elapsed * 1000, stack)
+
+        self.last_log = now
+        self.suppressed = 0
+
+        return sequence
+
+    def run(self):
+        reported = None
+        while not self.shutdown.isSet():
+            self.shutdown.wait(self.threshold / 2)
+            try:
+                reported = self.check(reported)
+            except:
+                log.error('error in Watchdog', exc_info=1)
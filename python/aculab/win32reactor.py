@@ -10,19 +10,25 @@ import logging
 import win32api
 import win32event
 import time
+from collections import deque
 # local imports
-from timer import TimerBase
+from timer import TimerBase, Periodic
+from util import PRIORITY_MEDIA
+from executor import run_in_executor
 
 log = logging.getLogger('reactor')
 
-def add_event(reactor, event, method):
+def add_event(reactor, event, method, edge = False,
+              priority = PRIORITY_MEDIA):
     """Add an event to a reactor.
 
     @param reactor: The reactor to add the event to
     @param event: A C{tSMEventId} structure.
+    @param edge: Ignored on Windows.
+    @param priority: Ignored on Windows.
     @return: a OS dependent value that can be used for reactor.remove()
     """
-    reactor.add(event, method)
+    reactor.add(event, method, priority)
     return event
 
 def remove_event(reactor, event):
@@ -142,16 +148,24 @@ class Win32Reactor(threading.Thread):
         self.queue = []
         self.wakeup = win32event.CreateEvent(None, 0, 0, None)
         self.timer = TimerBase()
+        # functions queued by signal handlers, without the mutex
+        self.signalled = deque()
+        # the thread running the reactor loop, if any
+        self.thread = None
 
-    def add_timer(self, interval, function, args = [], kwargs={}):
-        '''Add a timer after interval in seconds.'''
+    def add_timer(self, interval, function, args = [], kwargs={}, slack = 0):
+        '''Add a timer after interval in seconds.
+
+        @param slack: The timer may be delayed by up to slack seconds, so
+        that it expires in the same wakeup as other timers.'''
 
         with self.mutex:
-            t, adjust = self.timer.add(interval, function, args, kwargs)
+            t, adjust = self.timer.add(interval, function, args, kwargs,
+                                       slack)
 
         # if the new timer is the next, wake up the timer thread to readjust
         # the wait period
-        if adjust and threading.currentThread() != self and self.isAlive():
+        if adjust and self.is_foreign():
             win32event.SetEvent(self.wakeup)
 
         return t
@@ -162,9 +176,69 @@ class Win32Reactor(threading.Thread):
         with self.mutex:
             adjust = self.timer.cancel(timer)
         
-        if adjust and threading.currentThread() != self and self.isAlive():
+        if adjust and self.is_foreign():
             win32event.SetEvent(self.wakeup)
 
+    def add_periodic(self, interval, function, args = [], kwargs = {},
+                     policy = 'skip'):
+        """Call function every interval seconds, until the returned
+        L{Periodic <timer.Periodic>} is cancelled.
+
+        @param policy: What to do when the reactor falls behind by one or
+        more intervals: C{'skip'}, C{'burst'} or C{'coalesce'}. See
+        L{Periodic <timer.Periodic>}."""
+
+        p = Periodic(self, interval, function, args, kwargs, policy)
+        p.schedule()
+
+        return p
+
+    def call_soon(self, function, *args):
+        """Call function from the reactor loop as soon as possible.
+
+        This is safe to call from any thread. All functions queued before
+        the reactor wakes up are called in one batch, in order."""
+
+        with self.mutex:
+            self.enqueue(lambda: function(*args))
+
+    def call_from_signal(self, function, *args):
+        """Call function from the reactor loop as soon as possible.
+
+        This is safe to call from a signal handler: it does not take the
+        mutex, which the interrupted main thread may hold."""
+
+        # deque.append is atomic
+        self.signalled.append(lambda: function(*args))
+        win32event.SetEvent(self.wakeup)
+
+    def call_from_thread(self, function, *args):
+        """Call function in the reactor thread.
+
+        Worker threads use this to hand results back to calls and channels.
+        From the reactor thread itself, function is called immediately."""
+
+        if self.is_foreign():
+            self.call_soon(function, *args)
+        else:
+            function(*args)
+
+    def run_in_executor(self, function, *args, **kwargs):
+        """Call function(*args) in a worker thread, without blocking the
+        reactor.
+
+        @param callback: Keyword argument. Called in the reactor thread as
+        C{callback(result, exception)} when function has returned.
+        @param executor: Keyword argument. The L{WorkerPool
+        <executor.WorkerPool>}. The default is the pool shared by all
+        reactors."""
+        run_in_executor(self, function, args, kwargs)
+
+    def is_foreign(self):
+        """Return True if the reactor loop is running in another thread."""
+        thread = self.thread
+        return thread is not None and thread != threading.currentThread()
+
     def enqueue(self, m):
         """Internal for Win32ReactorThread:
         Queue a callback and signal the internal event.
@@ -175,11 +249,13 @@ class Win32Reactor(threading.Thread):
         self.queue.append(m)
         win32event.SetEvent(self.wakeup)
 
-    def add(self, event, method):
+    def add(self, event, method, priority = PRIORITY_MEDIA):
         """Add a new handle to the reactor.
 
         @param event: The event to watch.
-        @param method: This will be called when the event is fired."""
+        @param method: This will be called when the event is fired.
+        @param priority: Ignored. The callbacks are dispatched in the order
+        in which the worker threads see the events."""
 
         # log.debug('adding: %s', event)
         with self.mutex:
@@ -236,12 +312,22 @@ class Win32Reactor(threading.Thread):
     def start(self):
         """Start the reactor in a new thread."""
 
+        self.thread = self
         threading.Thread.start(self)
         self.start_workers()
 
     def run(self):
         """Run the reactor in the current thread."""
-        
+
+        self.thread = threading.currentThread()
+        try:
+            self.loop()
+        finally:
+            self.thread = None
+
+    def loop(self):
+        """The reactor loop. Used internally."""
+
         with self.mutex:
             self.start_workers()
             wait = self.timer.time_to_wait()
@@ -265,6 +351,9 @@ class Win32Reactor(threading.Thread):
                 timers = self.timer.get_pending()
                 wait = self.timer.time_to_wait()
 
+            while self.signalled:
+                todo.append(self.signalled.popleft())
+
             try:
                 for m in todo:
                     m()
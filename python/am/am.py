@@ -10,8 +10,11 @@ import logging
 import aculab
 from aculab.error import AculabError
 from aculab.callcontrol import Call
-from aculab.speech import SpeechChannel, PlayJob, RecordJob, Glue
+from aculab.speech import SpeechChannel, PlaylistJob, RecordJob, Glue, \
+     prompt_cache
+from aculab.manifest import scan, preload
 from aculab.reactor import Reactor
+from aculab.drain import drain_on_signal
 from aculab.switching import DefaultBus, connect
 import aculab.lowlevel as lowlevel
 from mail import AsyncEmail
@@ -21,6 +24,10 @@ from slim import async_cli_display
 # the call
 wait_accept = 20.0
 
+# the prompts in root
+jingle = '4011_suonho_sweetchoff_iLLCommunications_suonho.al'
+prompts = [jingle, 'default.al', 'beep.al']
+
 # application map
 portmap = { '41': 'am', '42': 'am', '43': 8, '44': 8,
             '45': 9, '46': 9, '47': 1, '48': 1 }
@@ -47,17 +54,14 @@ class AnsweringMachine(Glue):
         self.speech.listen_for()
         
         f = os.path.join(root, '%s.al' % self.call.details.destination_addr)
-        if os.path.exists(f):
-            announce = PlayJob(self.speech, f)
-        else:
-            announce = PlayJob(self.speech, os.path.join(root, 'default.al'))
+        if not os.path.exists(f):
+            f = os.path.join(root, 'default.al')
+
+        # jingle, announcement and beep without gaps
+        playlist = [os.path.join(root, jingle), f,
+                    os.path.join(root, 'beep.al')]
             
-        self.jobs = [PlayJob(self.speech,
-                             os.path.join(root,
-                                          '4011_suonho_sweetchoff_' \
-                                          'iLLCommunications_suonho.al')),
-                     announce,
-                     PlayJob(self.speech, os.path.join(root, 'beep.al')),
+        self.jobs = [PlaylistJob(self.speech, playlist, cache = prompt_cache),
                      RecordJob(self.speech, os.tmpfile(), max_silence=4.0)]
 
         self.speech.start(self.jobs[0])
@@ -285,7 +289,7 @@ class IncomingCallController(object):
 
         if portmap.get(call.details.destination_addr, None) == 'am':
             if cli:
-                async_cli_display(cli)
+                async_cli_display(cli, call.reactor)
 
             # Let AMController take over.
             log.debug('starting timer for answering machine')
@@ -357,6 +361,10 @@ if __name__ == '__main__':
     log.info('answering machine starting (bus: %s)',
              bus.__class__.__name__)
 
+    # load the prompts before the first call, fail if one is missing
+    preload(scan(root, False) + [os.path.join(root, p) for p in prompts],
+            strict = True)
+
     if forwarding:
         bri_ts = (1, 2)
 
@@ -372,6 +380,9 @@ if __name__ == '__main__':
     else:
         calls = [Call(controller, card=card, port=port)]
 
+    # on SIGTERM, let the recordings finish before exiting
+    drain_on_signal(Reactor)
+
     try:
         Reactor.run()
     except:
@@ -3,7 +3,6 @@
 import sys
 import logging
 import time
-import threading
 import smtplib
 import traceback
 import email.Utils
@@ -19,15 +18,13 @@ smtp_from = 'am@ibp.de'
 
 log = logging.getLogger('mail')
 
-class AsyncEmail(threading.Thread):
+class AsyncEmail(object):
 
     def __init__(self, file, call, cli = None):
-        """Initialize a thread that will send an email with 'file' as an
-        attachement. The 'call' will be disconnected when the email has been
-        sent. 'cli' is overwritten unless 'call' is None; this is intended for
-        testing."""
+        """Prepare an email with 'file' as an attachement. The 'call' will be
+        disconnected when the email has been sent. 'cli' is overwritten unless
+        'call' is None; this is intended for testing."""
         
-        super(self.__class__, self).__init__(name= 'email')
         self.file = file
         self.call = call
         if self.call:
@@ -35,7 +32,9 @@ class AsyncEmail(threading.Thread):
         else:
             self.cli = cli
 
-        self.setDaemon(1)
+    def start(self):
+        """Send the email in the worker pool of the reactor of the call."""
+        self.call.reactor.run_in_executor(self.run)
 
     def name_lookup(self, subject, txt):
         try:
@@ -102,8 +101,8 @@ class AsyncEmail(threading.Thread):
                 self.file = None
 
             if self.call:
-                # disconnect the call
-                self.call.disconnect()
+                # disconnect the call from the reactor thread
+                self.call.reactor.call_from_thread(self.call.disconnect)
                 self.call = None
         
             smtp = smtplib.SMTP(smtp_server)
@@ -145,5 +144,4 @@ if __name__ == '__main__':
         cli = args[0]
 
     a = AsyncEmail(None, None, cli)
-    a.start()
-    a.join()
+    a.run()
@@ -1,6 +1,5 @@
 import urllib
 import logging
-import threading
 
 log = logging.getLogger('slim')
 
@@ -39,16 +38,12 @@ def cli_display(cli):
     for p in players:
         slim_display(line1, line2, 20, p)
 
-def async_cli_display(cli):
-    t = threading.Thread(target=cli_display, name='slim display', args=(cli,))
-    t.setDaemon(1)
-    t.start()
-    return t
+def async_cli_display(cli, reactor):
+    reactor.run_in_executor(cli_display, cli)
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG,
                         format='%(asctime)s %(levelname)s %(message)s')
     
-    t = async_cli_display('01772706491')
-    t.join()
+    cli_display('01772706491')
     
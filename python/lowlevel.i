@@ -181,6 +181,14 @@ BLOCKING(smfax_negotiate)
 BLOCKING(smfax_rx_page)
 BLOCKING(smfax_tx_page)
 BLOCKING(sm_t38gw_worker_fn)
+/* The driver calls on the media path. Releasing the GIL lets the
+   reactors of a ReactorGroup dispatch in parallel. */
+BLOCKING(sm_replay_status)
+BLOCKING(sm_put_replay_data)
+BLOCKING(sm_put_last_replay_data)
+BLOCKING(sm_record_status)
+BLOCKING(sm_get_recorded_data)
+BLOCKING(sm_get_recognised)
 
 /* Functions that are in Aculab's headers, but not implemented.
 
@@ -502,6 +510,53 @@ GET_SET_DATA(NON_STANDARD_DATA_XPARMS, MAXRAWDATA)
 		return PyInt_FromLong(rc);
 	}
 
+	/* Pass length bytes at offset of a buffer object (e.g. an mmap) to
+	   sm_put_replay_data or, if last is nonzero, sm_put_last_replay_data.
+	   The data is not copied into this structure.
+
+	   self->data points into the buffer only while the driver copies from
+	   it. The GIL is held throughout (do not release it here), so another
+	   thread cannot close or resize the buffer in the meantime. */
+	PyObject *put_replay_buffer(PyObject *o, int offset, int length,
+								int last)
+	{
+		const void *buffer;
+		Py_ssize_t size;
+		char *data;
+		int rc;
+
+		Py_INCREF(o);
+		if (PyObject_AsReadBuffer(o, &buffer, &size) < 0)
+		{
+			Py_DECREF(o);
+			return NULL;
+		}
+
+		/* offset + length may overflow */
+		if (offset < 0 || length < 0 || (Py_ssize_t)offset > size
+			|| (Py_ssize_t)length > size - (Py_ssize_t)offset)
+		{
+			Py_DECREF(o);
+	    	PyErr_SetString(PyExc_ValueError,
+							"offset and length exceed the buffer");
+			return NULL;
+		}
+
+		data = self->data;
+		self->data = (char*)buffer + offset;
+		self->length = length;
+
+		if (last)
+			rc = sm_put_last_replay_data(self);
+		else
+			rc = sm_put_replay_data(self);
+
+		self->data = data;
+		Py_DECREF(o);
+
+		return PyInt_FromLong(rc);
+	}
+
 	PyObject *getdata() {
 		return PyBuffer_FromMemory(self->data, self->length);
 	}
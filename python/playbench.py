@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2009 Lars Immisch
+
+"""Benchmark the play paths for many simultaneous plays of one prompt.
+
+No Aculab hardware is needed: a bytearray per channel stands in for the
+replay buffer of the driver, which copies the data it is given.
+
+ - file: the path of L{PlayJob <aculab.speech.PlayJob>}. Every channel
+   opens the prompt and reads each chunk with C{fread} into its own
+   C{SM_TS_DATA_PARMS} buffer, which is then copied by the driver.
+ - mmap: the path of L{MappedPlayJob <aculab.speech.MappedPlayJob>}. All
+   channels share one L{MappedFile <aculab.speech.MappedFile>} and the
+   driver copies each chunk directly from the mapping.
+
+The read system calls are counted from C{/proc/self/io} (Linux only).
+"""
+
+import os
+import sys
+import time
+import resource
+import tempfile
+import optparse
+from aculab.speech import MappedFile
+
+# kSMMaxReplayDataBufferSize
+CHUNK = 4096
+
+def read_syscalls():
+    """Return the number of read system calls of the process, or None."""
+    try:
+        for line in file('/proc/self/io'):
+            if line.startswith('syscr:'):
+                return int(line.split()[1])
+    except IOError:
+        return None
+
+def read_overhead():
+    """Return the read system calls of read_syscalls itself."""
+    before = read_syscalls()
+    if before is None:
+        return 0
+    return read_syscalls() - before
+
+# computed in main
+overhead = 0
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+def play_file(name, channels):
+    """Play the prompt on all channels with a file per channel."""
+    files = [file(name, 'rb') for i in range(channels)]
+    buffers = [bytearray(CHUNK) for i in range(channels)]
+    drivers = [bytearray(CHUNK) for i in range(channels)]
+    active = range(channels)
+    while active:
+        remaining = []
+        for i in active:
+            # sm_ts_data_parms.read: fread into the parms buffer
+            l = files[i].readinto(buffers[i])
+            # sm_put_replay_data: the driver copies the buffer
+            drivers[i][:l] = buffer(buffers[i], 0, l)
+            if l == CHUNK:
+                remaining.append(i)
+        active = remaining
+
+    for f in files:
+        f.close()
+
+def play_mmap(name, channels):
+    """Play the prompt on all channels from one mapping."""
+    prompt = MappedFile(name)
+    drivers = [bytearray(CHUNK) for i in range(channels)]
+    offsets = [0] * channels
+    active = range(channels)
+    while active:
+        remaining = []
+        for i in active:
+            offset = offsets[i]
+            l = max(min(CHUNK, prompt.length - offset), 0)
+            # put_replay_buffer: the driver copies from the mapping
+            drivers[i][:l] = buffer(prompt.data, offset, l)
+            offsets[i] = offset + l
+            if l == CHUNK:
+                remaining.append(i)
+        active = remaining
+
+    prompt.close()
+
+def bench(function, name, channels):
+    """Run function and return wall time, CPU time and read syscalls."""
+    syscalls = read_syscalls()
+    cpu = cpu_time()
+    start = time.time()
+    function(name, channels)
+    elapsed = time.time() - start
+    cpu = cpu_time() - cpu
+    if syscalls is not None:
+        # reading /proc/self/io takes read syscalls, too
+        syscalls = read_syscalls() - syscalls - overhead
+
+    return elapsed, cpu, syscalls
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options]',
+                                   description='Benchmark the play paths.')
+    parser.add_option('-c', '--channels', type='int', default=500,
+                      help='Number of simultaneous plays. Default is 500.')
+    parser.add_option('-s', '--seconds', type='float', default=30.0,
+                      help='Length of the prompt in seconds (A-law). '
+                      'Default is 30.')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='Repeat each benchmark REPEAT times and report '
+                      'the best. Default is 3.')
+
+    options, args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < options.channels + 64:
+        resource.setrlimit(resource.RLIMIT_NOFILE,
+                           (min(options.channels + 64, hard), hard))
+
+    overhead = read_overhead()
+
+    fd, name = tempfile.mkstemp(suffix = '.al')
+    try:
+        os.write(fd, os.urandom(int(options.seconds * 8000)))
+        os.close(fd)
+
+        print 'play: %d channels, %.0fs prompt (%d chunks of %d bytes)' % \
+              (options.channels, options.seconds,
+               int(options.seconds * 8000 + CHUNK - 1) / CHUNK, CHUNK)
+        for path, function, fds in (('file', play_file, options.channels),
+                                    ('mmap', play_mmap, 1)):
+            results = [bench(function, name, options.channels)
+                       for i in range(options.repeat)]
+            elapsed, cpu, syscalls = min(results)
+            if syscalls is None:
+                syscalls = 'n/a'
+            print '%-6s %.3fs wall %.3fs cpu %6s read syscalls %4d fds' % \
+                  (path, elapsed, cpu, syscalls, fds)
+    finally:
+        os.unlink(name)
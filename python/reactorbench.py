@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2009 Lars Immisch
+
+"""Benchmarks for the reactor implementations.
+
+Pipes stand in for the driver event fds, so no Aculab hardware is needed.
+
+ - dispatch: register many idle pipes and a small active subset and
+   measure the cost of dispatching events on the active pipes.
+ - churn: add and remove many pipes from a foreign thread while the
+   reactor is running.
+ - contention: dispatch events on many active pipes while a foreign
+   thread keeps adding and cancelling timers.
+ - priority: measure the latency of a call control event while many
+   media pipes are busy, with and without PRIORITY_CONTROL.
+ - handoff: push call events from a thread through the v5
+   CallEventThread to the reactor at a fixed rate.
+"""
+
+import sys
+import os
+import time
+import select
+import threading
+import resource
+import optparse
+import random
+from collections import deque
+from aculab.posixreactor import PollReactor, EpollReactor
+from aculab.util import PRIORITY_CONTROL, PRIORITY_MEDIA
+from aculab.instrument import Histogram
+from aculab.reactor import CallEventThread
+import aculab.lowlevel as lowlevel
+
+def raise_fd_limit(count):
+    """Raise the soft limit for file descriptors to at least count."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < count:
+        if hard != resource.RLIM_INFINITY and hard < count:
+            raise RuntimeError('need %d file descriptors, hard limit is %d'
+                               % (count, hard))
+        resource.setrlimit(resource.RLIMIT_NOFILE, (count, hard))
+
+def create_pipes(count):
+    pipes = [os.pipe() for i in range(count)]
+    return pipes
+
+def close_pipes(pipes):
+    for r, w in pipes:
+        os.close(r)
+        os.close(w)
+
+class Echo:
+    """Read a byte from a pipe and write it back, count the events and
+    stop the reactor after a number of events."""
+
+    def __init__(self, counter, fds):
+        self.counter = counter
+        self.r, self.w = fds
+
+    def __call__(self):
+        os.read(self.r, 1)
+        os.write(self.w, 'x')
+        self.counter.count = self.counter.count + 1
+        if self.counter.count >= self.counter.limit:
+            raise StopIteration
+
+class Counter:
+    def __init__(self, limit):
+        self.count = 0
+        self.limit = limit
+
+def bench_dispatch(reactor, registered, active, events, edge = False):
+    """Register registered pipes, with active pipes that are always ready.
+
+    @return: the time in seconds to dispatch events events."""
+
+    pipes = create_pipes(registered)
+    counter = Counter(events)
+
+    try:
+        for i, fds in enumerate(pipes):
+            if i < active:
+                reactor.add(fds[0], select.POLLIN, Echo(counter, fds), edge)
+                os.write(fds[1], 'x')
+            else:
+                reactor.add(fds[0], select.POLLIN, Echo(counter, fds))
+
+        start = time.time()
+        reactor.run()
+        elapsed = time.time() - start
+
+        for r, w in pipes:
+            reactor.remove(r)
+    finally:
+        close_pipes(pipes)
+
+    return elapsed
+
+def nop():
+    pass
+
+class Hammer(threading.Thread):
+    """Add and cancel timers in reactor until stopped."""
+
+    def __init__(self, reactor):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.reactor = reactor
+        self.running = True
+        self.count = 0
+
+    def run(self):
+        while self.running:
+            t = self.reactor.add_timer(3600.0, nop)
+            self.reactor.cancel_timer(t)
+            self.count = self.count + 1
+
+def bench_contention(reactor, active, events):
+    """Dispatch events on active pipes while a L{Hammer} adds and cancels
+    timers.
+
+    @return: a tuple (elapsed time in seconds, timers added)."""
+
+    pipes = create_pipes(active)
+    counter = Counter(events)
+    hammer = Hammer(reactor)
+
+    try:
+        for fds in pipes:
+            reactor.add(fds[0], select.POLLIN, Echo(counter, fds))
+            os.write(fds[1], 'x')
+
+        hammer.start()
+        start = time.time()
+        reactor.run()
+        elapsed = time.time() - start
+        hammer.running = False
+        hammer.join()
+
+        for r, w in pipes:
+            reactor.remove(r)
+    finally:
+        close_pipes(pipes)
+
+    return elapsed, hammer.count
+
+class Media:
+    """An always ready pipe with a callback that takes work seconds, like
+    a play buffer refill."""
+
+    def __init__(self, fds, work):
+        self.r, self.w = fds
+        self.work = work
+
+    def __call__(self):
+        os.read(self.r, 1)
+        os.write(self.w, 'x')
+        end = time.time() + self.work
+        while time.time() < end:
+            pass
+
+class Control:
+    """Record the latency of events written by a L{Signaller}."""
+
+    def __init__(self, fds, samples):
+        self.r, self.w = fds
+        self.samples = samples
+        self.sent = []
+        self.latency = Histogram()
+        self.done = threading.Event()
+
+    def __call__(self):
+        os.read(self.r, 1)
+        self.latency.add((time.time() - self.sent.pop(0)) * 1e6)
+        self.done.set()
+        if self.latency.count >= self.samples:
+            raise StopIteration
+
+class Signaller(threading.Thread):
+    """Write call control events at random intervals."""
+
+    def __init__(self, control):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.control = control
+
+    def run(self):
+        c = self.control
+        for i in range(c.samples):
+            time.sleep(random.uniform(0.001, 0.005))
+            c.done.clear()
+            c.sent.append(time.time())
+            os.write(c.w, 'x')
+            c.done.wait()
+
+def bench_priority(reactor, media, samples, priority, work = 0.00002):
+    """Measure the latency of a control event while media pipes are busy.
+
+    @return: a L{Histogram} of the latency in microseconds."""
+
+    pipes = create_pipes(media + 1)
+    # the control pipe has the highest fd, so poll returns it last
+    control = Control(pipes[-1], samples)
+
+    try:
+        for fds in pipes[:-1]:
+            reactor.add(fds[0], select.POLLIN, Media(fds, work))
+            os.write(fds[1], 'x')
+        reactor.add(control.r, select.POLLIN, control, priority = priority)
+
+        Signaller(control).start()
+        reactor.run()
+
+        for r, w in pipes:
+            reactor.remove(r)
+    finally:
+        close_pipes(pipes)
+
+    return control.latency
+
+def bench_churn(reactor, count):
+    """Add and remove count pipes from a foreign thread while reactor
+    is running.
+
+    @return: the time in seconds until the reactor has applied all
+    adds and removes."""
+
+    pipes = create_pipes(count)
+    done = threading.Event()
+
+    def stop():
+        done.set()
+        raise StopIteration
+
+    try:
+        reactor.start()
+
+        start = time.time()
+        for r, w in pipes:
+            reactor.add(r, select.POLLIN, stop)
+        for r, w in pipes:
+            reactor.remove(r)
+        # the timer runs after the queued operations have been applied
+        reactor.add_timer(0.0, stop)
+        done.wait()
+        elapsed = time.time() - start
+
+        reactor.join()
+    finally:
+        close_pipes(pipes)
+
+    return elapsed
+
+class FakeEvent:
+    """A call event without the driver."""
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.state = lowlevel.EV_DETAILS
+
+class FakeCall:
+    """A call that records the latency of its events. The producer appends
+    the send time of each event to sent."""
+
+    def __init__(self, handle, counter, latency):
+        self.handle = handle
+        self.name = 'cc-%04x' % handle
+        self.controllers = [None]
+        self.user_data = None
+        self.counter = counter
+        self.latency = latency
+        self.sent = deque()
+
+    def ev_details(self):
+        self.latency.add((time.time() - self.sent.popleft()) * 1e6)
+        self.counter.count = self.counter.count + 1
+        if self.counter.count >= self.counter.limit:
+            raise StopIteration
+
+class Producer(threading.Thread):
+    """Push events for calls at rate events per second, in batches
+    every millisecond, like the call_event loop of the CallEventThread."""
+
+    def __init__(self, thread, calls, rate, events):
+        threading.Thread.__init__(self)
+        self.setDaemon(1)
+        self.thread = thread
+        self.calls = calls
+        self.rate = rate
+        self.events = events
+
+    def run(self):
+        start = time.time()
+        sent = 0
+        while sent < self.events:
+            due = min(int((time.time() - start) * self.rate) + 1,
+                      self.events)
+            while sent < due:
+                call = self.calls[sent % len(self.calls)]
+                call.sent.append(time.time())
+                self.thread.enqueue(FakeEvent(call.handle))
+                sent = sent + 1
+            time.sleep(0.001)
+
+def bench_handoff(reactor, calls, rate, events):
+    """Push events at rate events per second through a CallEventThread
+    to reactor. The thread itself is not started, the L{Producer} stands
+    in for it.
+
+    @return: a tuple (elapsed time in seconds, wakeups, L{Histogram} of the
+    latency in microseconds)."""
+
+    thread = CallEventThread()
+    counter = Counter(events)
+    latency = Histogram()
+
+    fakes = [FakeCall(i + 1, counter, latency) for i in range(calls)]
+    for c in fakes:
+        thread.add(reactor, c)
+
+    start = time.time()
+    Producer(thread, fakes, rate, events).start()
+    reactor.run()
+    elapsed = time.time() - start
+
+    wakeups = sum([q.wakeups for q in thread.queues.values()])
+
+    return elapsed, wakeups, latency
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options]',
+                                   description='Benchmark the reactors.')
+    parser.add_option('-n', '--registered', type='int', default=3000,
+                      help='Register REGISTERED pipes. Default is 3000.')
+    parser.add_option('-a', '--active', type='int', default=10,
+                      help='Number of active pipes. Default is 10.')
+    parser.add_option('-e', '--events', type='int', default=100000,
+                      help='Dispatch EVENTS events. Default is 100000.')
+    parser.add_option('-c', '--churn', type='int', default=5000,
+                      help='Add and remove CHURN pipes from a foreign '
+                      'thread. Default is 5000.')
+    parser.add_option('-t', '--contention', type='int', default=1000,
+                      help='Number of active pipes while a foreign thread '
+                      'adds timers. Default is 1000.')
+    parser.add_option('-m', '--media', type='int', default=200,
+                      help='Number of busy media pipes for the priority '
+                      'benchmark. Default is 200.')
+    parser.add_option('-r', '--rate', type='int', default=50000,
+                      help='Call events per second for the handoff '
+                      'benchmark. Default is 50000.')
+
+    options, args = parser.parse_args()
+
+    raise_fd_limit(max(options.registered, options.churn,
+                       options.contention) * 2 + 64)
+
+    reactors = [('poll', PollReactor, {}, False),
+                ('epoll', EpollReactor, {}, False),
+                ('epoll-et', EpollReactor, { 'edge_triggered': True }, True)]
+
+    print 'dispatch: %d registered, %d active, %d events' % \
+          (options.registered, options.active, options.events)
+    for name, factory, kwargs, edge in reactors:
+        elapsed = bench_dispatch(factory(**kwargs), options.registered,
+                                 options.active, options.events, edge)
+        print '%-10s %.3fs %8.2f us/event %10.0f events/s' % \
+              (name, elapsed, elapsed * 1e6 / options.events,
+               options.events / elapsed)
+
+    print 'churn: %d pipes added and removed from a foreign thread' % \
+          options.churn
+    for name, factory, kwargs, edge in reactors:
+        elapsed = bench_churn(factory(**kwargs), options.churn)
+        print '%-10s %.3fs %8.2f us/operation' % \
+              (name, elapsed, elapsed * 1e6 / (options.churn * 2))
+
+    print 'contention: %d active pipes, %d events, timers added from a ' \
+          'foreign thread' % (options.contention, options.events)
+    for name, factory, kwargs, edge in reactors:
+        elapsed, timers = bench_contention(factory(**kwargs),
+                                           options.contention, options.events)
+        print '%-10s %.3fs %8.2f us/event %10.0f timers/s' % \
+              (name, elapsed, elapsed * 1e6 / options.events,
+               timers / elapsed)
+
+    print 'priority: call control latency with %d busy media pipes' % \
+          options.media
+    for name, factory, kwargs, edge in reactors:
+        for pname, priority in (('media', PRIORITY_MEDIA),
+                                ('control', PRIORITY_CONTROL)):
+            h = bench_priority(factory(**kwargs), options.media, 200, priority)
+            print '%-10s %-8s p50 %6d us  p99 %6d us  max %6d us' % \
+                  (name, pname, h.percentile(50), h.percentile(99), h.max)
+
+    print 'handoff: %d call events/s from a call event thread' % options.rate
+    for name, factory, kwargs, edge in reactors:
+        elapsed, wakeups, h = bench_handoff(factory(**kwargs), 100,
+                                            options.rate, options.rate * 2)
+        print '%-10s %10.0f events/s %6.1f events/wakeup  p50 %6d us  ' \
+              'p99 %6d us' % (name, options.rate * 2 / elapsed,
+                               options.rate * 2.0 / wakeups,
+                               h.percentile(50), h.percentile(99))
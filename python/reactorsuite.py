@@ -0,0 +1,561 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2009 Lars Immisch
+
+"""Conformance and throughput suite for the reactor implementations.
+
+The reactors are only used through their public API (add, remove,
+add_timer, cancel_timer, run and StopIteration to stop), with pipes and
+socketpairs standing in for the driver fds. No Aculab hardware is needed.
+
+ - conformance: correctness cases, like removing an fd in its own
+   callback.
+ - throughput: events per second with 100, 1000 and 10000 registered
+   fds.
+ - churn: add and remove pipes from several foreign threads.
+ - timers: the lateness of timers, as percentiles.
+
+The results are printed as JSON, so they can be compared across releases.
+The exit status is 1 if a conformance case failed.
+"""
+
+import sys
+import os
+import time
+import socket
+import select
+import random
+import platform
+import threading
+import resource
+import optparse
+try:
+    import json
+except ImportError:
+    import simplejson as json
+from aculab.posixreactor import PollReactor, EpollReactor
+from aculab.instrument import Histogram
+
+def raise_fd_limit(count):
+    """Raise the soft limit for file descriptors to count, or to the hard
+    limit if that is lower.
+
+    @return: the new soft limit."""
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < count:
+        if hard != resource.RLIM_INFINITY and hard < count:
+            count = hard
+        resource.setrlimit(resource.RLIMIT_NOFILE, (count, hard))
+        return count
+
+    return soft
+
+def create_pipes(count):
+    return [os.pipe() for i in range(count)]
+
+def close_pipes(pipes):
+    for r, w in pipes:
+        os.close(r)
+        os.close(w)
+
+class Failed(Exception):
+    pass
+
+def check(condition, message):
+    if not condition:
+        raise Failed(message)
+
+def stop():
+    raise StopIteration
+
+def run(reactor, timeout = 2.0):
+    """Run reactor until a callback raises StopIteration. Fail if that
+    takes longer than timeout seconds."""
+    expired = []
+
+    def watchdog():
+        expired.append(True)
+        raise StopIteration
+
+    t = reactor.add_timer(timeout, watchdog)
+    reactor.run()
+    check(not expired, 'reactor did not stop within %.1fs' % timeout)
+    reactor.cancel_timer(t)
+
+# Conformance cases. Each case gets a new reactor and raises Failed
+
+def case_stop_from_timer(reactor):
+    """StopIteration in a timer stops the reactor."""
+    reactor.add_timer(0.01, stop)
+    run(reactor)
+
+def case_event(reactor):
+    """A readable pipe is dispatched."""
+    pipes = create_pipes(1)
+    r, w = pipes[0]
+    called = []
+
+    def read():
+        os.read(r, 1)
+        called.append(True)
+        raise StopIteration
+
+    try:
+        reactor.add(r, select.POLLIN, read)
+        os.write(w, 'x')
+        run(reactor)
+        reactor.remove(r)
+    finally:
+        close_pipes(pipes)
+
+    check(called == [True], 'callback called %d times' % len(called))
+
+def case_remove_in_own_callback(reactor):
+    """An fd that removes itself in its callback is not dispatched again,
+    although it is still readable."""
+    pipes = create_pipes(1)
+    r, w = pipes[0]
+    called = []
+
+    def once():
+        called.append(True)
+        reactor.remove(r)
+        reactor.add_timer(0.05, stop)
+
+    try:
+        reactor.add(r, select.POLLIN, once)
+        os.write(w, 'x')
+        run(reactor)
+    finally:
+        close_pipes(pipes)
+
+    check(len(called) == 1, 'callback called %d times' % len(called))
+
+def case_remove_other_in_callback(reactor):
+    """An fd removed by the callback of another fd in the same batch is not
+    dispatched."""
+    pipes = create_pipes(2)
+    called = []
+
+    def event(mine, other):
+        def method():
+            called.append(mine)
+            reactor.remove(other)
+            reactor.remove(mine)
+            reactor.add_timer(0.05, stop)
+        return method
+
+    try:
+        (r1, w1), (r2, w2) = pipes
+        reactor.add(r1, select.POLLIN, event(r1, r2))
+        reactor.add(r2, select.POLLIN, event(r2, r1))
+        os.write(w1, 'x')
+        os.write(w2, 'x')
+        run(reactor)
+    finally:
+        close_pipes(pipes)
+
+    check(len(called) == 1, 'callbacks called %d times' % len(called))
+
+def case_readd_in_callback(reactor):
+    """An fd removed and added again with a new method in its callback
+    dispatches to the new method."""
+    pipes = create_pipes(1)
+    r, w = pipes[0]
+    called = []
+
+    def first():
+        called.append('first')
+        reactor.remove(r)
+        reactor.add(r, select.POLLIN, second)
+
+    def second():
+        os.read(r, 1)
+        called.append('second')
+        reactor.remove(r)
+        raise StopIteration
+
+    try:
+        reactor.add(r, select.POLLIN, first)
+        os.write(w, 'x')
+        run(reactor)
+    finally:
+        close_pipes(pipes)
+
+    check(called == ['first', 'second'], 'called %s' % called)
+
+def case_socketpair_writable(reactor):
+    """A connected socket is writable (POLLOUT)."""
+    a, b = socket.socketpair()
+    called = []
+
+    def writable():
+        called.append(True)
+        reactor.remove(a.fileno())
+        raise StopIteration
+
+    try:
+        reactor.add(a.fileno(), select.POLLOUT, writable)
+        run(reactor)
+    finally:
+        a.close()
+        b.close()
+
+    check(called == [True], 'callback called %d times' % len(called))
+
+def case_socketpair_hangup(reactor):
+    """Closing the peer of a socket dispatches an event for the socket."""
+    a, b = socket.socketpair()
+    called = []
+
+    def hangup():
+        called.append(a.recv(1))
+        reactor.remove(a.fileno())
+        raise StopIteration
+
+    try:
+        reactor.add(a.fileno(), select.POLLIN, hangup)
+        b.close()
+        run(reactor)
+    finally:
+        a.close()
+
+    check(called == [''], 'called %s' % called)
+
+def case_add_from_foreign_thread(reactor):
+    """An fd added from a foreign thread is dispatched."""
+    pipes = create_pipes(1)
+    r, w = pipes[0]
+    called = []
+
+    def read():
+        os.read(r, 1)
+        called.append(True)
+        reactor.remove(r)
+        raise StopIteration
+
+    def add():
+        time.sleep(0.02)
+        reactor.add(r, select.POLLIN, read)
+        os.write(w, 'x')
+
+    try:
+        reactor.add_timer(0.0, threading.Thread(target = add).start)
+        run(reactor)
+    finally:
+        close_pipes(pipes)
+
+    check(called == [True], 'callback called %d times' % len(called))
+
+def case_timer_from_foreign_thread(reactor):
+    """A timer added from a foreign thread while the reactor sleeps is
+    not delayed by the sleep."""
+    called = []
+
+    def fire():
+        called.append(time.time())
+        raise StopIteration
+
+    def add():
+        time.sleep(0.02)
+        called.append(time.time())
+        reactor.add_timer(0.01, fire)
+
+    # the reactor sleeps for 1s if the timer thread does not wake it up
+    reactor.add_timer(1.0, stop)
+    reactor.add_timer(0.0, threading.Thread(target = add).start)
+    run(reactor)
+
+    check(len(called) == 2, 'timer did not fire')
+    check(called[1] - called[0] < 0.5, 'timer fired after %.3fs'
+          % (called[1] - called[0]))
+
+def case_timer_order(reactor):
+    """Timers fire in the order of their expiry, not their creation."""
+    called = []
+
+    def fire(i):
+        called.append(i)
+        if len(called) == 5:
+            raise StopIteration
+
+    for i in (4, 2, 0, 3, 1):
+        reactor.add_timer(0.01 + i * 0.005, fire, [i])
+    run(reactor)
+
+    check(called == range(5), 'fired in order %s' % called)
+
+def case_cancel_in_callback(reactor):
+    """A timer cancelled in the callback of an earlier timer does not
+    fire."""
+    called = []
+    timers = []
+
+    def first():
+        called.append('first')
+        reactor.cancel_timer(timers[1])
+        reactor.add_timer(0.1, stop)
+
+    def second():
+        called.append('second')
+
+    timers.append(reactor.add_timer(0.01, first))
+    timers.append(reactor.add_timer(0.05, second))
+    run(reactor)
+
+    check(called == ['first'], 'called %s' % called)
+
+def case_cancel_expired(reactor):
+    """Cancelling an expired timer raises ValueError."""
+    t = reactor.add_timer(0.0, stop)
+    run(reactor)
+    try:
+        reactor.cancel_timer(t)
+    except ValueError:
+        return
+
+    raise Failed('no ValueError')
+
+cases = [case_stop_from_timer,
+         case_event,
+         case_remove_in_own_callback,
+         case_remove_other_in_callback,
+         case_readd_in_callback,
+         case_socketpair_writable,
+         case_socketpair_hangup,
+         case_add_from_foreign_thread,
+         case_timer_from_foreign_thread,
+         case_timer_order,
+         case_cancel_in_callback,
+         case_cancel_expired]
+
+def conformance(factory):
+    """Run all cases with new reactors from factory.
+
+    @return: a dictionary that maps the case name to C{'pass'} or the
+    reason of the failure."""
+    results = {}
+    for case in cases:
+        name = case.__name__[5:]
+        try:
+            case(factory())
+            results[name] = 'pass'
+        except Failed, e:
+            results[name] = 'fail: %s' % e
+        except Exception, e:
+            results[name] = 'error: %s: %s' % (e.__class__.__name__, e)
+
+    return results
+
+# Benchmarks
+
+class Echo:
+    """Read a byte from a pipe and write it back. Stop the reactor after
+    a number of events."""
+
+    def __init__(self, counter, fds):
+        self.counter = counter
+        self.r, self.w = fds
+
+    def __call__(self):
+        os.read(self.r, 1)
+        os.write(self.w, 'x')
+        self.counter[0] = self.counter[0] - 1
+        if self.counter[0] <= 0:
+            raise StopIteration
+
+def throughput(factory, registered, active, events):
+    """Dispatch events on active pipes out of registered fds.
+
+    The idle fds are duplicates of the read end of a single pipe, so
+    only one fd per registered fd is needed.
+
+    @return: a dictionary with the events per second."""
+    reactor = factory()
+    pipes = create_pipes(active + 1)
+    idle = [os.dup(pipes[-1][0]) for i in range(registered - active)]
+    counter = [events]
+
+    try:
+        for fds in pipes[:-1]:
+            reactor.add(fds[0], select.POLLIN, Echo(counter, fds))
+            os.write(fds[1], 'x')
+        for fd in idle:
+            reactor.add(fd, select.POLLIN, stop)
+
+        start = time.time()
+        reactor.run()
+        elapsed = time.time() - start
+
+        for r, w in pipes[:-1]:
+            reactor.remove(r)
+        for fd in idle:
+            reactor.remove(fd)
+    finally:
+        close_pipes(pipes)
+        for fd in idle:
+            os.close(fd)
+
+    return { 'registered': registered,
+             'active': active,
+             'events': events,
+             'seconds': elapsed,
+             'events_per_second': events / elapsed }
+
+def churn(factory, threads, count):
+    """Add and remove count pipes from each of threads foreign threads
+    while the reactor runs.
+
+    @return: a dictionary with the operations per second."""
+    reactor = factory()
+    pipes = [create_pipes(count) for i in range(threads)]
+
+    def worker(mine):
+        for r, w in mine:
+            reactor.add(r, select.POLLIN, stop)
+        for r, w in mine:
+            reactor.remove(r)
+
+    workers = [threading.Thread(target = worker, args = (p,))
+               for p in pipes]
+
+    try:
+        start = time.time()
+        for t in workers:
+            t.start()
+        for t in workers:
+            t.join()
+        # runs after the queued adds and removes have been applied
+        reactor.add_timer(0.0, stop)
+        reactor.run()
+        elapsed = time.time() - start
+    finally:
+        for p in pipes:
+            close_pipes(p)
+
+    operations = threads * count * 2
+    return { 'threads': threads,
+             'operations': operations,
+             'seconds': elapsed,
+             'operations_per_second': operations / elapsed }
+
+def timer_accuracy(factory, count, max_interval = 0.05):
+    """Arm count timers with random intervals up to max_interval seconds
+    and measure how late they fire.
+
+    @return: a dictionary with the percentiles of the lateness in
+    microseconds and the number of timers that fired early."""
+    reactor = factory()
+    lateness = Histogram()
+    early = [0]
+    pending = [count]
+
+    def fire(due):
+        late = time.time() - due
+        if late < 0:
+            early[0] += 1
+        lateness.add(late * 1e6)
+        pending[0] -= 1
+        if not pending[0]:
+            raise StopIteration
+
+    def arm():
+        for i in range(count):
+            interval = random.uniform(0.001, max_interval)
+            reactor.add_timer(interval, fire, [time.time() + interval])
+
+    reactor.add_timer(0.0, arm)
+    reactor.run()
+
+    result = lateness.snapshot()
+    result['early'] = early[0]
+    return result
+
+def reactors():
+    """Return a list of (name, factory) for the available reactors."""
+    available = [('poll', PollReactor),
+                 ('poll-wheel', lambda: PollReactor(timer_wheel = True))]
+    if hasattr(select, 'epoll'):
+        available.extend([('epoll', EpollReactor),
+                          ('epoll-et', lambda: EpollReactor(
+                              edge_triggered = True))])
+    try:
+        from aculab.asyncioreactor import AsyncioReactor, asyncio
+        available.append(('asyncio', lambda: AsyncioReactor(
+            asyncio.new_event_loop())))
+    except ImportError:
+        pass
+
+    return available
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options]',
+                                   description='Test and benchmark the '
+                                   'reactors. The results are printed '
+                                   'as JSON.')
+    parser.add_option('-r', '--reactor', action='append', default=[],
+                      help='Test only REACTOR. May be repeated.')
+    parser.add_option('-e', '--events', type='int', default=100000,
+                      help='Dispatch EVENTS events. Default is 100000.')
+    parser.add_option('-a', '--active', type='int', default=10,
+                      help='Number of active pipes. Default is 10.')
+    parser.add_option('-c', '--churn', type='int', default=1000,
+                      help='Pipes added and removed per thread. '
+                      'Default is 1000.')
+    parser.add_option('-t', '--threads', type='int', default=4,
+                      help='Number of churn threads. Default is 4.')
+    parser.add_option('-n', '--timers', type='int', default=2000,
+                      help='Number of timers. Default is 2000.')
+    parser.add_option('-q', '--quick', action='store_true',
+                      help='Only run the conformance cases.')
+    parser.add_option('-o', '--output',
+                      help='Write the results to OUTPUT instead of stdout.')
+
+    options, args = parser.parse_args()
+
+    sizes = [100, 1000, 10000]
+    limit = raise_fd_limit(max(max(sizes), options.churn * options.threads
+                               * 2) + 64)
+
+    results = { 'time': time.time(),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'reactors': {} }
+    failed = False
+
+    for name, factory in reactors():
+        if options.reactor and name not in options.reactor:
+            continue
+
+        r = { 'conformance': conformance(factory) }
+        for case, result in r['conformance'].items():
+            if result != 'pass':
+                failed = True
+                print >> sys.stderr, '%s %s: %s' % (name, case, result)
+
+        if not options.quick:
+            r['throughput'] = []
+            for size in sizes:
+                if size + 64 > limit:
+                    r['throughput'].append({ 'registered': size,
+                                             'skipped': 'file descriptor '
+                                             'limit is %d' % limit })
+                else:
+                    r['throughput'].append(throughput(factory, size,
+                                                      options.active,
+                                                      options.events))
+            r['churn'] = churn(factory, options.threads, options.churn)
+            r['timers'] = timer_accuracy(factory, options.timers)
+
+        results['reactors'][name] = r
+
+    if options.output:
+        f = open(options.output, 'w')
+    else:
+        f = sys.stdout
+
+    json.dump(results, f, indent = 1, sort_keys = True)
+    f.write('\n')
+
+    if failed:
+        sys.exit(1)
@@ -5,6 +5,17 @@
 import unittest
 from aculab.error import AculabError, AculabSpeechError
 from aculab.sdp import SDP
+import time
+import select
+import threading
+from aculab.timer import TimerBase, TimerWheel, monotonic
+from aculab.instrument import Histogram
+from aculab.phrases import English, German, build, read_index
+try:
+    from aculab import asyncioreactor
+except ImportError:
+    # neither asyncio nor trollius is available
+    asyncioreactor = None
 
 class ErrorTest(unittest.TestCase):
     """Check formatting and name resolution of Aculab errors."""
@@ -112,5 +123,1268 @@ a=T38FaxUdpEC:t38UDPRedundancy'''
         self.failUnless(sdp.getMediaDescription('image')._a['T38FaxVersion']
                         == ['3'])
 
+class TimerTest(unittest.TestCase):
+    """Test the timer housekeeping in TimerBase."""
+
+    def nop(self):
+        pass
+
+    def testANextFlag(self):
+        'TimerBase: add reports whether the new timer is the next due'
+        timers = TimerBase()
+        self.failUnless(timers.add(10.0, self.nop)[1])
+        self.failUnless(timers.add(5.0, self.nop)[1])
+        self.failIf(timers.add(20.0, self.nop)[1])
+
+    def testBCancel(self):
+        'TimerBase: cancel the next timer and cancel twice'
+        timers = TimerBase()
+        t1 = timers.add(10.0, self.nop)[0]
+        t2 = timers.add(20.0, self.nop)[0]
+        self.failIf(timers.cancel(t2))
+        self.failUnless(timers.cancel(t1))
+        self.failUnless(len(timers) == 0)
+        self.assertRaises(ValueError, timers.cancel, t1)
+
+    def testCExpired(self):
+        'TimerBase: cancelling an expired timer raises a ValueError'
+        timers = TimerBase()
+        t2 = timers.add(-1.0, self.nop)[0]
+        t1 = timers.add(-2.0, self.nop)[0]
+        timers.add(10.0, self.nop)
+        self.failUnless(timers.get_pending() == [t1, t2])
+        self.assertRaises(ValueError, timers.cancel, t1)
+
+    def testDCompact(self):
+        'TimerBase: cancelled timers are compacted'
+        timers = TimerBase()
+        l = [timers.add(i + 1.0, self.nop)[0] for i in range(1000)]
+        for t in l[1:]:
+            timers.cancel(t)
+        self.failUnless(len(timers) == 1)
+        self.failUnless(len(timers.timers) < 500)
+        self.failUnless(timers.time_to_wait() > 0)
+
+    def testESlack(self):
+        'TimerBase: timers with slack expire together'
+        timers = TimerBase()
+        now = monotonic()
+        l = [timers.add(i * 0.0005, None, slack = 0.02)[0] for i in range(100)]
+        for i, t in enumerate(l):
+            self.failUnless(t.absolute >= now + i * 0.0005)
+            self.failUnless(t.absolute <= monotonic() + i * 0.0005 + 0.02)
+        # 0.05s of deadlines on a grid of 1/64s
+        self.failUnless(len(set([t.absolute for t in l])) <= 5)
+
+        while len(timers):
+            time.sleep(timers.time_to_wait() / 1000.0)
+            timers.get_pending()
+
+        stats = timers.stats()
+        self.failUnless(stats['expired'] == 100)
+        self.failUnless(stats['wakeups'] <= 5)
+
+class TimerWheelTest(unittest.TestCase):
+    """Test the TimerWheel, including cascading and overflow."""
+
+    def testAExpire(self):
+        'TimerWheel: timers fire in order, never early, and cancel works'
+        # a tiny wheel with a range of 0.256s
+        timers = TimerWheel(resolution = 0.001, bits = 4, levels = 2)
+        fired = []
+        l = [timers.add(i * 0.01, fired.append, [i])[0] for i in range(40)]
+        for t in l[1::2]:
+            timers.cancel(t)
+        self.assertRaises(ValueError, timers.cancel, l[1])
+
+        while len(timers):
+            time.sleep(timers.time_to_wait() / 1000.0)
+            for t in timers.get_pending():
+                self.failUnless(monotonic() >= t.absolute)
+                t()
+
+        self.failUnless(fired == range(0, 40, 2))
+        self.failUnless(timers.time_to_wait() == -1)
+        self.assertRaises(ValueError, timers.cancel, l[0])
+
+class HistogramTest(unittest.TestCase):
+    """Test the log-linear Histogram."""
+
+    def testAPercentile(self):
+        'Histogram: percentiles are within the bucket error'
+        h = Histogram()
+        for i in range(1, 10001):
+            h.add(i)
+
+        self.failUnless(h.count == 10000)
+        self.failUnless(h.min == 1 and h.max == 10000)
+        for p in (50, 90, 99):
+            self.failUnless(abs(h.percentile(p) - p * 100) <= p * 100 / 8)
+        self.failUnless(h.percentile(100) <= 10000)
+
+class ReactorTest(unittest.TestCase):
+    """Test the PollReactor without Aculab hardware."""
+
+    def create(self):
+        """Create the reactor under test."""
+        from aculab.posixreactor import PollReactor
+        return PollReactor()
+
+    def testACallFromThread(self):
+        'PollReactor: call_from_thread calls in the reactor thread, in order'
+
+        reactor = self.create()
+        main = threading.currentThread()
+        called = []
+
+        def append(i):
+            called.append((i, threading.currentThread() is main))
+
+        def stop():
+            raise StopIteration
+
+        def worker():
+            for i in range(100):
+                reactor.call_from_thread(append, i)
+            reactor.call_from_thread(stop)
+
+        # runs before the reactor is started
+        reactor.call_soon(threading.Thread(target = worker).start)
+        reactor.run()
+
+        self.failUnless(called == [(i, True) for i in range(100)])
+
+    def testBWatchdog(self):
+        'Watchdog: a sleeping callback is detected with its stack'
+        from aculab.watchdog import Watchdog
+
+        reactor = self.create()
+        watchdog = Watchdog(reactor, threshold = 0.02)
+        watchdog.start()
+
+        def sleeper():
+            time.sleep(0.1)
+
+        def stop():
+            raise StopIteration
+
+        reactor.call_soon(sleeper)
+        reactor.call_soon(stop)
+        reactor.run()
+        watchdog.stop()
+
+        self.failUnless(watchdog.detected == 1)
+        name, elapsed, stack = watchdog.last
+        self.failUnless(name == 'sleeper')
+        self.failUnless(elapsed >= 0.02)
+        self.failUnless('in sleeper' in stack)
+
+    def testCPeriodic(self):
+        'PollReactor: periodic timers skip missed deadlines without drift'
+
+        reactor = self.create()
+        calls = []
+
+        def tick():
+            calls.append((monotonic(), p.missed))
+            if len(calls) == 1:
+                # the next call is late, the one after that is skipped
+                time.sleep(p.deadline + 0.075 - monotonic())
+            elif len(calls) == 4:
+                p.cancel()
+                raise StopIteration
+
+        p = reactor.add_periodic(0.05, tick)
+        start = p.deadline - 0.05
+        reactor.run()
+
+        self.failUnless(calls[1][1] == 1)
+        # the phase is kept: the last call is due at start + 0.25
+        self.failUnless(calls[-1][0] >= start + 0.25)
+        self.failUnless(calls[-1][0] < start + 0.3)
+        self.assertRaises(ValueError, p.cancel)
+
+    def testDPriority(self):
+        'PollReactor: dispatch in priority order, defer background events'
+        import os, select
+        from aculab.util import PRIORITY_CONTROL, PRIORITY_MEDIA, \
+             PRIORITY_BACKGROUND
+
+        reactor = self.create()
+        reactor.background_budget = 1
+        called = []
+        pipes = [os.pipe() for i in range(4)]
+
+        def event(name, fd):
+            def method():
+                os.read(fd, 1)
+                called.append((name, len(reactor.deferred)))
+                if len(called) == 4:
+                    raise StopIteration
+            return method
+
+        priorities = [('b1', PRIORITY_BACKGROUND), ('b2', PRIORITY_BACKGROUND),
+                      ('m', PRIORITY_MEDIA), ('c', PRIORITY_CONTROL)]
+
+        try:
+            for (name, priority), (r, w) in zip(priorities, pipes):
+                reactor.add(r, select.POLLIN, event(name, r),
+                            priority = priority)
+                os.write(w, 'x')
+
+            reactor.run()
+        finally:
+            for r, w in pipes:
+                os.close(r)
+                os.close(w)
+
+        # one background event is deferred to the next batch
+        self.failUnless(called[:2] == [('c', 1), ('m', 1)])
+        self.failUnless(called[3][1] == 0)
+        self.failUnless(sorted([n for n, d in called[2:]]) == ['b1', 'b2'])
+        self.failUnless(reactor.deferred == [])
+
+    def testEAdmission(self):
+        'AdmissionControl: reject and defer new calls while the reactor lags'
+        from aculab.admission import AdmissionControl
+
+        class FakeCall:
+            name = 'cc-0000'
+            controllers = [None]
+            user_data = None
+
+        reactor = self.create()
+        admission = AdmissionControl(reactor, max_lag = 0.02,
+                                     interval = 0.01, recovery = 2)
+        states = []
+        admitted = []
+        started = []
+        probe = admission.probe
+
+        def record():
+            probe()
+            states.append(admission.overloaded)
+            if admission.overloaded and not admission.pending:
+                admitted.append(admission.admit(FakeCall()))
+                admission.defer(FakeCall(), started.append, 'openout')
+            if started:
+                raise StopIteration
+
+        admission.probe = record
+        admission.start()
+        # block the reactor
+        reactor.add_timer(0.015, time.sleep, [0.05])
+        reactor.run()
+        admission.stop()
+
+        self.failUnless(True in states)
+        self.failUnless(states[-1] == False)
+        self.failUnless(admitted == [False])
+        self.failUnless(started == ['openout'])
+        stats = admission.stats()
+        self.failUnless(stats['rejected'] == 1)
+        self.failUnless(stats['deferred'] == 1)
+        self.failUnless(stats['max_lag'] == 20000)
+
+    def testFCallEventThread(self):
+        'CallEventThread: early events are buffered up to a limit'
+        import aculab.lowlevel as lowlevel
+        from aculab.reactor import CallEventThread
+
+        class Event:
+            def __init__(self, handle):
+                self.handle = handle
+                self.state = lowlevel.EV_DETAILS
+
+        class Call:
+            handle = 1
+            name = 'cc-0001'
+            controllers = [None]
+            user_data = None
+
+            def ev_details(self):
+                called.append(len(called))
+                if len(called) == 10:
+                    raise StopIteration
+
+        reactor = self.create()
+        thread = CallEventThread(max_chicken_events = 5)
+        called = []
+
+        # the call is not yet known, one event is dropped
+        for i in range(6):
+            thread.enqueue(Event(1))
+        thread.add(reactor, Call())
+        for i in range(5):
+            thread.enqueue(Event(1))
+        reactor.run()
+
+        self.failUnless(called == range(10))
+        self.failUnless(thread.dropped == 1)
+        self.failUnless(thread.chicken_events == 0)
+        # all events were queued before the reactor woke up
+        self.failUnless(thread.queues[reactor].wakeups == 1)
+
+    def testGExecutor(self):
+        'PollReactor: run_in_executor calls back in the reactor thread'
+        from aculab.executor import WorkerPool
+
+        reactor = self.create()
+        pool = WorkerPool(workers = 2)
+        main = threading.currentThread()
+        results = []
+
+        def work(i):
+            time.sleep(0.01)
+            if i == 3:
+                raise ValueError(i)
+            return i
+
+        def done(result, exception):
+            results.append((result, exception is not None,
+                            threading.currentThread() is main))
+            if len(results) == 8:
+                raise StopIteration
+
+        for i in range(8):
+            reactor.run_in_executor(work, i, callback = done,
+                                    executor = pool)
+        reactor.run()
+        pool.stop()
+
+        self.failUnless(sorted(results) == [(None, True, True)] +
+                        [(i, False, True) for i in range(8) if i != 3])
+        stats = pool.stats()
+        self.failUnless(stats['threads'] == 2)
+        self.failUnless(stats['completed'] == 7 and stats['failed'] == 1)
+        self.failUnless(stats['max_queued'] >= 6)
+        self.failUnless(stats['run']['count'] == 8)
+        self.assertRaises(TypeError, reactor.run_in_executor, work, 1,
+                          callbak = done)
+
+    def testHDrain(self):
+        'Drain: stop when the last call has ended or the timeout passed'
+        from aculab import drain
+
+        class Call:
+            name = 'cc-0001'
+
+        call = Call()
+        reports = []
+
+        reactor = self.create()
+        d = drain.Drain(reactor, timeout = 1.0, interval = 0.01,
+                        report = reports.append)
+        drain.call_started(call)
+        reactor.add_timer(0.05, drain.call_ended, [call])
+        reactor.call_soon(d.start)
+        start = time.time()
+        try:
+            self.failUnless(drain.draining() is None)
+            reactor.run()
+            self.failUnless(drain.draining() is d)
+        finally:
+            d.cancel()
+
+        self.failUnless(0.05 <= time.time() - start < 0.5)
+        self.failUnless(reports[0]['calls'] == 1)
+        self.failUnless(reports[-1]['calls'] == 0)
+
+        # the second call does not end
+        reactor = self.create()
+        d = drain.Drain(reactor, timeout = 0.05, interval = 0.01)
+        drain.call_started(call)
+        reactor.call_soon(d.start)
+        try:
+            reactor.run()
+        finally:
+            d.cancel()
+            drain.call_ended(call)
+
+        self.failUnless(d.stats()['remaining'] == 0.0)
+
+    def testIDrainSignal(self):
+        'Drain: start from a signal that interrupts the reactor mutex'
+        import os, signal
+        from aculab import drain
+
+        def kill():
+            # the handler runs in this thread while it holds the mutex
+            reactor.mutex.acquire()
+            try:
+                os.kill(os.getpid(), signal.SIGUSR1)
+            finally:
+                reactor.mutex.release()
+
+        reactor = self.create()
+        previous = signal.getsignal(signal.SIGUSR1)
+        d = drain.drain_on_signal(reactor, signal.SIGUSR1, timeout = 1.0,
+                                  interval = 0.01)
+        reactor.add_timer(0.01, kill)
+        watchdog = threading.Timer(2.0, os.kill,
+                                   [os.getpid(), signal.SIGUSR1])
+        watchdog.start()
+        try:
+            reactor.run()
+            self.failUnless(drain.draining() is d)
+        finally:
+            watchdog.cancel()
+            d.cancel()
+            signal.signal(signal.SIGUSR1, previous)
+
+        self.failUnless(d.stats()['calls'] == 0)
+
+    def testJReplace(self):
+        'PollReactor: add an fd twice, remove it after it was closed'
+        import os, select
+
+        reactor = self.create()
+        called = []
+        r, w = os.pipe()
+
+        def first():
+            called.append('first')
+
+        def second():
+            os.read(r, 1)
+            called.append('second')
+            raise StopIteration
+
+        try:
+            reactor.add(r, select.POLLIN, first)
+            reactor.add(r, select.POLLIN, second)
+            os.write(w, 'x')
+            reactor.run()
+        finally:
+            os.close(r)
+            os.close(w)
+
+        # the fd is gone, but the handle is still registered
+        reactor.remove(r)
+
+        self.failUnless(called == ['second'])
+        self.failUnless(r not in reactor.handles)
+
+    def testKCallDispatch(self):
+        'call_dispatch: only HANDLED from the call consumes an event'
+        import aculab.lowlevel as lowlevel
+        from aculab.reactor import call_dispatch, HANDLED
+
+        called = []
+
+        class Controller:
+            def ev_details(self, call, user_data):
+                called.append('controller')
+
+        class Call:
+            name = 'cc-0000'
+            user_data = None
+            controllers = [Controller()]
+
+            def __init__(self, result):
+                self.result = result
+
+            def ev_details(self):
+                called.append('call')
+                return self.result
+
+            def ev_details_post(self):
+                called.append('post')
+
+        class Event:
+            state = lowlevel.EV_DETAILS
+
+        call_dispatch(Call(True), Event())
+        self.failUnless(called == ['call', 'controller', 'post'])
+
+        del called[:]
+        call_dispatch(Call(HANDLED), Event())
+        self.failUnless(called == ['call'])
+
+    def testLRemoveForeign(self):
+        'PollReactor: no callback after a foreign remove has returned'
+        import os
+        from aculab.util import PRIORITY_CONTROL
+
+        reactor = self.create()
+        entered = threading.Event()
+        release = threading.Event()
+        called = []
+        r1, w1 = os.pipe()
+        r2, w2 = os.pipe()
+
+        def blocker():
+            # dispatched first in the batch
+            os.read(r1, 1)
+            entered.set()
+            release.wait(5.0)
+
+        def stop():
+            raise StopIteration
+
+        try:
+            reactor.add(r1, select.POLLIN, blocker,
+                        priority = PRIORITY_CONTROL)
+            reactor.add(r2, select.POLLIN, lambda: called.append(r2))
+            # both fds are in the first batch
+            os.write(w1, 'x')
+            os.write(w2, 'x')
+            reactor.start()
+            entered.wait(5.0)
+            reactor.remove(r2)
+            release.set()
+            # stop after the next poll, which unregisters r2
+            reactor.add_timer(0.05, stop)
+            reactor.join(5.0)
+        finally:
+            for fd in (r1, w1, r2, w2):
+                os.close(fd)
+
+        self.failUnless(called == [])
+        self.failUnless(r2 not in reactor.handles)
+        self.failUnless(not reactor.removed)
+
+    def testMCoalesce(self):
+        'PollReactor: foreign calls and updates share one wakeup'
+        import os
+
+        class Pipe:
+            def __init__(self, f):
+                self.f = f
+
+            def write(self, data):
+                writes.append(data)
+                self.f.write(data)
+
+        reactor = self.create()
+        writes = []
+        reactor.pipe = (reactor.pipe[0], Pipe(reactor.pipe[1]))
+        entered = threading.Event()
+        release = threading.Event()
+        called = []
+        r, w = os.pipe()
+
+        def blocker():
+            entered.set()
+            release.wait(5.0)
+
+        def stop():
+            raise StopIteration
+
+        try:
+            reactor.call_soon(blocker)
+            reactor.start()
+            entered.wait(5.0)
+            for i in range(10):
+                reactor.call_soon(called.append, i)
+            reactor.add(r, select.POLLIN, lambda: None)
+            reactor.remove(r)
+            # the reactor is blocked, so there is one wakeup for all
+            self.failUnless(len(writes) == 1)
+            release.set()
+            reactor.call_soon(stop)
+            reactor.join(5.0)
+        finally:
+            os.close(r)
+            os.close(w)
+
+        self.failUnless(called == range(10))
+        self.failUnless(r not in reactor.handles)
+
+    def testNAdmissionDeferred(self):
+        'AdmissionControl: limit deferred calls, report failed and expired'
+        from aculab.admission import AdmissionControl, Overloaded
+
+        class Controller:
+            def __init__(self):
+                self.failed = []
+
+            def openout_failed(self, call, reason, user_data):
+                self.failed.append((call.name, reason.__class__, user_data))
+
+        class Call:
+            def __init__(self, name, controller):
+                self.name = name
+                self.controllers = [controller]
+                self.user_data = name
+
+        def openout(rc):
+            if rc:
+                raise AculabError(rc, 'call_openout')
+            started.append(rc)
+
+        controller = Controller()
+        started = []
+        admission = AdmissionControl(self.create(), max_pending = 2)
+        admission.overloaded = True
+        self.failUnless(admission.defer(Call('a', controller), openout, 0))
+        self.failUnless(admission.defer(Call('b', controller), openout, -1))
+        self.failUnlessRaises(Overloaded, admission.defer,
+                              Call('c', controller), openout, 0)
+        admission.stop()
+        self.failUnless(started == [0])
+        self.failUnless(controller.failed == [('b', AculabError, 'b')])
+
+        # the timeout has passed at once
+        admission = AdmissionControl(self.create(), timeout = 0.0)
+        admission.overloaded = True
+        self.failUnless(admission.defer(Call('d', controller), openout, 0))
+        admission.expire()
+        self.failUnless(controller.failed[-1] == ('d', Overloaded, 'd'))
+        stats = admission.stats()
+        self.failUnless(stats['expired'] == 1 and stats['pending'] == 0)
+        self.failUnless(started == [0])
+
+if hasattr(select, 'epoll'):
+    class EpollReactorTest(ReactorTest):
+        """Run the reactor tests against the EpollReactor."""
+
+        def create(self):
+            """Create the reactor under test."""
+            from aculab.posixreactor import EpollReactor
+            return EpollReactor()
+
+if asyncioreactor:
+    class AsyncioReactorTest(unittest.TestCase):
+        """Test the AsyncioReactor without Aculab hardware."""
+
+        def setUp(self):
+            self.loop = asyncioreactor.asyncio.new_event_loop()
+            self.reactor = asyncioreactor.AsyncioReactor(self.loop)
+
+        def tearDown(self):
+            self.loop.close()
+
+        def testAEvents(self):
+            'AsyncioReactor: fd events, timers and calls from threads'
+            import os
+
+            reactor = self.reactor
+            called = []
+            r, w = os.pipe()
+
+            def read():
+                os.read(r, 1)
+                reactor.remove(r)
+                called.append('event')
+
+            def stop():
+                raise StopIteration
+
+            try:
+                reactor.add(r, select.POLLIN, read)
+                os.write(w, 'x')
+                reactor.add_timer(0.01, called.append, ['timer'])
+                cancelled = reactor.add_timer(0.01, called.append,
+                                              ['cancelled'])
+                reactor.cancel_timer(cancelled)
+                threading.Thread(target = reactor.call_from_thread,
+                                 args = (called.append, 'thread')).start()
+                reactor.add_timer(0.1, stop)
+                reactor.run()
+            finally:
+                os.close(r)
+                os.close(w)
+
+            self.failUnless(sorted(called) == ['event', 'thread', 'timer'])
+            self.failUnless(r not in reactor.handles)
+
+        def testBError(self):
+            'AsyncioReactor: an exception in a callback is raised from run'
+            def fail():
+                raise ValueError('fail')
+
+            self.reactor.call_soon(fail)
+            self.assertRaises(ValueError, self.reactor.run)
+
+        def testCFuture(self):
+            'AsyncioReactor: FutureController resolves a future on a callback'
+            controller = asyncioreactor.FutureController(loop = self.loop)
+            channel = object()
+            f = controller.expect(channel, 'play_done')
+            controller.play_done(channel, None, 1.5)
+
+            self.failUnless(f.done() and f.result() is None)
+            self.assertRaises(ValueError, controller.expect, channel,
+                              'unknown')
+
+        def testDModify(self):
+            'AsyncioReactor: add a handle again with a different mode'
+            import os
+
+            reactor = self.reactor
+            called = []
+            r, w = os.pipe()
+
+            def stop():
+                raise StopIteration
+
+            try:
+                reactor.add(w, select.POLLOUT, called.append)
+                # the pipe is always writable, but never readable
+                reactor.add(w, select.POLLIN, lambda: called.append(w))
+                reactor.add_timer(0.05, stop)
+                reactor.run()
+                self.failUnless(reactor.handles[w][0] == select.POLLIN)
+                reactor.remove(w)
+                reactor.add_timer(0.01, stop)
+                reactor.run()
+            finally:
+                os.close(r)
+                os.close(w)
+
+            self.failUnless(called == [])
+            self.failUnless(w not in reactor.handles)
+
+class SimulatedReactorTest(unittest.TestCase):
+    """Test the SimulatedReactor."""
+
+    def testATimeouts(self):
+        'SimulatedReactor: hours of call timeouts without real time passing'
+        from aculab.simreactor import SimulatedReactor
+
+        reactor = SimulatedReactor()
+        accepted = []
+        hungup = []
+
+        class Call:
+            # accept after 20s unless the caller hangs up before
+            def __init__(self, i):
+                self.i = i
+                self.timer = reactor.add_timer(20.0, self.accept)
+
+            def accept(self):
+                accepted.append((self.i, reactor.time()))
+
+            def hangup(self):
+                if self.timer.pending:
+                    reactor.cancel_timer(self.timer)
+                hungup.append(self.i)
+
+        def incoming(i):
+            call = Call(i)
+            # every other caller hangs up after 10s
+            if i % 2:
+                reactor.call_at(reactor.time() + 10.0, call.hangup)
+
+        for i in range(1000):
+            reactor.call_at(i * 60.0, incoming, i)
+
+        start = time.time()
+        reactor.run()
+
+        self.failUnless(time.time() - start < 5.0)
+        self.failUnless(accepted == [(i, i * 60.0 + 20.0)
+                                     for i in range(0, 1000, 2)])
+        self.failUnless(hungup == range(1, 1000, 2))
+        # the last caller hangs up
+        self.failUnless(reactor.time() == 999 * 60.0 + 10.0)
+
+    def testBEvents(self):
+        'SimulatedReactor: scripted events, periodic timers and run until'
+        import select
+        from aculab.simreactor import SimulatedReactor
+
+        reactor = SimulatedReactor()
+        events = []
+        ticks = []
+
+        def on_event():
+            events.append(reactor.time())
+            if len(events) == 2:
+                reactor.remove(3)
+
+        reactor.add(3, select.POLLIN, on_event)
+        for t in (1.0, 2.0, 3.0):
+            reactor.inject(t, 3)
+        # the event at 1.5 does not match the mode
+        reactor.inject(1.5, 3, select.POLLOUT)
+
+        p = reactor.add_periodic(0.5, lambda: ticks.append(reactor.time()))
+        reactor.run(until = 10.0)
+
+        self.failUnless(events == [1.0, 2.0])
+        self.failUnless(reactor.stats()['ignored'] == 2)
+        self.failUnless(ticks == [i * 0.5 for i in range(1, 21)])
+        self.failUnless(reactor.time() == 10.0)
+        p.cancel()
+
+class SupervisorTest(unittest.TestCase):
+    """Test the Supervisor without Aculab hardware."""
+
+    def testARestart(self):
+        'Supervisor: restart a crashed worker and aggregate metrics'
+        import os, tempfile
+        from aculab.snapshot import Partition
+        from aculab.supervisor import Supervisor
+
+        class TestSupervisor(Supervisor):
+            def open(self, partition):
+                pass
+
+        marker = tempfile.mktemp()
+
+        def worker(partition, reporter):
+            reporter.report({ 'calls': len(partition.cards),
+                              'reactor': { 'events': 10 } })
+            if partition.cards == ['b'] and not os.path.exists(marker):
+                open(marker, 'w').close()
+                raise RuntimeError('crash')
+
+        supervisor = TestSupervisor(worker, [Partition(['a']),
+                                             Partition(['b'])],
+                                    restart_delay = 0.01)
+        try:
+            supervisor.run()
+        finally:
+            if os.path.exists(marker):
+                os.unlink(marker)
+
+        metrics = supervisor.metrics()
+        self.failUnless([m['restarts'] for m in metrics['workers']] == [0, 1])
+        self.failUnless(metrics['total'] == { 'calls': 2,
+                                              'reactor': { 'events': 20 } })
+
+    def testBKill(self):
+        'Supervisor: kill a worker that ignores SIGTERM after kill_timeout'
+        import os, signal
+        from aculab.snapshot import Partition
+        from aculab.supervisor import Supervisor
+
+        class TestSupervisor(Supervisor):
+            def open(self, partition):
+                pass
+
+        def worker(partition, reporter):
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            time.sleep(30)
+
+        supervisor = TestSupervisor(worker, [Partition(['a'])],
+                                    kill_timeout = 0.2)
+        stop = threading.Timer(0.3, supervisor.stop)
+        stop.start()
+        start = time.time()
+        supervisor.run()
+        stop.join()
+
+        self.failUnless(time.time() - start < 5.0)
+        self.failUnless(supervisor.workers[0].pid is None)
+
+    def testCPartition(self):
+        'Supervisor: share the ports and modules of a card between workers'
+        from aculab.supervisor import partition_cards
+
+        partitions = partition_cards(['a', 'b', 'c'], 2)
+        self.failUnless([p.cards for p in partitions] == [['a', 'c'], ['b']])
+
+        partitions = partition_cards(['a', 'b'], 3)
+        self.failUnless([p.cards for p in partitions] == [['a'], ['b'],
+                                                          ['a']])
+        self.failUnless([p.sip for p in partitions] == [True, False, False])
+        a0, b, a1 = partitions
+        self.failUnless([i for i in range(5) if a0.port('a', i)] == [0, 2, 4])
+        self.failUnless([i for i in range(5) if a1.module('a', i)] == [1, 3])
+        self.failUnless(b.port('b', 7) and b.module('b', 7))
+
+class PhraseTest(unittest.TestCase):
+    """Check the segment names of the phrase languages."""
+
+    def testANumber(self):
+        'Phrases: English numbers'
+        en = English()
+        self.failUnless(en.number(0) == ['0'])
+        self.failUnless(en.number(1234) == ['1', 'thousand', '2', 'hundred',
+                                            '30', '4'])
+        self.failUnless(en.number(-2000017) == ['minus', '2', 'million',
+                                                '17'])
+        self.assertRaises(ValueError, en.number, 10 ** 12)
+
+    def testBGerman(self):
+        'Phrases: German numbers with ein, eins and eine'
+        de = German()
+        self.failUnless(de.number(1) == ['1'])
+        self.failUnless(de.number(1234) == ['one', 'thousand', '2', 'hundred',
+                                            '4', 'and', '30'])
+        self.failUnless(de.number(1000101) == ['a', 'million', 'one',
+                                               'hundred', '1'])
+        self.failUnless(de.number(21000000) == ['one', 'and', '20',
+                                                'millions'])
+
+    def testCDigitsDates(self):
+        'Phrases: digits and dates'
+        import datetime
+        en = English()
+        self.failUnless(en.digits('+49 (30) 12-3') == ['plus', '4', '9', '3',
+                                                       '0', '1', '2', '3'])
+        self.assertRaises(ValueError, en.digits, '12a')
+        self.failUnless(en.date(datetime.date(1905, 3, 3)) ==
+                        ['month3', 'ord3', '19', 'oh', '5'])
+        self.failUnless(German().date(datetime.date(2009, 3, 3)) ==
+                        ['ord3', 'month3', '2', 'thousand', '9'])
+
+    def testDAmount(self):
+        'Phrases: amounts'
+        self.failUnless(English().amount(1.01) == ['1', 'euro', 'and',
+                                                   '1', 'cent'])
+        self.failUnless(German().amount(-12.5, 'euro', 'cent') ==
+                        ['minus', '12', 'euro', 'and', '50', 'cent'])
+        self.failUnless(German().amount(0) == ['0', 'euros'])
+        self.failUnless(English().amount(0.125) == ['13', 'cents'])
+        self.failUnless(English().amount(-2.005) == ['minus', '2', 'euros',
+                                                     'and', '1', 'cent'])
+
+    def testEBuild(self):
+        'Phrases: build a blob and read its index'
+        import os, tempfile, shutil
+        tmp = tempfile.mkdtemp()
+        try:
+            filenames = []
+            for name, data in (('1', 'a' * 3), ('2', 'b' * 5)):
+                fn = os.path.join(tmp, name + '.al')
+                f = open(fn, 'wb')
+                f.write(data)
+                f.close()
+                filenames.append(fn)
+
+            blob = os.path.join(tmp, 'en.al')
+            build(filenames, blob)
+            self.failUnless(open(blob, 'rb').read() == 'aaabbbbb')
+            self.failUnless(read_index(os.path.join(tmp, 'en.idx')) ==
+                            { '1': (0, 3), '2': (3, 5) })
+        finally:
+            shutil.rmtree(tmp)
+
+class SpeechTest(unittest.TestCase):
+
+    class Channel:
+        channel = None
+        name = 'test'
+
+    class Data:
+        'Record the data that a play job passes to the driver'
+        channel = None
+
+        def __init__(self):
+            self.puts = []
+            self.buffer = ''
+
+        def put_replay_buffer(self, buffer, offset, length, last):
+            self.puts.append((str(buffer[offset:offset + length]),
+                              bool(last), 'buffer'))
+            return 0
+
+        def setdata(self, s):
+            self.buffer = s
+
+    def play(self, job, length):
+        """Pass the data of job to a Data in chunks of length, the way
+        fill_play_buffer does. Return the puts."""
+        from aculab import speech
+        data = job.data = self.Data()
+        def put(data, last):
+            data.puts.append((data.buffer, last, 'copy'))
+            return 0
+        lowlevel = speech.lowlevel
+        saved = lowlevel.sm_put_replay_data, lowlevel.sm_put_last_replay_data
+        lowlevel.sm_put_replay_data = lambda data: put(data, False)
+        lowlevel.sm_put_last_replay_data = lambda data: put(data, True)
+        try:
+            while not data.puts or not data.puts[-1][1]:
+                job.offset += job.put_data(length)
+        finally:
+            lowlevel.sm_put_replay_data, lowlevel.sm_put_last_replay_data = \
+                                         saved
+        return data.puts
+
+    def setUp(self):
+        import tempfile
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        import os
+        fn = os.path.join(self.tmp, name)
+        f = open(fn, 'wb')
+        f.write(data)
+        f.close()
+        return fn
+
+    def testAPromptEviction(self):
+        'Speech: the prompt cache evicts the least recently used prompt'
+        from aculab.speech import PromptCache
+        cache = PromptCache(budget = 8, check_interval = None)
+        a, b, c = [self.write(n + '.al', n * 4) for n in 'abc']
+        cache.get(a)
+        cache.get(b)
+        # a is now more recently used than b
+        cache.get(a)
+        prompt = cache.get(c)
+        self.failUnless(prompt.data == 'cccc')
+        self.failUnless(sorted(cache.prompts.keys()) == [a, c])
+        stats = cache.stats()
+        self.failUnless(stats['size'] == 8)
+        self.failUnless(stats['evictions'] == 1)
+        self.failUnless(stats['hits'] == 1 and stats['misses'] == 3)
+
+    def testBPromptPinning(self):
+        'Speech: the prompt cache does not evict pinned prompts'
+        from aculab.speech import PromptCache
+        cache = PromptCache(budget = 8, check_interval = None)
+        a, b, c, d = [self.write(n + '.al', n * 4) for n in 'abcd']
+        cache.pin(a)
+        cache.get(b)
+        cache.get(c)
+        self.failUnless(sorted(cache.prompts.keys()) == [a, c])
+        cache.unpin(a)
+        cache.get(d)
+        self.failUnless(sorted(cache.prompts.keys()) == [c, d])
+
+    def testCPromptAcquire(self):
+        'Speech: the prompt cache does not evict prompts that are playing'
+        from aculab.speech import PromptCache
+        cache = PromptCache(budget = 8, check_interval = None)
+        a, b, c, d = [self.write(n + '.al', n * 4) for n in 'abcd']
+        prompt = cache.get(a)
+        cache.acquire(prompt)
+        cache.get(b)
+        cache.get(c)
+        self.failUnless(sorted(cache.prompts.keys()) == [a, c])
+        cache.release(prompt)
+        cache.get(d)
+        self.failUnless(sorted(cache.prompts.keys()) == [c, d])
+
+    def testCPromptPinLarge(self):
+        'Speech: the prompt cache keeps a pinned prompt over its budget'
+        from aculab.speech import PromptCache
+        cache = PromptCache(budget = 4, check_interval = None)
+        a, b = [self.write(n + '.al', n * 8) for n in 'ab']
+        self.failUnless(cache.get(a).data == 'aaaaaaaa')
+        self.failUnless(a not in cache.prompts)
+        cache.pin(b)
+        cache.get(b)
+        self.failUnless(cache.prompts.keys() == [b])
+        stats = cache.stats()
+        self.failUnless(stats['pinned'] == 1 and stats['size'] == 8)
+        self.failUnless(stats['hits'] == 1 and stats['misses'] == 2)
+        cache.unpin(b)
+        self.failUnless(cache.prompts == {})
+
+    def testDMappedPut(self):
+        'Speech: MappedPlayJob passes chunks of the mapping to the driver'
+        from aculab.speech import MappedFile, MappedPlayJob
+        mapped = MappedFile(self.write('a.al', 'abcdefghij'))
+        try:
+            job = MappedPlayJob(self.Channel(), mapped)
+            self.failUnless(self.play(job, 4) ==
+                            [('abcd', False, 'buffer'),
+                             ('efgh', False, 'buffer'),
+                             ('ij', True, 'buffer')])
+            # the last data is empty if the length is a multiple of the chunk
+            job = MappedPlayJob(self.Channel(), mapped)
+            self.failUnless(self.play(job, 5) ==
+                            [('abcde', False, 'buffer'),
+                             ('fghij', False, 'buffer'),
+                             ('', True, 'buffer')])
+        finally:
+            mapped.close()
+
+    def testEReplayBufferBounds(self):
+        'Speech: put_replay_buffer rejects ranges outside the buffer'
+        from aculab import lowlevel
+        data = lowlevel.SM_TS_DATA_PARMS(0)
+        self.failUnlessRaises(ValueError, data.put_replay_buffer,
+                              'abc', 2, 2, 0)
+        self.failUnlessRaises(ValueError, data.put_replay_buffer,
+                              'abc', -1, 1, 0)
+        # offset + length overflows an int
+        self.failUnlessRaises(ValueError, data.put_replay_buffer,
+                              'abc', 1, 0x7fffffff, 0)
+
+    def testFPreload(self):
+        'Speech: preload pins valid prompts and reports the others'
+        import os
+        from aculab.speech import PromptCache
+        from aculab.manifest import preload
+        cache = PromptCache(check_interval = None)
+        good = self.write('good.al', 'aaaa')
+        missing = os.path.join(self.tmp, 'missing.al')
+        wav = self.write('wav.al', 'RIFF' + 'a' * 40)
+        odd = self.write('odd.sw', 'abc')
+        empty = self.write('empty.ul', '')
+        text = self.write('readme.txt', 'text')
+        report = preload([good, missing, wav, odd, empty, text, good], cache)
+        self.failUnless([p.filename for p in report.loaded] == [good])
+        self.failUnless(report.size == 4)
+        problems = dict(report.problems)
+        self.failUnless(sorted(problems.keys()) ==
+                        sorted([missing, wav, odd, empty, text]))
+        self.failUnless(problems[wav] == 'WAV header')
+        self.failUnless(problems[odd] == 'odd length for 16 bit samples')
+        self.failUnless(problems[empty] == 'empty')
+        self.failUnless(problems[text] == 'unknown extension')
+        # only the valid prompt stays in the cache, pinned
+        self.failUnless(cache.prompts.keys() == [good])
+        self.failUnless(cache.prompts[good].pinned)
+
+    def testGPreloadStrict(self):
+        'Speech: preload raises a ValueError for invalid prompts if strict'
+        import os
+        from aculab.speech import PromptCache
+        from aculab.manifest import preload
+        cache = PromptCache(check_interval = None)
+        good = self.write('good.al', 'aaaa')
+        missing = os.path.join(self.tmp, 'missing.al')
+        self.failUnlessRaises(ValueError, preload, [good, missing], cache,
+                              True)
+        report = preload([good], cache, True)
+        self.failUnless(len(report.loaded) == 1 and not report.problems)
+
+    def testGPreloadCached(self):
+        'Speech: preload loads large prompts and reports uncached ones'
+        from aculab.speech import PromptCache
+        from aculab.manifest import preload
+
+        class Cache(PromptCache):
+            # a cache that does not keep pinned prompts over its budget
+            def pin(self, filename, filetype = None):
+                return self.get(filename, filetype)
+
+        large = self.write('large.al', 'a' * 8)
+        cache = PromptCache(budget = 4, check_interval = None)
+        report = preload([large], cache, True)
+        self.failUnless(report.size == 8 and large in cache.prompts)
+
+        cache = Cache(budget = 4, check_interval = None)
+        report = preload([large], cache)
+        self.failUnless(report.loaded == [] and report.size == 0)
+        self.failUnless(report.problems == [(large, 'not cached')])
+        self.failUnlessRaises(ValueError, preload, [large], cache, True)
+
+    def testHPlaylistPut(self):
+        'Speech: PlaylistJob copies chunks across items'
+        from aculab.speech import MappedFile, PlaylistJob
+        a = MappedFile(self.write('a.al', 'aaaaaa'))
+        c = MappedFile(self.write('c.al', 'cccc'))
+        try:
+            job = PlaylistJob(self.Channel(),
+                              [a, self.write('b.al', 'bbb'), c])
+            try:
+                self.failUnless(self.play(job, 4) ==
+                                [('aaaa', False, 'buffer'),
+                                 ('aabb', False, 'copy'),
+                                 ('bccc', False, 'copy'),
+                                 ('c', True, 'buffer')])
+            finally:
+                job.release()
+        finally:
+            a.close()
+            c.close()
+
+    def testIPlaylistLast(self):
+        'Speech: PlaylistJob passes the last chunk across items as last data'
+        from aculab.speech import PlaylistJob
+        job = PlaylistJob(self.Channel(), [self.write('a.al', 'aaa'),
+                                           self.write('b.al', 'bbbb')])
+        try:
+            self.failUnless(self.play(job, 4) ==
+                            [('aaab', False, 'copy'),
+                             ('bbb', True, 'copy')])
+        finally:
+            job.release()
+
+        job = PlaylistJob(self.Channel(), [self.write('c.al', 'cc'),
+                                           self.write('d.al', 'dd')])
+        try:
+            self.failUnless(self.play(job, 4) ==
+                            [('ccdd', False, 'copy'),
+                             ('', True, 'copy')])
+        finally:
+            job.release()
+
+    def testJPlaylistLocate(self):
+        'Speech: PlaylistJob finds the item at an offset'
+        from aculab.speech import PlaylistJob
+        job = PlaylistJob(self.Channel(), [self.write('a.al', 'a' * 800),
+                                           self.write('b.al', ''),
+                                           self.write('c.al', 'c' * 1600)])
+        try:
+            self.failUnless(job.starts == [0, 800, 800])
+            self.failUnless(job.boundaries() == [0.0, 0.1, 0.1])
+            self.failUnless(job.locate(0) == (0, 0.0))
+            self.failUnless(job.locate(400) == (0, 0.05))
+            # the empty item is skipped
+            self.failUnless(job.locate(800) == (2, 0.0))
+            self.failUnless(job.locate(1200) == (2, 0.05))
+            # the end is the end of the last item
+            self.failUnless(job.locate(2400) == (2, 0.2))
+        finally:
+            job.release()
+
+    def testKStartFailure(self):
+        'Speech: a job that fails to start is no longer tracked by a drain'
+        from aculab import drain
+        from aculab.speech import SpeechChannel
+        from aculab.posixreactor import PollReactor
+
+        class Job:
+            def start(self):
+                raise AculabSpeechError(-1, 'sm_replay_start', 'test')
+
+        # no hardware: only the attributes that start uses
+        channel = SpeechChannel.__new__(SpeechChannel)
+        channel.name = 'test'
+        channel.channel = None
+        channel.job = None
+        channel.close_pending = False
+
+        d = drain.Drain(PollReactor())
+        d.start()
+        try:
+            self.failUnlessRaises(AculabSpeechError, channel.start, Job())
+            self.failUnless(channel.job is None)
+            self.failUnless(d.stats()['jobs'] == 0)
+        finally:
+            d.cancel()
+
+    def testLPlaylistShortRead(self):
+        'Speech: PlaylistJob ends with the data it read from a shrunk file'
+        from StringIO import StringIO
+        from aculab.speech import PlaylistJob
+        b = StringIO('bbbb')
+        job = PlaylistJob(self.Channel(), [self.write('a.al', 'aaa'), b])
+        try:
+            # b shrinks after its length was measured
+            b.truncate(2)
+            self.failUnless(self.play(job, 4) ==
+                            [('aaab', False, 'copy'),
+                             ('b', True, 'copy')])
+            self.failUnless(job.offset == 5)
+            self.failUnless(job.locate(job.offset) == (1, 2 / 8000.0))
+        finally:
+            job.release()
+
+    def testMPlaylistOpenError(self):
+        'Speech: PlaylistJob closes the files it opened if an item fails'
+        import os
+        from aculab import speech
+        opened = []
+        def open_file(name, mode = 'r'):
+            f = open(name, mode)
+            opened.append(f)
+            return f
+
+        speech.file = open_file
+        try:
+            self.failUnlessRaises(IOError, speech.PlaylistJob, self.Channel(),
+                                  [self.write('a.al', 'aaa'),
+                                   os.path.join(self.tmp, 'missing.al')])
+        finally:
+            del speech.file
+
+        self.failUnless(len(opened) == 1 and opened[0].closed)
+
 if __name__ == '__main__':
     unittest.main()
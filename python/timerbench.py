@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2009 Lars Immisch
+
+"""Benchmark for the reactor timers.
+
+Arms a large number of timers with random intervals, then cancels
+them in random order. Also measures how many wakeups the timer slack
+saves. No Aculab hardware is needed."""
+
+import sys
+import time
+import random
+import optparse
+from aculab.timer import TimerBase, TimerWheel
+
+def nop():
+    pass
+
+def bench_add_cancel(timers, count):
+    """Arm count timers and cancel all of them in random order.
+
+    @return: a tuple (add time, cancel time) in seconds."""
+
+    intervals = [random.uniform(1.0, 60.0) for i in range(count)]
+
+    start = time.time()
+    armed = [timers.add(i, nop)[0] for i in intervals]
+    t_add = time.time() - start
+
+    random.shuffle(armed)
+
+    start = time.time()
+    for t in armed:
+        timers.cancel(t)
+    t_cancel = time.time() - start
+
+    return t_add, t_cancel
+
+def bench_expire(timers, count):
+    """Arm count timers that are already due and collect them.
+
+    @return: the time needed to collect the timers in seconds."""
+
+    for i in range(count):
+        timers.add(0.0, nop)
+
+    # wait for the first tick of a TimerWheel
+    time.sleep(getattr(timers, 'resolution', 0.0) * 2)
+
+    start = time.time()
+    todo = timers.get_pending()
+    t_expire = time.time() - start
+
+    assert len(todo) == count
+
+    return t_expire
+
+def bench_wakeups(timers, count, slack, spread = 1.0):
+    """Arm count timers due within spread seconds with slack and let them
+    expire.
+
+    @return: the timer statistics, see L{TimerBase.stats}."""
+
+    for i in range(count):
+        timers.add(random.uniform(0.0, spread), nop, slack = slack)
+
+    while len(timers):
+        time.sleep(timers.time_to_wait() / 1000.0)
+        timers.get_pending()
+
+    return timers.stats()
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='usage: %prog [options]',
+                                   description='Benchmark the reactor timers.')
+    parser.add_option('-n', '--count', type='int', default=100000,
+                      help='Arm COUNT timers. Default is 100000.')
+    parser.add_option('-w', '--wheel', action='store_true',
+                      help='Benchmark the TimerWheel instead of TimerBase.')
+    parser.add_option('-s', '--slack', type='float', default=0.05,
+                      help='Slack for the wakeup benchmark. Default is 0.05.')
+
+    options, args = parser.parse_args()
+
+    if options.wheel:
+        factory = TimerWheel
+    else:
+        factory = TimerBase
+
+    t_add, t_cancel = bench_add_cancel(factory(), options.count)
+    print 'add:    %d timers in %.3fs (%.2f us/timer)' % \
+          (options.count, t_add, t_add * 1e6 / options.count)
+    print 'cancel: %d timers in %.3fs (%.2f us/timer)' % \
+          (options.count, t_cancel, t_cancel * 1e6 / options.count)
+
+    t_expire = bench_expire(factory(), options.count)
+    print 'expire: %d timers in %.3fs (%.2f us/timer)' % \
+          (options.count, t_expire, t_expire * 1e6 / options.count)
+
+    count = min(options.count, 10000)
+    for slack in (0.0, options.slack):
+        stats = bench_wakeups(factory(), count, slack)
+        print 'wakeups: %d timers within 1s, slack %.3fs: %d wakeups ' \
+              '(%.1f%% saved)' % (count, slack, stats['wakeups'],
+                                  stats['wakeup_reduction'] * 100)